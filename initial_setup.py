@@ -16,7 +16,8 @@ libraries = [
     'pick', 
     'alive_progress',
     'openpyxl',
-    'xlsxwriter'
+    'xlsxwriter',
+    'pyarrow'
  ]
 
 try:
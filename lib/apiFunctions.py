@@ -0,0 +1,1321 @@
+'''
+apiFunctions.py is a module of the rate calculator tool. It contains the
+functions for using the calculator from other python code. Unlike calcRun,
+these functions do not print, prompt or write files (other than hourly cost
+attribution files when they are asked for). Results are returned as
+dataframes and progress and log messages are passed to optional callbacks.
+
+example:
+    import lib.apiFunctions as api
+
+    rates = api.loadRates()   # load once and reuse for many calculations
+    longdf, summarydf = api.calculate((energy, power),
+                                      'Filtered Commercial Rates', 5,
+                                      rates=rates)
+
+Built by Atlas Public Policy in Washington, DC
+2023
+'''
+
+# external dependencies
+import pandas as pd
+import numpy as np
+import pyarrow.dataset as ds
+import json
+import time
+import os
+
+# internal dependencies
+import lib.inputFunctions as imp
+import lib.calculatorFunctions as calc
+import lib.outputFunctions as out
+
+############################ RATE FUNCTIONS ####################################
+
+def loadRates(cache=None, stack=True):
+    '''
+    loads the rate cache (if not passed in) and stacks the supported rates
+    for the batch calculator (unless stack is False, see calculateChunks).
+    The cache must already be built (see buildCache), otherwise
+    FileNotFoundError is raised. Returns a dictionary
+    of:
+        cache - the loaded cache (see loadCache)
+        info - rate details indexed by rate id
+        reasons - supportReason of each rate id
+        batch - supported rates stacked for batchCalc (see priceBatch)
+        position - position of each supported rate id in batch and in the
+                   cached price matrices
+        eiaIndex, utilityIndex - rate ids of each eiaId and utility name
+    '''
+    if cache is None:
+        cache = imp.loadCache(quiet=True)
+
+    info = cache['info'].set_index('id')
+
+    rates = {'cache': cache,
+             'info': info,
+             'reasons': dict(zip(cache['info']['id'],
+                                 cache['info']['supportReason'])),
+             'eiaIndex': rateIndex(info['eiaId']),
+             'utilityIndex': rateIndex(info['utilityName']),
+             'position': {k: i for i, k in
+                          enumerate(cache['prices']['ids'].tolist())}}
+
+    if stack:
+        rates['batch'] = calc.priceBatch(cache['prices'])
+
+    return rates
+
+# ------------------------------------------------------------------------------
+
+def rateIndex(column):
+    '''
+    returns a dictionary of the rate ids for each value of a rate info column
+    '''
+    return {k: v.tolist() for k, v in
+            column.index.groupby(column.values).items()}
+
+# ------------------------------------------------------------------------------
+
+def listCriteria(value):
+    '''
+    helper function that turns a single selection value into a list
+    '''
+    return value if isinstance(value, list) else [value]
+
+# ------------------------------------------------------------------------------
+
+def selectRates(rates, selection):
+    '''
+    returns the ids of the rates picked by a rate selection. selection is one
+    of:
+        - the name of a calculator rate set (see filterIds)
+        - a list of rate ids (ids not in the cache are dropped)
+        - a dictionary with any of the keys:
+            filter - calculator rate set, default 'All Filtered Rates'
+            ids, sector, eiaId, utility - a value or list of values to keep
+            asOf - a date or a [start, end] pair of dates. Only rates in
+                   effect on the date or during the range are kept (see
+                   inputFunctions.effectiveRates)
+    '''
+    if isinstance(selection, str):
+        selection = {'filter': selection}
+    elif not isinstance(selection, dict):
+        # lists of ids keep their order
+        return [i for i in selection if i in rates['info'].index]
+
+    cache = rates['cache']
+    ids = imp.filterIds(selection.get('filter', 'All Filtered Rates'),
+                        imp.filteredRates(cache), cache['rates'])
+    info = rates['info'].loc[ids]
+
+    columns = {'ids': info.index, 'sector': info['sector'],
+               'eiaId': info['eiaId'], 'utility': info['utilityName']}
+    keep = np.ones(len(info), dtype=bool)
+    for k, v in columns.items():
+        if k in selection:
+            keep &= np.asarray(v.isin(listCriteria(selection[k])))
+    if 'asOf' in selection:
+        keep &= np.asarray(info.index.isin(
+            list(imp.effectiveRates(cache['dates'], selection['asOf']))))
+
+    return info.index[keep].tolist()
+
+# ------------------------------------------------------------------------------
+
+def applicableIds(rates, ids, power):
+    '''
+    returns the ids whose demand range contains the peak of power (see
+    applicableRates)
+    '''
+    keep = imp.applicableRates(rates['cache']['demand'], np.max(power))
+    return [i for i in ids if i in keep]
+
+# ------------------------------------------------------------------------------
+
+def ratePositions(rates, ids):
+    '''
+    returns the positions in the stacked batch of the supported rates in ids
+    '''
+    return np.array([rates['position'][i] for i in ids
+                     if i in rates['position']], dtype=int)
+
+########################### PROFILE FUNCTIONS ##################################
+
+def readProfile(profile, sheet='Single'):
+    '''
+    returns validated 12 x 24 energy and power arrays from a profile, which is
+    either:
+        - an (energy, power) pair or array of 24 or 12 x 24 hourly values
+        - the path to an input workbook (read from sheet) or profile file
+    raises ValueError if the profile is invalid
+    '''
+    if isinstance(profile, (str, os.PathLike)):
+        energy, power = imp.readFile(profile, sheet)
+    else:
+        energy, power = imp.monthlyProfile(np.asarray(profile,
+                                                      dtype=np.float64))
+
+    imp.validateProfile(energy, power)
+    return energy, power
+
+########################## CALCULATION FUNCTIONS ###############################
+
+def calculate(profile, rate_selection='All Filtered Rates', charge_days=7,
+              rates=None, sheet='Single', applicable=False, progress=None,
+              log=None, attribution=None):
+    '''
+    calculates the cost of a load profile under a selection of rates.
+
+    profile: load profile (see readProfile)
+    rate_selection: rate set name, list of rate ids or selection criteria
+                    (see selectRates)
+    charge_days: charging days per week (1-7)
+    rates: rates from loadRates, loaded from the cache if not passed in.
+           Pass them in when calculating many profiles
+    applicable: if True, only rates whose demand range contains the
+                profile's peak demand are included (see applicableRates)
+    progress: optional callback called with (rates done, total rates)
+    log: optional callback called with progress messages
+    attribution: optional path prefix. If given, the hourly TOU energy cost
+                 and the TOU demand cost of each period are written to
+                 <attribution>_energy.parquet and <attribution>_demand.parquet
+                 as the rates are calculated (see attributionStreams)
+
+    returns the monthly (long) and annual (summary) dataframes written by
+    calcRun. Unsupported rates are included with rateSupported False
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates()
+
+    energy, power = readProfile(profile, sheet)
+    ids = selectRates(rates, rate_selection)
+    if applicable:
+        ids = applicableIds(rates, ids, power)
+    index = ratePositions(rates, ids)
+    log(f'{len(index)} of {len(ids)} rates are supported')
+
+    days = calc.daysMonth(charge_days)
+    total_energy = calc.nrgUse(energy, days)
+
+    log('calculating costs')
+    streams, write = attributionStreams(attribution, energy, days)
+    try:
+        costs = calc.batchCalc(rates['batch'], energy, power, days, index,
+                               progress, write)
+    finally:
+        closeStreams(streams)
+
+    log('assembling output')
+    return buildOutput(rates, ids, [rates['batch']['ids'][i] for i in index],
+                       costs, 0, total_energy)
+
+# ------------------------------------------------------------------------------
+
+def calculateChunks(profile, rate_selection='All Filtered Rates',
+                    charge_days=7, rates=None, chunk_size=2000,
+                    sheet='Single', applicable=False, progress=None,
+                    log=None, attribution=None):
+    '''
+    streaming version of calculate for large rate selections. Rates are
+    calculated chunk_size at a time in id order and the monthly (long) and
+    annual (summary) dataframes of each chunk are yielded in turn. Only one
+    chunk of rates is stacked and only one chunk of output is held at a time,
+    so memory use is set by chunk_size rather than the number of rates.
+
+    arguments are as for calculate. rates may be loaded with
+    loadRates(stack=False) as chunks are read from the cached price matrices
+    when they are calculated
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates(stack=False)
+
+    energy, power = readProfile(profile, sheet)
+    ids = sorted(selectRates(rates, rate_selection))
+    if applicable:
+        ids = applicableIds(rates, ids, power)
+    log(f'calculating {len(ids)} rates in chunks of {chunk_size}')
+
+    days = calc.daysMonth(charge_days)
+    total_energy = calc.nrgUse(energy, days)
+
+    streams, write = attributionStreams(attribution, energy, days)
+    try:
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            batch = calc.priceBatch(rates['cache']['prices'],
+                                    ratePositions(rates, chunk))
+            costs = calc.batchCalc(batch, energy, power, days,
+                                   attribution=write)
+
+            yield buildOutput(rates, chunk, batch['ids'], costs, 0,
+                              total_energy)
+
+            if progress is not None:
+                progress(start + len(chunk), len(ids))
+    finally:
+        closeStreams(streams)
+
+# ------------------------------------------------------------------------------
+
+def attributionStreams(path, energy, days):
+    '''
+    opens the hourly cost attribution files <path>_energy.parquet (TOU energy
+    cost by month, day type and hour) and <path>_demand.parquet (TOU demand
+    cost by month and period) and returns the file streams and a batchCalc
+    attribution callback that appends each chunk of rates to them. Returns
+    no streams and no callback if path is None
+    '''
+    if path is None:
+        return {}, None
+
+    streams = {'energy': out.openParquetStream(f'{path}_energy.parquet'),
+               'demand': out.openParquetStream(f'{path}_demand.parquet')}
+
+    def write(ids, hourly, peaks, hours, cost, prices):
+        out.appendParquetRows(streams['energy'], out.energyAttribution(
+            ids, hourly[0], energy, days))
+        out.appendParquetRows(streams['demand'], out.demandAttribution(
+            ids, peaks[0], hours[0], cost[0], prices))
+
+    return streams, write
+
+# ------------------------------------------------------------------------------
+
+def closeStreams(streams):
+    '''
+    closes the attribution files opened by attributionStreams
+    '''
+    for i in streams.values():
+        out.closeParquetStream(i)
+
+# ------------------------------------------------------------------------------
+
+def buildOutput(rates, ids, costIds, costs, p, total_energy):
+    '''
+    assembles the batchCalc costs of profile p into the monthly (long) and
+    annual (summary) dataframes with the same output pipeline as calcRun.
+    ids are all rates in the output and costIds the (supported) rates in the
+    order they were calculated in
+    '''
+    output = {k: {c: costs[c][p, n].tolist() for c in calc.components}
+              for n, k in enumerate(costIds)}
+    output = {k: out.processOutput(v, total_energy)
+              for k, v in output.items()}
+
+    # unsupported rates all share the same empty (NaN) output
+    unsupported = out.processOutput('unsupported', total_energy)
+    output = {k: output.get(k, unsupported) for k in ids}
+
+    rateInfo = rates['cache']['info']
+    for i in [out.toDataFrame, out.addRateInfo, out.createSummaries]:
+        output = i(output, rateInfo)
+
+    return output
+
+# ------------------------------------------------------------------------------
+
+def rateDetailsJoin(df, rates):
+    '''
+    joins the rate details (name, utility, eiaId, sector and supportReason)
+    to a dataframe of per-rate results indexed by rate id and returns it with
+    the rate id as a column
+    '''
+    details = ['rateName', 'utilityName', 'eiaId', 'sector', 'supportReason']
+    return df.join(rates['info'][details]).reset_index()
+
+######################## INCREMENTAL FUNCTIONS #################################
+
+# monthly results of the last run of each input (see recalculate), saved as
+# <key>.npz with the profile they were calculated for
+monthDir = 'results/months'
+
+# ------------------------------------------------------------------------------
+
+def readMonths(key):
+    '''
+    returns the monthly results saved under key (see writeMonths), None if
+    there are none
+    '''
+    path = os.path.join(monthDir, f'{key}.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+# ------------------------------------------------------------------------------
+
+def writeMonths(key, months):
+    '''
+    saves monthly results (see recalculate) under key. The file is written to
+    a temporary file and moved into place
+    '''
+    os.makedirs(monthDir, exist_ok=True)
+    path = os.path.join(monthDir, f'{key}.npz')
+    with open(imp.stagedFile(path), 'wb') as f:
+        np.savez(f, **months)
+    os.replace(imp.stagedFile(path), path)
+
+# ------------------------------------------------------------------------------
+
+def joinMonths(parts):
+    '''
+    joins the monthly results of the chunks of recalculateChunks. Returns
+    None if there are no chunks
+    '''
+    parts = list(parts)
+    if not parts:
+        return None
+    return dict(parts[0], **{k: np.concatenate([i[k] for i in parts])
+                             for k in ['ids', 'fingerprints'] + calc.components})
+
+# ------------------------------------------------------------------------------
+
+def changedMonths(previous, energy, power):
+    '''
+    returns the positions (0-11) of the months whose hourly energy or power
+    differ from those of previous monthly results (all months if previous is
+    None)
+    '''
+    if previous is None:
+        return list(range(12))
+    changed = ((previous['energy'] != energy)
+               | (previous['power'] != power)).any(axis=1)
+    return np.flatnonzero(changed).tolist()
+
+# ------------------------------------------------------------------------------
+
+def monthCosts(batch, index, energy, power, charge_days, fingerprints,
+               previous=None, progress=None, attribution=None):
+    '''
+    batchCalc of the rates at index in batch for one profile that reuses
+    previous monthly results. Rates in previous with the same fingerprint
+    (and the same charge days) keep their results and only the months whose
+    profile changed are recalculated (see monthCalc). Flat demand charges
+    use the peak of the year, so they are recalculated for every month if
+    the peak changed. Other rates are calculated in full, as are all rates
+    when attribution (a batchCalc attribution callback) is given.
+
+    returns a dictionary of 1 x N x 12 arrays keyed by component name and
+    the monthly results to save or pass as previous next time
+    '''
+    days = calc.daysMonth(charge_days)
+    index = np.asarray(index, dtype=int)
+    ids = np.array([batch['ids'][i] for i in index], dtype=str)
+    prints = np.array([fingerprints[i] for i in ids], dtype=str)
+    costs = {c: np.zeros((1, len(index), 12)) for c in calc.components}
+
+    # position of each rate in previous, -1 if it has to be calculated
+    old = np.full(len(index), -1)
+    if (previous is not None and attribution is None and len(previous['ids'])
+            and int(previous['chargeDays']) == charge_days):
+        position = {k: n for n, k in enumerate(previous['ids'].tolist())}
+        old = np.array([position.get(k, -1) for k in ids.tolist()], dtype=int)
+        old[previous['fingerprints'][old] != prints] = -1
+    reuse = old >= 0
+
+    # report progress over all rates across both calculations
+    report = lambda offset: (None if progress is None else
+                             lambda done, total: progress(offset + done,
+                                                          len(index)))
+
+    if not reuse.all():
+        output = calc.batchCalc(batch, energy, power, days, index[~reuse],
+                                report(0), attribution)
+        for c in calc.components:
+            costs[c][:, ~reuse] = output[c]
+
+    if reuse.any():
+        for c in calc.components:
+            costs[c][0, reuse] = previous[c][old[reuse]]
+
+        months = changedMonths(previous, energy, power)
+        if months:
+            output = calc.monthCalc(batch, energy, power, days, months,
+                                    index[reuse], report((~reuse).sum()))
+            rows = np.flatnonzero(reuse)
+            for c in calc.components:
+                costs[c][0][np.ix_(rows, months)] = output[c][0]
+
+        if power.max() != previous['power'].max():
+            maxPower = calc.batchProfiles(energy, power, days)[4]
+            costs['FlatDemandCharge'][:, reuse] = calc.tierKernel(
+                maxPower, batch['demandFlatRates'][index[reuse]],
+                batch['demandFlatMax'][index[reuse]])
+
+    months = {'energy': energy, 'power': power, 'chargeDays': charge_days,
+              'ids': ids, 'fingerprints': prints,
+              **{c: costs[c][0] for c in calc.components}}
+    return costs, months
+
+# ------------------------------------------------------------------------------
+
+def recalculate(profile, previous=None, rate_selection='All Filtered Rates',
+                charge_days=7, rates=None, sheet='Single', applicable=False,
+                progress=None, log=None, attribution=None):
+    '''
+    version of calculate that reuses the monthly results of an earlier call,
+    usually for the same input before it was edited. Only the months whose
+    hourly energy or power changed are recalculated (see monthCosts), so
+    editing one month of a profile costs about 1/12 of a calculation.
+
+    previous: monthly results returned by an earlier call (or readMonths),
+              everything is calculated if None
+    other arguments are as for calculate
+
+    returns the monthly (long) and annual (summary) dataframes of calculate
+    and the monthly results to pass as previous next time
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates()
+
+    energy, power = readProfile(profile, sheet)
+    ids = selectRates(rates, rate_selection)
+    if applicable:
+        ids = applicableIds(rates, ids, power)
+    index = ratePositions(rates, ids)
+    log(f'{len(index)} of {len(ids)} rates are supported')
+
+    days = calc.daysMonth(charge_days)
+    total_energy = calc.nrgUse(energy, days)
+
+    log(f'{len(changedMonths(previous, energy, power))} of 12 months changed, '
+        'calculating costs')
+    streams, write = attributionStreams(attribution, energy, days)
+    try:
+        costs, months = monthCosts(rates['batch'], index, energy, power,
+                                   charge_days, rates['cache']['fingerprints'],
+                                   previous, progress, write)
+    finally:
+        closeStreams(streams)
+
+    log('assembling output')
+    longdf, summarydf = buildOutput(rates, ids, months['ids'].tolist(), costs,
+                                    0, total_energy)
+    return longdf, summarydf, months
+
+# ------------------------------------------------------------------------------
+
+def recalculateChunks(profile, previous=None,
+                      rate_selection='All Filtered Rates', charge_days=7,
+                      rates=None, chunk_size=2000, sheet='Single',
+                      applicable=False, progress=None, log=None,
+                      attribution=None):
+    '''
+    streaming version of recalculate (see calculateChunks). Yields the
+    monthly (long) and annual (summary) dataframes and the monthly results of
+    each chunk of rates in turn. The monthly results of the chunks are
+    joined with joinMonths
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates(stack=False)
+
+    energy, power = readProfile(profile, sheet)
+    ids = sorted(selectRates(rates, rate_selection))
+    if applicable:
+        ids = applicableIds(rates, ids, power)
+    log(f'{len(changedMonths(previous, energy, power))} of 12 months changed, '
+        f'calculating {len(ids)} rates in chunks of {chunk_size}')
+
+    days = calc.daysMonth(charge_days)
+    total_energy = calc.nrgUse(energy, days)
+
+    streams, write = attributionStreams(attribution, energy, days)
+    try:
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            batch = calc.priceBatch(rates['cache']['prices'],
+                                    ratePositions(rates, chunk))
+            costs, months = monthCosts(batch, np.arange(len(batch['ids'])),
+                                       energy, power, charge_days,
+                                       rates['cache']['fingerprints'],
+                                       previous, attribution=write)
+
+            yield (*buildOutput(rates, chunk, batch['ids'], costs, 0,
+                                total_energy), months)
+
+            if progress is not None:
+                progress(start + len(chunk), len(ids))
+    finally:
+        closeStreams(streams)
+
+######################### UNCERTAINTY FUNCTIONS ################################
+
+# distributions of the factors each hour of a profile is multiplied by in
+# simulate. All have a mean of 1, spread is the standard deviation (normal,
+# lognormal) or half width (uniform) of the factors
+distributions = {
+    'normal': lambda rng, spread, size: rng.normal(1, spread, size),
+    'lognormal': lambda rng, spread, size: rng.lognormal(
+        -np.log1p(spread ** 2) / 2, np.sqrt(np.log1p(spread ** 2)), size),
+    'uniform': lambda rng, spread, size: rng.uniform(1 - spread, 1 + spread,
+                                                     size)}
+
+# cost percentiles reported by simulate
+percentiles = [10, 50, 90]
+
+# ------------------------------------------------------------------------------
+
+def drawProfiles(energy, power, draws, energy_spread=0.1, power_spread=0.2,
+                 distribution='normal', seed=None):
+    '''
+    returns draws x 12 x 24 arrays of energy and power, each hour of the
+    profile multiplied by a random factor from distribution (see
+    distributions). Negative values are set to zero
+    '''
+    if distribution not in distributions:
+        raise ValueError(f'unknown distribution {distribution}, expected one '
+                         f'of {", ".join(distributions)}')
+    if draws < 1:
+        raise ValueError('draws must be at least 1')
+
+    rng = np.random.default_rng(seed)
+    size = (draws,) + np.shape(energy)
+    energy = energy * distributions[distribution](rng, energy_spread, size)
+    power = power * distributions[distribution](rng, power_spread, size)
+
+    return np.maximum(energy, 0), np.maximum(power, 0)
+
+# ------------------------------------------------------------------------------
+
+def simulate(profile, rate_selection='All Filtered Rates', charge_days=7,
+             draws=1000, energy_spread=0.1, power_spread=0.2,
+             distribution='normal', seed=None, rates=None, sheet='Single',
+             applicable=False, progress=None, log=None):
+    '''
+    Monte Carlo version of calculate for uncertain load profiles. draws
+    perturbed profiles are drawn around the profile (see drawProfiles) and
+    all of them are calculated against the selected rates in batchCalc.
+
+    draws: number of perturbed profiles
+    energy_spread, power_spread: spread of the hourly energy and power
+                                 factors (e.g. 0.2 for about 20%)
+    distribution: distribution of the factors (see distributions)
+    seed: optional random seed for repeatable draws
+    other arguments are as for calculate
+
+    returns a dataframe with one row per rate of the annual cost of the
+    input profile and the P10, P50 and P90 annual cost and cost per kWh
+    over the draws, with rate details. Unsupported rates have no costs
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates()
+
+    energy, power = readProfile(profile, sheet)
+    ids = selectRates(rates, rate_selection)
+    if applicable:
+        ids = applicableIds(rates, ids, power)
+    index = ratePositions(rates, ids)
+
+    drawnEnergy, drawnPower = drawProfiles(energy, power, draws,
+                                           energy_spread, power_spread,
+                                           distribution, seed)
+    # the input profile is calculated first, followed by the draws
+    energy = np.concatenate([energy[None], drawnEnergy])
+    power = np.concatenate([power[None], drawnPower])
+
+    days = calc.daysMonth(charge_days)
+    annualEnergy = np.einsum('pmh,dm->p', energy, days)
+    log(f'calculating {len(index)} supported rates for {draws} draws')
+
+    # rates are calculated in chunks so the (draws x rates x 12) outputs of
+    # all components together stay within batchCells
+    chunkSize = max(1, calc.batchCells // (len(energy) * 12
+                                           * len(calc.components)))
+    annual = np.zeros((len(energy), len(index)))
+
+    for start in range(0, len(index), chunkSize):
+        chunk = index[start:start + chunkSize]
+        costs = calc.batchCalc(rates['batch'], energy, power, days, chunk)
+        annual[:, start:start + len(chunk)] = sum(
+            costs[c].sum(axis=2) for c in calc.components)
+
+        if progress is not None:
+            progress(start + len(chunk), len(index))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        perkWh = np.nan_to_num(annual / annualEnergy[:, None])
+
+    columns = {'annualCost': annual[0]}
+    columns.update({f'annualCostP{q}': v for q, v in
+                    zip(percentiles, np.percentile(annual[1:], percentiles,
+                                                   axis=0))})
+    columns.update({f'costPerkWhP{q}': v for q, v in
+                    zip(percentiles, np.percentile(perkWh[1:], percentiles,
+                                                   axis=0))})
+
+    df = pd.DataFrame(columns,
+                      index=[rates['batch']['ids'][i] for i in index])
+    df = df.reindex(ids)
+    df.index.name = 'id'
+    df.insert(0, 'rateSupported', df['annualCost'].notna())
+
+    return rateDetailsJoin(df, rates)
+
+########################## PROJECTION FUNCTIONS ################################
+
+def yearFactors(value, years, name):
+    '''
+    helper function that turns a projection input into one factor per year.
+    A single number is an annual rate compounded from the first year (e.g.
+    0.03 gives 1, 1.03, 1.0609, ...), a list gives the factor of each year
+    '''
+    if np.ndim(value) == 0:
+        factors = (1 + float(value)) ** np.arange(years)
+    else:
+        factors = np.asarray(value, dtype=np.float64)
+        if factors.shape != (years,):
+            raise ValueError(f'{name} must have one factor for each of the '
+                             f'{years} years, got {len(factors)}')
+
+    if not (factors >= 0).all():
+        raise ValueError(f'{name} factors cannot be negative')
+    return factors
+
+# ------------------------------------------------------------------------------
+
+def project(profile, rate_selection='All Filtered Rates', charge_days=7,
+            years=15, energy_escalation=0.03, demand_escalation=0.03,
+            load_growth=0.0, discount_rate=0.05, rates=None, sheet='Single',
+            applicable=False, progress=None, log=None):
+    '''
+    projects the annual cost of a load profile under a selection of rates
+    over several years (see calculatorFunctions.projectCalc).
+
+    years: number of years projected
+    energy_escalation, demand_escalation: escalation of energy and demand
+        prices, an annual rate or a list of factors (see yearFactors)
+    load_growth: growth of the load (energy and power), an annual rate or a
+        list of load multipliers (see yearFactors)
+    discount_rate: rate used to discount costs to a net present value.
+        Costs are counted at the end of each year (year 1 is discounted by
+        one year)
+    other arguments are as for calculate
+
+    returns two dataframes:
+        yeardf - annual cost by component of each rate and year
+        summarydf - the net present value and total cost over all years of
+                    each rate, with rate details. Unsupported rates have no
+                    costs
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates()
+
+    loads = yearFactors(load_growth, years, 'load_growth')
+    energyFactors = yearFactors(energy_escalation, years, 'energy_escalation')
+    demandFactors = yearFactors(demand_escalation, years, 'demand_escalation')
+
+    energy, power = readProfile(profile, sheet)
+    ids = selectRates(rates, rate_selection)
+    if applicable:
+        ids = applicableIds(rates, ids, power)
+    index = ratePositions(rates, ids)
+    costIds = [rates['batch']['ids'][i] for i in index]
+    log(f'projecting {len(index)} supported rates over {years} years')
+
+    days = calc.daysMonth(charge_days)
+    costs = calc.projectCalc(rates['batch'], energy, power, days, loads,
+                             energyFactors, demandFactors, index, progress)
+    totalCost = sum(costs.values())
+    annualEnergy = loads * np.sum(calc.nrgUse(energy, days))
+
+    # years x rates arrays to one row per rate and year
+    yeardf = pd.DataFrame({'id': np.tile(costIds, years),
+                           'year': np.repeat(np.arange(1, years + 1),
+                                             len(costIds))})
+    for c in calc.components:
+        yeardf[c] = costs[c].ravel()
+    yeardf['totalCost'] = totalCost.ravel()
+    yeardf['totalEnergy'] = np.repeat(annualEnergy, len(costIds))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        yeardf['costPerkWh'] = np.nan_to_num(yeardf['totalCost']
+                                             / yeardf['totalEnergy'])
+
+    discount = (1 + discount_rate) ** -np.arange(1, years + 1)
+    summarydf = pd.DataFrame({'npv': discount @ totalCost,
+                              'totalCost': totalCost.sum(axis=0),
+                              'firstYearCost': totalCost[0],
+                              'lastYearCost': totalCost[-1]},
+                             index=costIds).reindex(ids)
+    summarydf.index.name = 'id'
+    summarydf.insert(0, 'rateSupported', summarydf['npv'].notna())
+
+    return yeardf, rateDetailsJoin(summarydf, rates)
+
+########################## MANAGED CHARGING FUNCTIONS ##########################
+
+def optimize(profile, rate_selection='All Filtered Rates', charge_days=7,
+             plug_in=18, departure=7, max_kw=None, peak_cap=None, rates=None,
+             sheet='Single', applicable=False, progress=None, log=None):
+    '''
+    compares managed and unmanaged charging of a load profile under a
+    selection of rates. For each rate the daily energy is shifted into the
+    cheapest hours of a charging window (see calculatorFunctions.shiftCalc).
+
+    plug_in, departure: hours (0-23) the charging window starts and ends.
+        The window wraps past midnight (e.g. 18 to 7)
+    max_kw: charger power (kW), defaults to the peak power of the profile
+    peak_cap: optional site power limit (kW)
+    other arguments are as for calculate
+
+    returns a dataframe with the annual unmanaged and managed cost of each
+    rate, the savings and the peak power of the managed profile, the
+    managed cost by component and rate details. Unsupported rates have no
+    costs. raises ValueError if the window cannot deliver the daily energy
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates()
+
+    for name, hour in [('plug_in', plug_in), ('departure', departure)]:
+        if int(hour) != hour or not 0 <= hour <= 23:
+            raise ValueError(f'{name} must be an hour between 0 and 23')
+
+    energy, power = readProfile(profile, sheet)
+    if max_kw is None:
+        max_kw = float(np.max(power))
+    if max_kw <= 0 or (peak_cap is not None and peak_cap <= 0):
+        raise ValueError('max_kw and peak_cap must be greater than 0')
+
+    ids = selectRates(rates, rate_selection)
+    if applicable:
+        ids = applicableIds(rates, ids, power)
+    index = ratePositions(rates, ids)
+    costIds = [rates['batch']['ids'][i] for i in index]
+    log(f'optimizing charging for {len(index)} supported rates')
+
+    managed, unmanaged, peaks = calc.shiftCalc(
+        rates['batch'], energy, power, calc.daysMonth(charge_days),
+        (int(plug_in), int(departure)), max_kw, peak_cap, index, progress)
+
+    unmanagedCost = sum(unmanaged.values()).sum(axis=1)
+    managedCost = sum(managed.values()).sum(axis=1)
+    df = pd.DataFrame({'unmanagedCost': unmanagedCost,
+                       'managedCost': managedCost,
+                       'savings': unmanagedCost - managedCost},
+                      index=costIds)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['savingsPct'] = np.nan_to_num(df['savings'] / unmanagedCost)
+    df['managedPeak'] = peaks
+    for c in calc.components:
+        df[f'managed{c}'] = managed[c].sum(axis=1)
+
+    df = df.reindex(ids)
+    df.index.name = 'id'
+    df.insert(0, 'rateSupported', df['managedCost'].notna())
+
+    return rateDetailsJoin(df, rates)
+
+########################## DEMAND CAP FUNCTIONS ################################
+
+def capSweep(profile, caps, rate_selection='All Filtered Rates',
+             charge_days=7, rates=None, sheet='Single', applicable=False,
+             progress=None, log=None):
+    '''
+    calculates the savings of capping the site power at each of a list of
+    cap levels (kW) under a selection of rates (see
+    calculatorFunctions.capCalc). The power profile is clipped at each cap
+    and the energy profile is unchanged.
+
+    caps: list of power caps (kW). Caps above the peak power of the profile
+        have no effect
+    other arguments are as for calculate
+
+    returns two dataframes:
+        curvedf - the annual demand charges, total cost and savings of each
+                  rate and cap (the savings curve of each rate)
+        summarydf - the uncapped annual cost of each rate and its savings at
+                    each cap (one savings column per cap), with rate
+                    details. Unsupported rates have no costs
+    '''
+    log = log or (lambda message: None)
+
+    caps = np.asarray(caps, dtype=np.float64).ravel()
+    if len(caps) == 0 or not (caps > 0).all():
+        raise ValueError('caps must be a list of power levels greater than 0')
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates()
+
+    energy, power = readProfile(profile, sheet)
+    ids = selectRates(rates, rate_selection)
+    if applicable:
+        ids = applicableIds(rates, ids, power)
+    index = ratePositions(rates, ids)
+    costIds = [rates['batch']['ids'][i] for i in index]
+    log(f'calculating {len(caps)} demand caps for {len(index)} supported '
+        'rates')
+
+    # the uncapped profile is calculated as the last cap
+    costs = calc.capCalc(rates['batch'], energy, power,
+                         calc.daysMonth(charge_days), np.append(caps, np.inf),
+                         index, progress)
+    costs = {k: v.sum(axis=2) for k, v in costs.items()}
+    totalCost = sum(costs.values())
+    savings = totalCost[-1] - totalCost[:-1]
+
+    # caps x rates arrays to one row per rate and cap
+    curvedf = pd.DataFrame({'id': np.tile(costIds, len(caps)),
+                            'capKW': np.repeat(caps, len(costIds))})
+    for c in ['FlatDemandCharge', 'TOUDemandCharge']:
+        curvedf[c] = costs[c][:-1].ravel()
+    curvedf['totalCost'] = totalCost[:-1].ravel()
+    curvedf['savings'] = savings.ravel()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        curvedf['savingsPct'] = np.nan_to_num(
+            curvedf['savings'] / np.tile(totalCost[-1], len(caps)))
+
+    summarydf = pd.DataFrame({'uncappedCost': totalCost[-1]}, index=costIds)
+    for k, cap in enumerate(caps):
+        summarydf[f'savings{cap:g}kW'] = savings[k]
+    summarydf = summarydf.reindex(ids)
+    summarydf.index.name = 'id'
+    summarydf.insert(0, 'rateSupported', summarydf['uncappedCost'].notna())
+
+    return curvedf, rateDetailsJoin(summarydf, rates)
+
+########################### SCENARIO FUNCTIONS #################################
+
+# saved scenarios. scenarios.json lists each scenario's inputs, its load
+# profile is saved as <name>_profile.npy and its annual results, with the
+# fingerprint of each rate they were calculated with, as <name>.parquet
+scenarioDir = 'results/scenarios'
+
+# annual result columns kept for saved scenarios
+scenarioColumns = ['id', 'rateSupported', 'supportReason',
+                   'TieredEnergyCharge', 'TOUEnergyCharge', 'FlatDemandCharge',
+                   'TOUDemandCharge', 'totalCost', 'totalEnergy', 'costPerkWh']
+
+# ------------------------------------------------------------------------------
+
+def readScenarios():
+    '''
+    returns the saved scenarios (name: inputs) from scenarios.json, an empty
+    dictionary if no scenario has been saved
+    '''
+    path = os.path.join(scenarioDir, 'scenarios.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+# ------------------------------------------------------------------------------
+
+def writeScenario(name, scenario, summarydf, rates):
+    '''
+    saves a scenario's inputs and annual results with the current
+    fingerprint of each rate (see inputFunctions.rateFingerprint). Files are
+    written to temporary files and moved into place
+    '''
+    summarydf = summarydf[scenarioColumns].copy()
+    for c in scenarioColumns[3:]:
+        summarydf[c] = summarydf[c].astype(float)
+    summarydf['fingerprint'] = summarydf['id'].map(
+        rates['cache']['fingerprints'])
+
+    path = os.path.join(scenarioDir, f'{name}.parquet')
+    summarydf.to_parquet(imp.stagedFile(path), index=False)
+    os.replace(imp.stagedFile(path), path)
+
+    scenarios = readScenarios()
+    scenarios[name] = dict(scenario,
+                           updated=time.strftime('%Y-%m-%d %H:%M:%S'))
+    path = os.path.join(scenarioDir, 'scenarios.json')
+    with open(imp.stagedFile(path), 'w') as f:
+        json.dump(scenarios, f, indent=2)
+    os.replace(imp.stagedFile(path), path)
+
+# ------------------------------------------------------------------------------
+
+def saveScenario(name, profile, rate_selection='All Filtered Rates',
+                 charge_days=7, sheet='Single', applicable=False, rates=None,
+                 progress=None, log=None):
+    '''
+    calculates a scenario (arguments as for calculate) and saves it so it
+    can be brought up to date after the cache is refreshed (see
+    updateScenarios). A scenario with the same name is replaced. Returns the
+    annual (summary) dataframe of calculate
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates()
+
+    os.makedirs(scenarioDir, exist_ok=True)
+    energy, power = readProfile(profile, sheet)
+    np.save(os.path.join(scenarioDir, f'{name}_profile.npy'),
+            np.array([energy, power]))
+
+    longdf, summarydf = calculate((energy, power), rate_selection,
+                                  charge_days, rates=rates,
+                                  applicable=applicable, progress=progress,
+                                  log=log)
+
+    writeScenario(name, {'rateSelection': rate_selection,
+                         'chargeDays': charge_days,
+                         'applicable': applicable}, summarydf, rates)
+    log(f'scenario {name} saved with {len(summarydf)} rates')
+    return summarydf
+
+# ------------------------------------------------------------------------------
+
+def updateScenarios(names=None, rates=None, progress=None, log=None):
+    '''
+    brings saved scenarios up to date with the current cache. For each
+    scenario, only the rates whose fingerprint changed since the scenario
+    was saved, and rates that are new to its rate selection, are
+    recalculated. Rates no longer in the selection (or the cache) are
+    removed. The scenario results are then saved again.
+
+    names: scenarios to update, all saved scenarios by default
+    progress: optional callback called with (scenarios done, total)
+
+    returns two dataframes:
+        deltadf - one row per added, removed or changed rate of each
+                  scenario with its old and new annual cost
+        summarydf - the number of rates of each scenario by change and the
+                    change of the total annual cost of the changed rates
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates()
+
+    scenarios = readScenarios()
+    names = list(scenarios) if names is None else names
+    missing = [i for i in names if i not in scenarios]
+    if missing:
+        raise ValueError(f'unknown scenarios: {", ".join(missing)}')
+
+    fingerprints = rates['cache']['fingerprints']
+    deltas, summaries = [], []
+    for n, name in enumerate(names):
+        scenario = scenarios[name]
+        stored = pd.read_parquet(os.path.join(scenarioDir,
+                                              f'{name}.parquet'))
+        stored = stored.set_index('id')
+        energy, power = np.load(os.path.join(scenarioDir,
+                                             f'{name}_profile.npy'))
+
+        ids = selectRates(rates, scenario['rateSelection'])
+        if scenario['applicable']:
+            ids = applicableIds(rates, ids, power)
+
+        kept = stored.index.intersection(ids)
+        changes = {'added': [i for i in ids if i not in stored.index],
+                   'removed': stored.index.difference(ids).tolist(),
+                   'changed': [i for i in kept
+                               if fingerprints[i] != stored.at[i,
+                                                               'fingerprint']]}
+        log(f'scenario {name}: ' + ', '.join(f'{len(v)} {k}'
+                                            for k, v in changes.items()))
+
+        recalculate = changes['added'] + changes['changed']
+        if recalculate:
+            longdf, newdf = calculate((energy, power), recalculate,
+                                      scenario['chargeDays'], rates=rates)
+            newdf = newdf.set_index('id')
+        else:
+            newdf = stored.iloc[:0]
+
+        delta = pd.DataFrame(
+            [(i, k) for k, v in changes.items() for i in v],
+            columns=['id', 'change'])
+        delta['oldCost'] = delta['id'].map(stored['totalCost'])
+        delta['newCost'] = delta['id'].map(newdf['totalCost']).astype(float)
+        delta['costChange'] = (delta['newCost'].fillna(0)
+                               - delta['oldCost'].fillna(0))
+        deltas.append(delta.assign(scenario=name))
+
+        summaries.append({'scenario': name, 'rates': len(ids),
+                          'unchanged': len(kept) - len(changes['changed']),
+                          **{k: len(v) for k, v in changes.items()},
+                          'costChange': delta['costChange'].sum()})
+
+        # unchanged results are kept, recalculated rates replace or add rows
+        unchanged = stored.loc[kept].drop(index=changes['changed'])
+        updated = pd.concat([unchanged[scenarioColumns[1:]],
+                             newdf[scenarioColumns[1:]]])
+        writeScenario(name, scenario, updated.reindex(ids).reset_index(),
+                      rates)
+
+        if progress is not None:
+            progress(n + 1, len(names))
+
+    deltadf = pd.concat(deltas, ignore_index=True)
+    deltadf = deltadf[['scenario'] + [c for c in deltadf.columns
+                                      if c != 'scenario']]
+    deltadf = deltadf.join(rates['info'][['rateName', 'utilityName']],
+                           on='id')
+    return deltadf, pd.DataFrame(summaries)
+
+# ------------------------------------------------------------------------------
+
+def snapshotChanges(cache):
+    '''
+    returns a dataframe of the rates added, removed and changed by the last
+    cache refresh (see inputFunctions.snapshotDiff) with their names, empty
+    if there is no previous snapshot
+    '''
+    previous = imp.loadFingerprints(imp.previousFingerprintFile)
+    if previous is None:
+        return pd.DataFrame(columns=['id', 'change'])
+
+    diff = imp.snapshotDiff(previous['rates'], cache['fingerprints'])
+    df = pd.DataFrame([(i, k) for k, v in diff.items() for i in v],
+                      columns=['id', 'change'])
+    # removed rates are no longer in the rate information table
+    return df.join(cache['info'].set_index('id')[['rateName', 'utilityName']],
+                   on='id')
+
+########################## RESULTS STORE FUNCTIONS #############################
+
+def runManifest():
+    '''
+    returns the runs in the results store with their inputs (see
+    outputFunctions.closeResultsRun) as a dataframe, one row per run
+    '''
+    if not os.path.exists(out.storeManifest):
+        return pd.DataFrame(columns=['runId', 'scenario', 'created', 'rows'])
+    return pd.read_json(out.storeManifest, lines=True, dtype={'runId': str,
+                                                              'scenario': str})
+
+# ------------------------------------------------------------------------------
+
+def queryResults(runs=None, scenario=None, sector=None, ids=None,
+                 months=None, columns=None, where=None):
+    '''
+    returns a slice of the monthly results in the results store. Each
+    argument is a value or list of values to keep (all if None):
+
+    runs: run ids, e.g. from a filtered runManifest()
+    scenario, sector: scenario names and rate sectors (partitions, only
+                      their folders are read)
+    ids, months: rate ids and months (1-12)
+    columns: columns to return, all by default
+    where: an optional extra pyarrow.dataset expression, e.g.
+           ds.field('totalCost') > 1000
+
+    filters are pushed down to the parquet files, so only the matching
+    partitions and row groups are read. Only runs in the manifest are
+    returned
+    '''
+    # series, arrays, tuples and sets of values are used as lists
+    values = lambda x: (list(x) if isinstance(x, (pd.Series, np.ndarray,
+                                                 tuple, set))
+                        else listCriteria(x))
+
+    manifest = runManifest()
+    committed = manifest['runId'].tolist()
+    if runs is not None:
+        committed = [i for i in values(runs) if i in set(committed)]
+    if not committed or not os.path.exists(out.storeDir):
+        return pd.DataFrame(columns=columns)
+
+    dataset = ds.dataset(out.storeDir, format='parquet',
+                         partitioning=out.storePartitioning)
+
+    expression = ds.field('runId').isin(committed)
+    for name, value in [('scenario', scenario), ('sector', sector),
+                        ('id', ids), ('month', months)]:
+        if value is not None:
+            expression &= ds.field(name).isin(values(value))
+    if where is not None:
+        expression &= where
+
+    return dataset.to_table(filter=expression, columns=columns).to_pandas()
+
+############################ FLEET FUNCTIONS ###################################
+
+# fleet manifest columns and their defaults. Columns that hold lists separate
+# values with ';'
+manifestColumns = {'siteId': 'required',
+                   'profileFile': 'required',
+                   'sheet': 'Single',
+                   'chargeDays': 7,
+                   'eiaId': '',
+                   'utility': '',
+                   'sector': ''}
+
+# ------------------------------------------------------------------------------
+
+def splitList(value, type=str):
+    '''
+    helper function that splits a ';' separated manifest value into a list
+    '''
+    if str(value).strip() == '':
+        return []
+    return [type(i.strip()) for i in str(value).split(';')]
+
+# ------------------------------------------------------------------------------
+
+def wholeNumber(value):
+    '''
+    helper function that reads a manifest number (e.g. '5' or '5.0') as an int
+    '''
+    return int(float(value))
+
+# ------------------------------------------------------------------------------
+
+def readManifest(manifest):
+    '''
+    reads a fleet manifest (csv or xlsx) into a list of sites. Each row of the
+    manifest is a site with the columns in manifestColumns. profileFile paths
+    are relative to the manifest directory. Sites are matched to the rates of
+    their eiaId and utility lists, optionally limited to a list of sectors.
+    raises ValueError if the manifest is invalid
+    '''
+    if os.path.splitext(manifest)[1].lower() == '.xlsx':
+        df = pd.read_excel(manifest, dtype=str)
+    else:
+        df = pd.read_csv(manifest, dtype=str)
+
+    missing = [k for k, v in manifestColumns.items()
+               if v == 'required' and k not in df.columns]
+    if missing:
+        raise ValueError(f'manifest is missing columns: {", ".join(missing)}')
+
+    required = [k for k, v in manifestColumns.items() if v == 'required']
+    if df[required].isna().any(axis=None):
+        raise ValueError('manifest has empty siteId or profileFile values')
+
+    defaults = {k: v for k, v in manifestColumns.items() if k not in required}
+    df = df.assign(**{k: v for k, v in defaults.items()
+                      if k not in df.columns}).fillna(defaults)
+    folder = os.path.dirname(manifest)
+
+    try:
+        sites = [{'siteId': i['siteId'],
+                  'profile': os.path.join(folder, i['profileFile']),
+                  'sheet': i['sheet'],
+                  'chargeDays': wholeNumber(i['chargeDays']),
+                  'eiaId': splitList(i['eiaId'], wholeNumber),
+                  'utility': splitList(i['utility']),
+                  'sector': splitList(i['sector'])}
+                 for i in df.to_dict('records')]
+    except ValueError as e:
+        raise ValueError(f'invalid manifest value ({e})')
+
+    if len({i['siteId'] for i in sites}) != len(sites):
+        raise ValueError('manifest siteId values must be unique')
+    if any(i['chargeDays'] < 1 or i['chargeDays'] > 7 for i in sites):
+        raise ValueError('manifest chargeDays must be between 1 and 7')
+
+    return sites
+
+# ------------------------------------------------------------------------------
+
+def siteRates(rates, site, candidates):
+    '''
+    returns the ids of a site's candidate rates: the rates of the site's
+    eiaIds and utilities (from the rate indexes built by loadRates) that are
+    in the candidates set and in the site's sectors (if any are given)
+    '''
+    ids = set()
+    for i in site['eiaId']:
+        ids.update(rates['eiaIndex'].get(i, []))
+    for i in site['utility']:
+        ids.update(rates['utilityIndex'].get(i, []))
+
+    ids &= candidates
+    if site['sector']:
+        ids = {i for i in ids
+               if rates['info'].at[i, 'sector'] in site['sector']}
+
+    return sorted(ids)
+
+# ------------------------------------------------------------------------------
+
+def calculateFleet(manifest, rate_selection='All Filtered Rates', rates=None,
+                   progress=None, log=None):
+    '''
+    calculates the cost of each site of a fleet under the rates of the site's
+    utilities.
+
+    manifest: path to a fleet manifest or a list of sites (see readManifest)
+    rate_selection: rates that sites may be matched to (see selectRates)
+    rates, log: as for calculate
+    progress: optional callback called with (sites done, total sites)
+
+    sites that share the same candidate rates are calculated together in one
+    batchCalc pass. returns the monthly (long) and annual (summary)
+    dataframes of calculate with a siteId column. Sites without candidate
+    rates are left out and logged
+    '''
+    log = log or (lambda message: None)
+
+    if rates is None:
+        log('loading rate cache')
+        rates = loadRates()
+
+    sites = readManifest(manifest) if isinstance(manifest, str) else manifest
+    candidates = set(selectRates(rates, rate_selection))
+
+    # group sites that share the same candidate rates
+    groups = {}
+    for site in sites:
+        ids = siteRates(rates, site, candidates)
+        if not ids:
+            log(f'site {site["siteId"]} has no candidate rates')
+            continue
+        groups.setdefault(tuple(ids), []).append(site)
+
+    if not groups:
+        raise ValueError('no site in the manifest has candidate rates')
+    log(f'{len(sites)} sites in {len(groups)} rate groups')
+
+    longdfs, summarydfs = [], []
+    done = 0
+    for ids, group in groups.items():
+        profiles = [readProfile(i['profile'], i['sheet']) for i in group]
+        days = [calc.daysMonth(i['chargeDays']) for i in group]
+        index = ratePositions(rates, ids)
+
+        costs = calc.batchCalc(rates['batch'],
+                               [i[0] for i in profiles],
+                               [i[1] for i in profiles],
+                               days, index)
+
+        for p, site in enumerate(group):
+            total_energy = calc.nrgUse(profiles[p][0], days[p])
+            longdf, summarydf = buildOutput(
+                rates, list(ids), [rates['batch']['ids'][i] for i in index],
+                costs, p, total_energy)
+            longdfs.append(longdf.assign(siteId=site['siteId']))
+            summarydfs.append(summarydf.assign(siteId=site['siteId']))
+
+        done += len(group)
+        if progress is not None:
+            progress(done, sum(len(i) for i in groups.values()))
+
+    # siteId as the first column
+    longdf, summarydf = [pd.concat(i, ignore_index=True)
+                         for i in [longdfs, summarydfs]]
+    longdf, summarydf = [i[['siteId'] + [c for c in i.columns
+                                         if c != 'siteId']]
+                         for i in [longdf, summarydf]]
+
+    return longdf, summarydf
@@ -11,14 +11,17 @@ Built by Atlas Public Policy in Washington, DC
 '''
 
 # external dependencies
-from alive_progress import alive_it
+from alive_progress import alive_it, alive_bar
 import numpy as np
 import logging
+import hashlib
+import time
 
 # internal dependencies
 import lib.inputFunctions as imp
 import lib.outputFunctions as out
 import lib.interfaceFunctions as itf
+import lib.apiFunctions as api
 
 
 #################### Preparation Functions #####################################
@@ -157,17 +160,15 @@ def flatDemandCalc(rate, mx, maxPower):
     control flow is based on whether or not there is a tiered rate structure 
     in the rate input
 
-    rate: flat demand rate structure
-    mx: max values for each tier
+    rate: flat demand rate structure (12 x n array)
+    mx: max values for each tier (12 x n array, None if untiered)
     maxPower: max power for each month
     """
-    # if max is false (empty) then there is a flat rate and the function 
+    # if max is None (empty) then there is a flat rate and the function 
     # calculates that 
-    if mx == False:
-        # flatten rate[0] to remove nested lists
-        xsublist = [x for y in rate for x in y]
-        # return maxPower * rate for each month
-        return (np.multiply(maxPower, xsublist)
+    if mx is None:
+        # return maxPower * rate for each month (single tier)
+        return (np.multiply(maxPower, rate[:, 0])
                 .tolist())
     
     # if rate[1][0] (max vals) is not empty, then there is a tiered rate and the
@@ -200,21 +201,794 @@ def demandTOUCalc(rate, power):
              for n in range(12)]
 
 
+##################### Batch Calculation Functions #############################
+
+# the batch calculator evaluates many rates against many profiles at once with
+# array operations. It gives the same results as coreCalc and is used where
+# rates are calculated in bulk (see stackRates and batchCalc)
+
+# charge components calculated for each rate (same keys as the coreCalc output)
+components = ['TieredEnergyCharge', 'TOUEnergyCharge',
+              'FlatDemandCharge', 'TOUDemandCharge']
+
+# rough number of array cells the batch calculator works on at once. Rates are
+# calculated in chunks to keep intermediate arrays within this size
+batchCells = 2 ** 24
+
+# -----------------------------------------------------------------------------
+
+def padTiers(tiers, nTiers, fill):
+    '''
+    helper function that pads a 12 x n tier array to 12 x nTiers using fill
+    '''
+    out = np.full((12, nTiers), fill)
+    out[:, :tiers.shape[1]] = tiers
+    return out
+
+# -----------------------------------------------------------------------------
+
+def stackTiers(tierRates, tierMax):
+    '''
+    stacks lists of compiled 12 x n tier rates and maximums (None where a rate
+    has no tiers) into N x 12 x T arrays. Rates without tiers get a single
+    zero-cost tier so they cost nothing. Untiered maximums (None) have no limit
+    '''
+    nTiers = max([1] + [i.shape[1] for i in tierRates if i is not None])
+    rates = np.zeros((len(tierRates), 12, nTiers))
+    maxes = np.full((len(tierRates), 12, nTiers), np.inf)
+
+    for n, (r, m) in enumerate(zip(tierRates, tierMax)):
+        if r is not None:
+            rates[n] = padTiers(r, nTiers, 0.0)
+        if m is not None:
+            maxes[n] = padTiers(m, nTiers, np.inf)
+
+    return rates, maxes
+
+# -----------------------------------------------------------------------------
+
+def stackRates(rates):
+    '''
+    stacks a dictionary of supported CompiledRates into the arrays used by
+    batchCalc. Returns a dictionary of:
+        ids - list of N rate ids
+        nrgTierRates, nrgTierMax - N x 12 x T tiered energy rates
+        nrgTOU - N x 2 x 12 x 24 TOU energy prices (weekday, weekend)
+        demandFlatRates, demandFlatMax - N x 12 x T flat demand rates
+        demandIds - N x 12 x 24 weekday TOU demand period of each hour
+        demandPrices - N x G TOU demand price of each period
+
+    components a rate does not have are zero-cost. Missing TOU energy prices
+    (NaN) are zero, as in nrgTOUCalc. Only the weekday TOU demand schedule is
+    used, as in demandTOUCalc, and its periods are renumbered so that each
+    price in the schedule is one period
+    '''
+    rates = list(rates.values())
+    n = len(rates)
+
+    batch = {'ids': [i.id for i in rates]}
+
+    batch['nrgTierRates'], batch['nrgTierMax'] = stackTiers(
+        [i.nrgTierRates for i in rates], [i.nrgTierMax for i in rates])
+
+    batch['demandFlatRates'], batch['demandFlatMax'] = stackTiers(
+        [i.demandFlatRates for i in rates], [i.demandFlatMax for i in rates])
+
+    batch['nrgTOU'] = np.zeros((n, 2, 12, 24))
+    demandIds = []
+    demandPrices = []
+
+    for x, rate in enumerate(rates):
+        if rate.nrgPrices is not None:
+            batch['nrgTOU'][x] = np.nan_to_num([rate.nrgTOUWkdRates,
+                                                rate.nrgTOUWkeRates], nan=0.0)
+        if rate.demandPrices is not None:
+            periods, ids = np.unique(rate.demandWkdSched, return_inverse=True)
+            demandIds.append(ids.reshape(12, 24))
+            demandPrices.append(rate.demandPrices[periods])
+        else:
+            demandIds.append(np.full((12, 24), -1))
+            demandPrices.append(np.zeros(0))
+
+    nPeriods = max([1] + [len(i) for i in demandPrices])
+    batch['demandIds'] = np.array(demandIds, dtype=np.int16).reshape(n, 12, 24)
+    batch['demandPrices'] = np.zeros((n, nPeriods))
+    for x, prices in enumerate(demandPrices):
+        batch['demandPrices'][x, :len(prices)] = prices
+
+    return batch
+
+# -----------------------------------------------------------------------------
+
+def priceBatch(prices, rows=None):
+    '''
+    returns the stacked rates used by batchCalc (as made by stackRates) from
+    the precompiled price matrices in the cache (see writePriceMatrices).
+    rows are the positions of the rates to take, all rates if None. Only
+    those rows are read from the memory mapped matrices
+    '''
+    take = np.asarray if rows is None else (lambda x: x[np.asarray(rows,
+                                                                   dtype=int)])
+
+    batch = {i: np.array(take(prices[i])) for i in
+             ['nrgTierRates', 'nrgTierMax', 'demandFlatRates',
+              'demandFlatMax', 'demandIds', 'demandPrices']}
+    batch['ids'] = take(prices['ids']).tolist()
+
+    # tiered rates have no TOU energy prices (see writePriceMatrices)
+    batch['nrgTOU'] = np.where(take(prices['nrgTiered'])[:, None, None, None],
+                               0.0, take(prices['marginal']))
+
+    return batch
+
+# -----------------------------------------------------------------------------
+
+def batchProfiles(energy, power, days):
+    '''
+    prepares energy and power profiles and days per month for batchCalc.
+    energy and power are 12 x 24 (one profile) or P x 12 x 24 arrays and days
+    is a daysMonth output (2 x 12) or P x 2 x 12. Returns P x 12 x 24 energy
+    and power, P x 2 x 12 days, P x 12 monthly energy use and P x 12 max power
+    (the same values as nrgUse and getMaxPower)
+    '''
+    energy = np.asarray(energy, dtype=np.float64).reshape(-1, 12, 24)
+    power = np.asarray(power, dtype=np.float64).reshape(-1, 12, 24)
+    days = np.asarray(days, dtype=np.float64).reshape(-1, 2, 12)
+
+    nProfiles = max(len(energy), len(power), len(days))
+    energy, power, days = [np.broadcast_to(x, (nProfiles,) + x.shape[1:])
+                           for x in [energy, power, days]]
+
+    total_energy = energy.sum(axis=2) * np.nansum(days, axis=1)
+    maxPower = np.repeat(power.max(axis=(1, 2))[:, None], 12, axis=1)
+
+    return energy, power, days, total_energy, maxPower
+
+# -----------------------------------------------------------------------------
+
+def tierKernel(unit, tierRates, tierMax):
+    '''
+    array version of tierCalc for many rates and profiles at once.
+
+    unit: P x 12 energy or power use
+    tierRates, tierMax: N x 12 x T stacked tiers (see stackTiers)
+
+    output: P x N x 12 cost
+
+    follows tierCalc exactly: full tier bands are charged for each tier below
+    the use, the rest of the use is charged in the first tier that contains it
+    and tiers after that are ignored
+    '''
+    return tierCost(unit[:, None, :, None], tierRates, tierMax)
+
+# -----------------------------------------------------------------------------
+
+def tierCost(unit, tierRates, tierMax):
+    '''
+    tier calculation of tierKernel for use already shaped to broadcast against
+    the ... x 12 x T tiers (with a trailing tier axis of 1). returns the cost
+    summed over tiers
+    '''
+    lower = np.concatenate([np.zeros_like(tierMax[..., :1]),
+                            tierMax[..., :-1]], axis=-1)
+
+    with np.errstate(invalid='ignore'):
+        inTier = (unit > lower) & (unit <= tierMax)
+        over = unit > tierMax
+        # tiers up to and including the first tier that contains the use
+        active = (np.cumsum(inTier, axis=-1) - inTier) == 0
+
+        band = np.where(active & over, tierMax - lower, 0)
+        remaining = unit - (np.cumsum(band, axis=-1) - band)
+
+        cost = (np.where(active & inTier, remaining * tierRates, 0)
+                + np.where(active & over, band * tierRates, 0))
+
+    return cost.sum(axis=-1)
+
+# -----------------------------------------------------------------------------
+
+def demandTOUKernel(power, demandIds, demandPrices):
+    '''
+    array version of demandTOUCalc for many rates and profiles at once.
+
+    power: P x 12 x 24 hourly power
+    demandIds, demandPrices: N x 12 x 24 and N x G stacked TOU demand
+
+    output: P x N x 12 demand charges (max power in each period times the
+    period price, summed over periods)
+    '''
+    cost = np.zeros((len(power), len(demandIds), power.shape[1]))
+
+    for g in range(demandPrices.shape[1]):
+        inPeriod = demandIds == g
+        # skip periods that no rate in the batch has
+        if not inPeriod.any():
+            continue
+        peak = np.where(inPeriod[None], power[:, None], -np.inf).max(axis=-1)
+        with np.errstate(invalid='ignore'):
+            cost += np.where(np.isfinite(peak),
+                             peak * demandPrices[None, :, g, None], 0)
+
+    return cost
+
+# -----------------------------------------------------------------------------
+
+def demandTOUPeriods(power, demandIds, demandPrices):
+    '''
+    per period version of demandTOUKernel used for cost attribution.
+
+    returns P x N x 12 x G arrays of the peak power, the hour of the peak and
+    the demand charge of each TOU demand period in each month. Periods a rate
+    does not have in a month have a NaN peak and no charge
+    '''
+    shape = (len(power), len(demandIds), 12, demandPrices.shape[1])
+    peaks = np.full(shape, np.nan)
+    hours = np.zeros(shape, dtype=np.int8)
+
+    for g in range(shape[-1]):
+        inPeriod = demandIds == g
+        if not inPeriod.any():
+            continue
+        masked = np.where(inPeriod[None], power[:, None], -np.inf)
+        hours[..., g] = masked.argmax(axis=-1)
+        peak = masked.max(axis=-1)
+        peaks[..., g] = np.where(np.isfinite(peak), peak, np.nan)
+
+    cost = np.nan_to_num(peaks * demandPrices[None, :, None, :])
+    return peaks, hours, cost
+
+# -----------------------------------------------------------------------------
+
+# rows of hourly cost attribution output produced per chunk of rates (see
+# batchCalc)
+attributionRows = 2 ** 20
+
+# -----------------------------------------------------------------------------
+
+def batchCalc(batch, energy, power, days, index=None, progress=None,
+              attribution=None):
+    '''
+    batch version of coreCalc. Calculates every charge component for a set of
+    stacked rates (see stackRates) against one or more profiles.
+
+    batch: stacked rates from stackRates
+    energy, power, days: profiles and days per month (see batchProfiles)
+    index: optional positions of the rates in batch to calculate
+    progress: optional callback called with (rates done, total rates) after
+              each chunk of rates
+    attribution: optional callback for hourly cost attribution. The TOU
+                 charges are then calculated by hour and TOU demand period
+                 and the callback is called for each chunk of rates with
+                 (rate ids, P x n x 2 x 12 x 24 TOU energy cost by day type
+                 and hour, the P x n x 12 x G peak power, peak hour and
+                 cost of each TOU demand period, see demandTOUPeriods, and
+                 the n x G price of each period)
+
+    returns a dictionary of P x N x 12 arrays keyed by component name where P
+    is the number of profiles and N the number of rates calculated
+    '''
+    energy, power, days, total_energy, maxPower = batchProfiles(energy, power,
+                                                                days)
+    if index is None:
+        index = np.arange(len(batch['ids']))
+    index = np.asarray(index)
+
+    nProfiles = len(energy)
+    output = {i: np.zeros((nProfiles, len(index), 12)) for i in components}
+
+    # calculate rates in chunks to limit the size of intermediate arrays
+    cellsPerRate = nProfiles * 12 * max(24, batch['nrgTierMax'].shape[-1],
+                                        batch['demandFlatMax'].shape[-1])
+    chunkSize = max(1, batchCells // cellsPerRate)
+    if attribution is not None:
+        chunkSize = min(chunkSize,
+                        max(1, attributionRows // (nProfiles * 2 * 12 * 24)))
+
+    for start in range(0, len(index), chunkSize):
+        chunk = index[start:start + chunkSize]
+        part = slice(start, start + len(chunk))
+
+        output['TieredEnergyCharge'][:, part] = tierKernel(
+            total_energy, batch['nrgTierRates'][chunk],
+            batch['nrgTierMax'][chunk])
+
+        output['FlatDemandCharge'][:, part] = tierKernel(
+            maxPower, batch['demandFlatRates'][chunk],
+            batch['demandFlatMax'][chunk])
+
+        if attribution is None:
+            # daily cost by day type, times days of each type in the month
+            daily = np.einsum('pmh,ndmh->pndm', energy,
+                              batch['nrgTOU'][chunk])
+            output['TOUEnergyCharge'][:, part] = np.einsum('pndm,pdm->pnm',
+                                                           daily, days)
+
+            output['TOUDemandCharge'][:, part] = demandTOUKernel(
+                power, batch['demandIds'][chunk],
+                batch['demandPrices'][chunk])
+
+        else:
+            # the same charges kept by hour and period, then summed
+            hourly = np.einsum('pmh,ndmh,pdm->pndmh', energy,
+                               batch['nrgTOU'][chunk], days)
+            output['TOUEnergyCharge'][:, part] = hourly.sum(axis=(2, 4))
+
+            peaks, hours, periodCost = demandTOUPeriods(
+                power, batch['demandIds'][chunk],
+                batch['demandPrices'][chunk])
+            output['TOUDemandCharge'][:, part] = periodCost.sum(axis=-1)
+
+            attribution([batch['ids'][i] for i in chunk], hourly, peaks,
+                        hours, periodCost, batch['demandPrices'][chunk])
+
+        if progress is not None:
+            progress(start + len(chunk), len(index))
+
+    return output
+
+
+# -----------------------------------------------------------------------------
+
+def projectCalc(batch, energy, power, days, loads, energyFactors,
+                demandFactors, index=None, progress=None):
+    '''
+    multi-year version of batchCalc for one profile. Each year y scales the
+    profile by loads[y], energy prices by energyFactors[y] and demand prices
+    by demandFactors[y].
+
+    TOU energy and TOU demand charges are linear in the load, so they are
+    calculated once and scaled for each year. Tiered energy and flat demand
+    charges are not, so the tier kernel is run with the scaled use of every
+    year at once (years take the place of profiles).
+
+    returns a dictionary of Y x N arrays of annual cost keyed by component
+    name where Y is the number of years and N the number of rates calculated
+    '''
+    energy, power, days, total_energy, maxPower = batchProfiles(energy, power,
+                                                                days)
+    loads = np.asarray(loads, dtype=np.float64)[:, None]
+    energyFactors = np.asarray(energyFactors, dtype=np.float64)[:, None]
+    demandFactors = np.asarray(demandFactors, dtype=np.float64)[:, None]
+
+    if index is None:
+        index = np.arange(len(batch['ids']))
+    index = np.asarray(index)
+
+    nYears = len(loads)
+    output = {i: np.zeros((nYears, len(index))) for i in components}
+
+    # calculate rates in chunks to limit the size of intermediate arrays
+    cellsPerRate = nYears * 12 * max(24, batch['nrgTierMax'].shape[-1],
+                                     batch['demandFlatMax'].shape[-1])
+    chunkSize = max(1, batchCells // cellsPerRate)
+
+    for start in range(0, len(index), chunkSize):
+        chunk = index[start:start + chunkSize]
+        part = slice(start, start + len(chunk))
+
+        output['TieredEnergyCharge'][:, part] = energyFactors * tierKernel(
+            loads * total_energy, batch['nrgTierRates'][chunk],
+            batch['nrgTierMax'][chunk]).sum(axis=2)
+
+        daily = np.einsum('pmh,ndmh->pndm', energy, batch['nrgTOU'][chunk])
+        output['TOUEnergyCharge'][:, part] = (
+            energyFactors * loads
+            * np.einsum('pndm,pdm->pn', daily, days))
+
+        output['FlatDemandCharge'][:, part] = demandFactors * tierKernel(
+            loads * maxPower, batch['demandFlatRates'][chunk],
+            batch['demandFlatMax'][chunk]).sum(axis=2)
+
+        output['TOUDemandCharge'][:, part] = (
+            demandFactors * loads
+            * demandTOUKernel(power, batch['demandIds'][chunk],
+                              batch['demandPrices'][chunk]).sum(axis=2))
+
+        if progress is not None:
+            progress(start + len(chunk), len(index))
+
+    return output
+
+# -----------------------------------------------------------------------------
+
+# peak caps tried by shiftCalc in hours with demand charges, as multiples of
+# the even charging level of the window (np.inf leaves only the charger limit)
+shiftLevels = [1, 1.5, 2, 3, np.inf]
+
+# -----------------------------------------------------------------------------
+
+def windowHours(plugIn, departure):
+    '''
+    returns the hours of a charging window from the plug-in hour up to (not
+    including) the departure hour. Windows wrap past midnight (e.g. 18 to 7)
+    and a window with the same plug-in and departure hour is the whole day
+    '''
+    return (plugIn + np.arange((departure - plugIn) % 24 or 24)) % 24
+
+# -----------------------------------------------------------------------------
+
+def rateKernel(batch, chunk, energy, power, days):
+    '''
+    calculates each rate in chunk against its own profile (the diagonal of
+    batchCalc, used when every rate has a different profile).
+
+    energy, power: n x 12 x 24 profiles, one for each rate in chunk
+    days: 2 x 12 days per month (see daysMonth)
+
+    returns a dictionary of n x 12 arrays keyed by component name
+    '''
+    total_energy = energy.sum(axis=2) * np.nansum(days, axis=0)
+    maxPower = np.repeat(power.max(axis=(1, 2))[:, None], 12, axis=1)
+    output = {}
+
+    output['TieredEnergyCharge'] = tierCost(
+        total_energy[..., None], batch['nrgTierRates'][chunk],
+        batch['nrgTierMax'][chunk])
+
+    output['TOUEnergyCharge'] = np.einsum('nmh,ndmh,dm->nm', energy,
+                                          batch['nrgTOU'][chunk], days)
+
+    output['FlatDemandCharge'] = tierCost(
+        maxPower[..., None], batch['demandFlatRates'][chunk],
+        batch['demandFlatMax'][chunk])
+
+    demandIds = batch['demandIds'][chunk]
+    demandPrices = batch['demandPrices'][chunk]
+    output['TOUDemandCharge'] = np.zeros((len(chunk), 12))
+    for g in range(demandPrices.shape[1]):
+        peak = np.where(demandIds == g, power, -np.inf).max(axis=-1)
+        with np.errstate(invalid='ignore'):
+            output['TOUDemandCharge'] += np.where(
+                np.isfinite(peak), peak * demandPrices[:, g, None], 0)
+
+    return output
+
+# -----------------------------------------------------------------------------
+
+def shiftFill(daily, order, caps):
+    '''
+    greedy fill of a charging window. daily (12) energy is put into the hours
+    of the window in the given order (n x 12 x W, cheapest first), each hour
+    taking up to its cap (n x 12 x W kWh). returns the n x 12 x W energy of
+    each window hour
+    '''
+    capSorted = np.take_along_axis(caps, order, axis=-1)
+    before = np.cumsum(capSorted, axis=-1) - capSorted
+    fillSorted = np.clip(daily[None, :, None] - before, 0, capSorted)
+
+    fill = np.empty_like(fillSorted)
+    np.put_along_axis(fill, order, fillSorted, axis=-1)
+    return fill
+
+# -----------------------------------------------------------------------------
+
+def shiftCalc(batch, energy, power, days, window, maxPower, peakCap=None,
+              index=None, progress=None):
+    '''
+    managed charging version of batchCalc for one profile. The daily energy
+    of each month is moved into the cheapest hours of a charging window for
+    every rate at once, and each rate is calculated with its own shifted
+    profile.
+
+    window: (plug-in hour, departure hour) of the charging window (see
+            windowHours). All of the daily energy is taken to be flexible
+    maxPower: charger power (kW). An hour of the window takes at most
+              maxPower kWh and shifted profiles charge at a constant power
+              within each hour (power = energy)
+    peakCap: optional site limit (kW) applied to every hour
+
+    hours are filled in order of their day weighted energy price, then TOU
+    demand price, then their order in the window. Filling cheap hours at the
+    charger limit can raise demand charges, so hours with a TOU demand price
+    (or every hour of months with a flat demand charge) are capped at each
+    multiple of shiftLevels of the even charging level of the window. The
+    cheapest of those schedules is kept for each rate
+
+    returns three dictionaries / arrays:
+        managed - N x 12 arrays of cost with the shifted profiles keyed by
+                  component name
+        unmanaged - N x 12 arrays of cost with the original profile
+        peaks - N peak power (kW) of the shifted profile of each rate
+    raises ValueError if the daily energy cannot be delivered in the window
+    '''
+    energy, power, days, _, _ = batchProfiles(energy, power, days)
+    energy, power, days = energy[0], power[0], days[0]
+
+    if index is None:
+        index = np.arange(len(batch['ids']))
+    index = np.asarray(index)
+
+    hours = windowHours(*window)
+    daily = energy.sum(axis=1)
+    limit = maxPower if peakCap is None else min(maxPower, peakCap)
+    level = daily / len(hours)
+    if (level > limit * (1 + 1e-9)).any():
+        raise ValueError(f'a {len(hours)} hour window at {limit:g} kW cannot '
+                         f'deliver the daily energy (up to {daily.max():g} '
+                         'kWh)')
+
+    unmanaged = {k: v[0] for k, v in batchCalc(batch, energy, power, days,
+                                                index).items()}
+    managed = {i: np.zeros((len(index), 12)) for i in components}
+    peaks = np.zeros(len(index))
+
+    # calculate rates in chunks to limit the size of intermediate arrays
+    cellsPerRate = 12 * max(24, batch['nrgTierMax'].shape[-1],
+                            batch['demandFlatMax'].shape[-1]) * 4
+    chunkSize = max(1, batchCells // cellsPerRate)
+
+    for start in range(0, len(index), chunkSize):
+        chunk = index[start:start + chunkSize]
+        part = slice(start, start + len(chunk))
+
+        # day weighted energy price and TOU demand price of the window hours
+        price = np.einsum('ndmh,dm->nmh', batch['nrgTOU'][chunk],
+                          days)[..., hours]
+        demandIds = batch['demandIds'][chunk][..., hours]
+        demand = np.take_along_axis(batch['demandPrices'][chunk],
+                                    demandIds.clip(0).reshape(len(chunk), -1),
+                                    axis=1).reshape(demandIds.shape)
+        demand = np.where(demandIds >= 0, demand, 0)
+
+        flat = (np.nan_to_num(batch['demandFlatRates'][chunk]) != 0).any(-1)
+        charged = (demand > 0) | flat[..., None]
+
+        position = np.broadcast_to(np.arange(len(hours)), price.shape)
+        order = np.lexsort((position, demand, price), axis=-1)
+
+        best = None
+        for f in shiftLevels:
+            cap = limit if np.isinf(f) else np.minimum(limit, f * level)
+            caps = np.where(charged, np.reshape(cap, (-1, 1)), limit)
+            profile = np.zeros((len(chunk), 12, 24))
+            profile[..., hours] = shiftFill(daily, order, caps)
+
+            cost = rateKernel(batch, chunk, profile, profile, days)
+            total = sum(cost.values()).sum(axis=1)
+
+            keep = np.ones(len(chunk), bool) if best is None else total < best
+            best = np.where(keep, total, best)
+            for c in components:
+                managed[c][part][keep] = cost[c][keep]
+            peaks[part][keep] = profile.max(axis=(1, 2))[keep]
+
+        if progress is not None:
+            progress(start + len(chunk), len(index))
+
+    return managed, unmanaged, peaks
+
+# -----------------------------------------------------------------------------
+
+def capCalc(batch, energy, power, days, caps, index=None, progress=None):
+    '''
+    demand cap sweep version of batchCalc for one profile. The power profile
+    is clipped at each of the caps (kW), as a site power limit or battery
+    would, while the energy profile is left unchanged.
+
+    energy charges do not depend on the cap, so they are calculated once.
+    Demand charges are calculated for all caps x rates in one pass with the
+    clipped profiles taking the place of profiles in the kernels.
+
+    returns a dictionary of C x N x 12 arrays keyed by component name where
+    C is the number of caps and N the number of rates calculated. The energy
+    components are the same for every cap (a read only broadcast view)
+    '''
+    energy, power, days, total_energy, _ = batchProfiles(energy, power, days)
+    caps = np.asarray(caps, dtype=np.float64)
+
+    clipped = np.minimum(power, caps[:, None, None])
+    maxPower = np.repeat(clipped.max(axis=(1, 2))[:, None], 12, axis=1)
+
+    if index is None:
+        index = np.arange(len(batch['ids']))
+    index = np.asarray(index)
+
+    output = {i: np.zeros((len(caps), len(index), 12))
+              for i in ['FlatDemandCharge', 'TOUDemandCharge']}
+    energyOutput = {i: np.zeros((1, len(index), 12))
+                    for i in ['TieredEnergyCharge', 'TOUEnergyCharge']}
+
+    # calculate rates in chunks to limit the size of intermediate arrays
+    cellsPerRate = len(caps) * 12 * max(24, batch['nrgTierMax'].shape[-1],
+                                        batch['demandFlatMax'].shape[-1])
+    chunkSize = max(1, batchCells // cellsPerRate)
+
+    for start in range(0, len(index), chunkSize):
+        chunk = index[start:start + chunkSize]
+        part = slice(start, start + len(chunk))
+
+        energyOutput['TieredEnergyCharge'][:, part] = tierKernel(
+            total_energy, batch['nrgTierRates'][chunk],
+            batch['nrgTierMax'][chunk])
+
+        daily = np.einsum('pmh,ndmh->pndm', energy, batch['nrgTOU'][chunk])
+        energyOutput['TOUEnergyCharge'][:, part] = np.einsum(
+            'pndm,pdm->pnm', daily, days)
+
+        output['FlatDemandCharge'][:, part] = tierKernel(
+            maxPower, batch['demandFlatRates'][chunk],
+            batch['demandFlatMax'][chunk])
+
+        output['TOUDemandCharge'][:, part] = demandTOUKernel(
+            clipped, batch['demandIds'][chunk], batch['demandPrices'][chunk])
+
+        if progress is not None:
+            progress(start + len(chunk), len(index))
+
+    for k, v in energyOutput.items():
+        output[k] = np.broadcast_to(v, (len(caps),) + v.shape[1:])
+
+    return {i: output[i] for i in components}
+
+# -----------------------------------------------------------------------------
+
+def monthCalc(batch, energy, power, days, months, index=None, progress=None):
+    '''
+    batchCalc of some months only, used to recalculate the months of a
+    profile that were edited (see apiFunctions.recalculate). Each charge
+    component of a month only depends on that month, except flat demand
+    charges, which use the peak of the whole year (so power is still taken
+    for all 12 months).
+
+    months: positions (0-11) of the months to calculate
+
+    returns a dictionary of P x N x M arrays keyed by component name where M
+    is the number of months
+    '''
+    energy, power, days, total_energy, maxPower = batchProfiles(energy, power,
+                                                                days)
+    months = np.asarray(months, dtype=int)
+    energy, power = energy[:, months], power[:, months]
+    days = days[:, :, months]
+    total_energy, maxPower = total_energy[:, months], maxPower[:, months]
+
+    if index is None:
+        index = np.arange(len(batch['ids']))
+    index = np.asarray(index)
+
+    # only the prices of the months are taken from the batch
+    sub = {'nrgTOU': batch['nrgTOU'][np.ix_(index, [0, 1], months)],
+           'demandPrices': batch['demandPrices'][index]}
+    for i in ['nrgTierRates', 'nrgTierMax', 'demandFlatRates',
+              'demandFlatMax', 'demandIds']:
+        sub[i] = batch[i][np.ix_(index, months)]
+
+    nProfiles = len(energy)
+    output = {i: np.zeros((nProfiles, len(index), len(months)))
+              for i in components}
+
+    # calculate rates in chunks to limit the size of intermediate arrays
+    cellsPerRate = nProfiles * len(months) * max(
+        24, batch['nrgTierMax'].shape[-1], batch['demandFlatMax'].shape[-1])
+    chunkSize = max(1, batchCells // max(1, cellsPerRate))
+
+    for start in range(0, len(index), chunkSize):
+        part = slice(start, start + chunkSize)
+
+        output['TieredEnergyCharge'][:, part] = tierKernel(
+            total_energy, sub['nrgTierRates'][part], sub['nrgTierMax'][part])
+
+        output['FlatDemandCharge'][:, part] = tierKernel(
+            maxPower, sub['demandFlatRates'][part], sub['demandFlatMax'][part])
+
+        daily = np.einsum('pmh,ndmh->pndm', energy, sub['nrgTOU'][part])
+        output['TOUEnergyCharge'][:, part] = np.einsum('pndm,pdm->pnm',
+                                                       daily, days)
+
+        output['TOUDemandCharge'][:, part] = demandTOUKernel(
+            power, sub['demandIds'][part], sub['demandPrices'][part])
+
+        if progress is not None:
+            progress(min(start + chunkSize, len(index)), len(index))
+
+    return output
+
+
+###################### Profiling Functions ####################################
+
+def countPeriods(prices):
+    '''
+    helper function that counts the distinct prices in a compiled TOU
+    schedule. returns 0 if the schedule is missing
+    '''
+    if prices is None:
+        return 0
+    return len(prices)
+
+def countTiers(tierMax):
+    '''
+    helper function that returns the largest number of tiers used in any month
+    of a compiled tier structure (only the last tier of a month has no upper
+    limit). returns 0 if there are no tiers
+    '''
+    if tierMax is None:
+        return 0
+    return int(np.isfinite(tierMax).sum(axis=1).max()) + 1
+
+# -----------------------------------------------------------------------------
+
+def rateComplexity(rate):
+    '''
+    returns a dictionary describing the structure of a processed rate: how many
+    energy and demand periods it has, the most tiers it uses in any month and
+    which charge components are present. Used by the profiling mode of calcRun
+    to explain why some rates take longer to evaluate than others.
+    '''
+
+    # components present in the rate (unsupported rates have no components)
+    components = {'TieredEnergy': rate.nrgTierRates,
+                  'TOUEnergy': rate.nrgPrices,
+                  'FlatDemand': rate.demandFlatRates,
+                  'TOUDemand': rate.demandPrices}
+
+    if rate.demandFlatRates is not None and rate.demandFlatMax is None:
+        demandFlatTiers = 1
+    else:
+        demandFlatTiers = countTiers(rate.demandFlatMax)
+
+    return {
+        'components': ', '.join(k for k, v in components.items()
+                                if v is not None),
+        'nrgPeriods': countPeriods(rate.nrgPrices),
+        'demandPeriods': countPeriods(rate.demandPrices),
+        'nrgTiers': countTiers(rate.nrgTierMax),
+        'demandFlatTiers': demandFlatTiers}
+
+# -----------------------------------------------------------------------------
+
+def profileCalc(rates, energy, power, days, maxPower, total_energy):
+    '''
+    profiling version of the coreCalc loop in calcRun. Each rate is timed
+    individually and its structural complexity is recorded alongside the
+    evaluation time. Returns the usual output dictionary and a dictionary of
+    profile records keyed by rate id.
+
+    only supported rates are passed in (see calcRun)
+    '''
+
+    output = {}
+    profile = {}
+
+    iter = alive_it(rates.items(), title='Processing rates (profiling)')
+    for k, v in iter:
+        start = time.perf_counter()
+        output[k] = coreCalc(v, energy, power, days, maxPower, total_energy)
+        elapsed = time.perf_counter() - start
+
+        profile[k] = {'evalTimeMs': elapsed * 1000}
+        profile[k].update(rateComplexity(v))
+
+    return output, profile
+
+
 ###################### Run Calcuation Functions ###############################
 
+# runs with more rates than streamChunk are calculated and written in chunks
+# of this many rates (see calcRun)
+streamChunk = 2000
+
 def calcSetup(inputfile, filter, days, curveType):
     '''
     This function is used to setup the calculation. It is called by the calc
-    function. It returns the rates, energy, power, days, maxPower, and
-    total_energy variables that are used in the coreCalc function.
+    function. It returns the ids of the selected rates, the energy, power,
+    days, maxPower, and total_energy variables that are used in the coreCalc
+    function and the loaded cache (its info table is used to add rate details
+    to the output). Rates are not loaded from the cache here, see calcRun.
     '''
 
     # assemble data for calculation--------------------------------------------
-    # first get the rates from cache or URDB
-    rates, filters = imp.checkCache()
-
-    # then filter the rates
-    rates = imp.filterRates(filter, rates, filters)
+    # first get the rates from cache or URDB (usually already loaded in the
+    # background or by an earlier run, see sessionCache)
+    cache = imp.sessionCache()
+
+    # then filter the rates (with the rate filter file if there is one)
+    try:
+        filtered = imp.filteredRates(cache)
+    except ValueError as e:
+        logging.error(e)
+        itf.exitOrMain(f'Error: {e}')
+    rates = imp.filterIds(filter, filtered, cache['rates'])
 
     # then get user inputs (this function may return an error that will return
     # user to the main menu)
@@ -230,7 +1004,7 @@ def calcSetup(inputfile, filter, days, curveType):
     # then get max and min power
     maxPower = getMaxPower(power)
 
-    return rates, energy, power, days, maxPower, total_energy
+    return rates, cache, energy, power, days, maxPower, total_energy
     
 # ---------------------------------------------------------------------------- #
 
@@ -247,47 +1021,40 @@ def coreCalc(rate, energy, power, days,
     output = {}
     empty = [0 for i in range(12)]
     
-    # if rate is not valid return unsupported
-    if imp.validRates(rate) is False:
-        return 'unsupported'
-
-    # if anything in rate = 'unsupported' then return unsupported
-    if 'unsupported' in rate.values():
-        return 'unsupported'
-    
-    # if schedule is not valid return unsupported
-    if 'schedule invalid' in rate.values():
+    # rate support (sentinel values, invalid schedules and out of sequence
+    # tiers) is decided when the rate is compiled into the cache
+    if rate.status is not imp.RateStatus.SUPPORTED:
         return 'unsupported'
     
     #----------------------------------------
 
     # energy charges
-    if rate['nrgTierRates'] is not False:
+    if rate.nrgTierRates is not None:
             output['TieredEnergyCharge'] = nrgTierCalc(total_energy,
-                                                 rate['nrgTierRates'],
-                                                 rate['nrgTierMax'])
+                                                 rate.nrgTierRates,
+                                                 rate.nrgTierMax)
     else:
         output['TieredEnergyCharge'] = empty
 
-    if rate['nrgTOUWkdRates'] is not False:
+    if rate.nrgPrices is not None:
         output['TOUEnergyCharge'] = nrgTOUCalc(energy,
-                                               rate['nrgTOUWkdRates'],
-                                               rate['nrgTOUWkeRates'],
+                                               rate.nrgTOUWkdRates,
+                                               rate.nrgTOUWkeRates,
                                                days)
     else:
         output['TOUEnergyCharge'] = empty
 
     # demand charges
     
-    if rate['demandFlatRates'] is not False:
-        output['FlatDemandCharge'] = flatDemandCalc(rate['demandFlatRates'],
-                                                    rate['demandFlatMax'],
+    if rate.demandFlatRates is not None:
+        output['FlatDemandCharge'] = flatDemandCalc(rate.demandFlatRates,
+                                                    rate.demandFlatMax,
                                                     maxPower)       
     else:
         output['FlatDemandCharge'] = empty
 
-    if rate['demandTOUwkdRates'] is not False:
-            output['TOUDemandCharge'] = demandTOUCalc(rate['demandTOUwkdRates'],
+    if rate.demandPrices is not None:
+            output['TOUDemandCharge'] = demandTOUCalc(rate.demandTOUwkdRates,
                                                       power)
     else:
         output['TOUDemandCharge'] = empty
@@ -297,40 +1064,195 @@ def coreCalc(rate, energy, power, days,
 
 # --------------------------------------------------
 
-def calcRun(inputfile, filter, days, curveType, filename):
+def asOfLabel(asOf):
+    '''
+    helper function that describes an as-of date or date range for messages
+    '''
+    if isinstance(asOf, (list, tuple)):
+        return f'between {asOf[0]} and {asOf[1]}'
+    return f'on {asOf}'
+
+# --------------------------------------------------
+
+def monthsKey(inputfile, curveType):
+    '''
+    helper function that names the saved monthly results of an input file
+    and load curve (see apiFunctions.readMonths)
+    '''
+    name = inputfile.replace('\\', '/').split('/')[-1].rsplit('.', 1)[0]
+    path = hashlib.sha256(f'{inputfile}|{curveType}'.encode()).hexdigest()
+    return f'{name}_{curveType}_{path[:8]}'
+
+# --------------------------------------------------
+
+def calcRun(inputfile, filter, days, curveType, filename, profile=False,
+            applicable=False, attribution=False, asOf=None, store=True):
     '''
     This function is the primary control function for the calculation.
-    it calls the calcSetup and coreCalc functions from this module and 
-    then the output processing functions from the outputFunctions module.
+    it calls the calcSetup function from this module, calculates the rates
+    with the library API (see apiFunctions.calculate) and writes the results.
+
+    if profile is True each rate is calculated and timed with coreCalc and a
+    ranked report of slow rates is saved next to the results
+    (<filename>_profile.xlsx)
+
+    if applicable is True, rates whose demand range (demandMin to demandMax)
+    does not contain the profile's peak demand are dropped before calculating
+
+    runs of more than streamChunk rates are streamed: rates are calculated,
+    summarized and written to the output file one chunk at a time
+
+    if attribution is True the hourly TOU energy cost and TOU demand cost of
+    each period are also saved for every rate, in
+    results/<filename>_attribution_energy.parquet and
+    results/<filename>_attribution_demand.parquet (not with profiling)
+
+    if asOf is given (a date or a (start, end) pair of dates) only rates in
+    effect on that date or during that range are calculated (see
+    inputFunctions.effectiveRates)
+
+    if store is True the monthly results are also added to the results store
+    under the output file name, with the run inputs (see
+    outputFunctions.openResultsRun)
+
+    the monthly results of each run are kept for its input file and curve.
+    When the input is run again only the months whose energy or power
+    changed are recalculated, for rates that did not change since (see
+    apiFunctions.recalculate). Attribution and profiling runs calculate
+    every month
     '''
 
     # define setup variables    
-    (rates, energy, power, days,
+    chargeDays = days
+    (rates, cache, energy, power, days,
     maxPower, total_energy) = calcSetup(inputfile, filter, days, curveType)
+    rateInfo = cache['info']
+    attribution = f'results/{filename}_attribution' if attribution else None
+
+    # drop rates that do not apply to the profile's peak demand
+    if applicable:
+        keep = imp.applicableRates(cache['demand'], maxPower[0])
+        print(f'{len(keep.intersection(rates))} of {len(rates)} rates apply '
+              f'to a peak demand of {maxPower[0]:.1f} kW')
+        rates = [k for k in rates if k in keep]
+
+    # drop rates that were not in effect on the as-of date
+    if asOf is not None:
+        keep = imp.effectiveRates(cache['dates'], asOf)
+        print(f'{len(keep.intersection(rates))} of {len(rates)} rates were in '
+              f'effect {asOfLabel(asOf)}')
+        rates = [k for k in rates if k in keep]
+
+    # split off unsupported rates (decided when the cache was built and read
+    # from the rate information table) so that only supported rates are
+    # calculated
+    supported = imp.supportedIds(rateInfo, rates)
+    print(f'{len(supported)} of {len(rates)} rates are supported')
 
     # run the calculator function    
+    # results store run, recorded in the store manifest once the run is done
+    run = out.openResultsRun(filename, {
+        'inputFile': inputfile, 'curve': curveType,
+        'profileHash': hashlib.sha256(np.asarray([energy, power])
+                                      .tobytes()).hexdigest()[:16],
+        'filter': filter, 'chargeDays': chargeDays, 'applicable': applicable,
+        'asOf': asOf, 'rates': len(rates), 'cache': imp.cacheVersion()})
+
+    # monthly results of the last run of this input. Profiling runs time
+    # every rate and month and do not save their months, so they skip this
+    key = monthsKey(inputfile, curveType)
+    previous = None if attribution or profile else api.readMonths(key)
+    if previous is not None:
+        changed = api.changedMonths(previous, energy, power)
+        print(f'{len(changed)} of 12 months changed since this input was last '
+              'run, only those months are recalculated')
+
     (print ('\ndoing the math...'))
-    # run coreCalc function in a dictionary comprehension
-    iter = alive_it(rates.items(), title='Processing rates')
-    output = {k : coreCalc(v, energy, power, days, maxPower, total_energy) for k, v in iter}
-    output = {k : out.processOutput(v, total_energy) for k, v in output.items()}
-
-    process = [out.toDataFrame,
-               out.addRateInfo,
-               out.createSummaries]
-    
-    print ('\nAssemblying output...')
-    iter = alive_it(process, title='Processing output')
-    
-    for i in iter: 
-        output = i(output, rates)
-    
-    # unpack output
-    longdf, summarydf = output
-    
-    # write output to excel
-    out.write2ExcelTables(filename, [summarydf, longdf],
-                         ['Annual Summary', 'Monthly Summary'])
+    # profiling runs coreCalc for each rate so that each rate can be timed
+    if profile:
+        output, timings = profileCalc(imp.getRates(cache['rates'], supported),
+                                      energy, power, days, maxPower,
+                                      total_energy)
+        output = {k : out.processOutput(v, total_energy) for k, v in output.items()}
+
+        # unsupported rates all share the same empty (NaN) output
+        unsupported = out.processOutput('unsupported', total_energy)
+        output = {k: output.get(k, unsupported) for k in rates}
+
+        process = [out.toDataFrame,
+                   out.addRateInfo,
+                   out.createSummaries]
+
+        print ('\nAssemblying output...')
+        iter = alive_it(process, title='Processing output')
+
+        for i in iter: 
+            output = i(output, rateInfo)
+
+        # unpack output
+        longdf, summarydf = output
+        if store:
+            out.appendResults(run, longdf, rateInfo)
+
+        # write output to excel
+        out.write2ExcelTables(filename, [summarydf, longdf],
+                             ['Annual Summary', 'Monthly Summary'])
+
+    # large runs are calculated and written in chunks of streamChunk rates so
+    # that memory use is set by the chunk size rather than the number of rates
+    elif len(rates) > streamChunk:
+        print(f'\nWriting results to results/{filename}.xlsx as rates are '
+              'calculated...')
+        stream = out.openExcelStream(filename, ['Annual Summary',
+                                                'Monthly Summary'])
+
+        parts = []
+        with alive_bar(manual=True, title='Processing rates') as bar:
+            for longdf, summarydf, months in api.recalculateChunks(
+                    (energy, power), previous, rates, chargeDays,
+                    rates=api.loadRates(cache, stack=False),
+                    chunk_size=streamChunk,
+                    progress=lambda done, total: bar(done / total),
+                    log=logging.info, attribution=attribution):
+                out.appendExcelRows(stream, 'Annual Summary', summarydf)
+                out.appendExcelRows(stream, 'Monthly Summary', longdf)
+                if store:
+                    out.appendResults(run, longdf, rateInfo)
+                parts.append(months)
+
+        out.closeExcelStream(stream)
+        if parts:
+            api.writeMonths(key, api.joinMonths(parts))
+
+    else:
+        with alive_bar(manual=True, title='Processing rates') as bar:
+            longdf, summarydf, months = api.recalculate(
+                (energy, power), previous, rates, chargeDays,
+                rates=api.loadRates(cache),
+                progress=lambda done, total: bar(done / total),
+                log=logging.info, attribution=attribution)
+        api.writeMonths(key, months)
+        if store:
+            out.appendResults(run, longdf, rateInfo)
+
+        # write output to excel
+        out.write2ExcelTables(filename, [summarydf, longdf],
+                             ['Annual Summary', 'Monthly Summary'])
+
+    if store:
+        out.closeResultsRun(run)
+        print(f'results added to the results store as run {run["runId"]}\n')
+
+    if attribution and not profile:
+        print(f'hourly cost attribution saved in {attribution}_energy.parquet '
+              f'and {attribution}_demand.parquet\n')
+
+    # write the rate profile report next to the results
+    if profile:
+        profiledf = out.createProfileReport(timings, rateInfo)
+        out.write2ExcelTables(f'{filename}_profile', [profiledf],
+                              ['Rate Profile'])
+        logging.info(f'{profiledf["outlier"].sum()} slow rate outliers found')
     
     # wrap up
 
@@ -339,3 +1261,202 @@ def calcRun(inputfile, filter, days, curveType, filename):
     itf.exitOrMain('Rate calculation complete...')
 
     
+
+# --------------------------------------------------
+
+def fleetRun(manifest, filter, filename):
+    '''
+    control function for fleet (multi-site) runs. Calculates each site of a
+    fleet manifest against the rates of its utilities (see
+    apiFunctions.calculateFleet) and writes the results with a siteId column
+    '''
+    cache = imp.sessionCache()
+
+    print('\ndoing the math...')
+    try:
+        with alive_bar(manual=True, title='Processing sites') as bar:
+            longdf, summarydf = api.calculateFleet(
+                manifest, filter, rates=api.loadRates(cache),
+                progress=lambda done, total: bar(done / total),
+                log=logging.info)
+
+    except (ValueError, KeyError, FileNotFoundError) as e:
+        print(f'Error: could not run the fleet manifest ({e})')
+        logging.error(f'fleet run failed: {e}')
+        return
+
+    print(f'{summarydf["siteId"].nunique()} sites calculated')
+    out.write2ExcelTables(filename, [summarydf, longdf],
+                          ['Annual Summary', 'Monthly Summary'])
+
+    itf.askOpenFile(filename)
+    logging.info('Fleet calculation completed without error')
+
+# ---------------------------------------------------------------------------- #
+
+def uncertaintyRun(inputfile, filter, days, curveType, filename, draws,
+                   distribution, energySpread, powerSpread):
+    '''
+    control function for load uncertainty (Monte Carlo) runs. Draws perturbed
+    versions of the input profile and calculates them all against the
+    selected rates (see apiFunctions.simulate). Writes the annual cost of the
+    input profile and the P10, P50 and P90 annual cost and cost per kWh of
+    each rate
+    '''
+    cache = imp.sessionCache()
+    energy, power = imp.parseUserInputs(inputfile, curveType)
+
+    print(f'\ncalculating {draws} load draws...')
+    with alive_bar(manual=True, title='Processing rates') as bar:
+        percentiledf = api.simulate(
+            (energy, power), filter, days, draws=draws,
+            energy_spread=energySpread, power_spread=powerSpread,
+            distribution=distribution, rates=api.loadRates(cache),
+            progress=lambda done, total: bar(done / total),
+            log=logging.info)
+
+    out.write2ExcelTables(filename, [percentiledf], ['Cost Percentiles'])
+
+    itf.askOpenFile(filename)
+    logging.info('Uncertainty calculation completed without error')
+
+# ---------------------------------------------------------------------------- #
+
+def projectionRun(inputfile, filter, days, curveType, filename, years,
+                  energyEscalation, demandEscalation, loadGrowth,
+                  discountRate):
+    '''
+    control function for multi-year projections. Projects the annual cost of
+    the input profile under each selected rate with price escalation and load
+    growth (see apiFunctions.project) and writes the net present value of
+    each rate and its annual costs by year
+    '''
+    cache = imp.sessionCache()
+    energy, power = imp.parseUserInputs(inputfile, curveType)
+
+    print(f'\nprojecting costs over {years} years...')
+    with alive_bar(manual=True, title='Processing rates') as bar:
+        yeardf, summarydf = api.project(
+            (energy, power), filter, days, years=years,
+            energy_escalation=energyEscalation,
+            demand_escalation=demandEscalation, load_growth=loadGrowth,
+            discount_rate=discountRate, rates=api.loadRates(cache),
+            progress=lambda done, total: bar(done / total),
+            log=logging.info)
+
+    out.write2ExcelTables(filename, [summarydf, yeardf],
+                          ['NPV Summary', 'Annual Projection'])
+
+    itf.askOpenFile(filename)
+    logging.info('Projection completed without error')
+
+# -----------------------------------------------------------------------------
+
+def managedRun(inputfile, filter, days, curveType, filename, plugIn,
+               departure, maxPower, peakCap):
+    '''
+    control function for managed charging runs. Shifts the charging of the
+    input profile into the cheapest hours of the charging window for each
+    selected rate (see apiFunctions.optimize) and writes the managed and
+    unmanaged cost of each rate. maxPower None uses the peak power of the
+    input profile as the charger power
+    '''
+    cache = imp.sessionCache()
+    energy, power = imp.parseUserInputs(inputfile, curveType)
+
+    print(f'\noptimizing charging between {plugIn}:00 and {departure}:00...')
+    try:
+        with alive_bar(manual=True, title='Processing rates') as bar:
+            df = api.optimize(
+                (energy, power), filter, days, plug_in=plugIn,
+                departure=departure, max_kw=maxPower, peak_cap=peakCap,
+                rates=api.loadRates(cache),
+                progress=lambda done, total: bar(done / total),
+                log=logging.info)
+
+    except ValueError as e:
+        print(f'Error: could not optimize charging ({e})')
+        logging.error(f'managed charging run failed: {e}')
+        return
+
+    out.write2ExcelTables(filename, [df], ['Managed Charging'])
+
+    itf.askOpenFile(filename)
+    logging.info('Managed charging run completed without error')
+
+# -----------------------------------------------------------------------------
+
+def capSweepRun(inputfile, filter, days, curveType, filename, capShares):
+    '''
+    control function for demand cap sweeps. Caps the power of the input
+    profile at each share of its peak power in capShares (see
+    apiFunctions.capSweep) and writes the savings of each rate by cap
+    '''
+    cache = imp.sessionCache()
+    energy, power = imp.parseUserInputs(inputfile, curveType)
+    caps = np.round(np.max(power) * np.asarray(capShares), 1)
+
+    print(f'\ncalculating {len(caps)} demand caps...')
+    with alive_bar(manual=True, title='Processing rates') as bar:
+        curvedf, summarydf = api.capSweep(
+            (energy, power), caps, filter, days, rates=api.loadRates(cache),
+            progress=lambda done, total: bar(done / total),
+            log=logging.info)
+
+    out.write2ExcelTables(filename, [summarydf, curvedf],
+                          ['Savings Summary', 'Savings Curves'])
+
+    itf.askOpenFile(filename)
+    logging.info('Demand cap sweep completed without error')
+
+# -----------------------------------------------------------------------------
+
+def scenarioSaveRun(inputfile, filter, days, curveType, name):
+    '''
+    control function for saving a scenario. Calculates the input profile
+    under the selected rates and saves the inputs and results so they can be
+    updated after the cache is refreshed (see apiFunctions.saveScenario)
+    '''
+    cache = imp.sessionCache()
+    energy, power = imp.parseUserInputs(inputfile, curveType)
+
+    print(f'\ncalculating scenario {name}...')
+    with alive_bar(manual=True, title='Processing rates') as bar:
+        summarydf = api.saveScenario(
+            name, (energy, power), filter, days, rates=api.loadRates(cache),
+            progress=lambda done, total: bar(done / total),
+            log=logging.info)
+
+    print(f'scenario {name} saved with {len(summarydf)} rates')
+    logging.info('Scenario saved without error')
+
+# -----------------------------------------------------------------------------
+
+def scenarioDeltaRun(filename):
+    '''
+    control function for scenario delta reports. Recalculates only the rates
+    of each saved scenario that changed since it was saved (see
+    apiFunctions.updateScenarios) and writes the cost changes with the rates
+    changed by the last cache refresh
+    '''
+    cache = imp.sessionCache()
+
+    if not api.readScenarios():
+        print('Error: no saved scenarios found')
+        logging.error('scenario delta report failed: no saved scenarios')
+        return
+
+    print('\nupdating saved scenarios...')
+    with alive_bar(manual=True, title='Processing scenarios') as bar:
+        deltadf, summarydf = api.updateScenarios(
+            rates=api.loadRates(cache),
+            progress=lambda done, total: bar(done / total),
+            log=logging.info)
+
+    out.write2ExcelTables(filename, [summarydf, deltadf,
+                                     api.snapshotChanges(cache)],
+                          ['Scenario Summary', 'Cost Changes',
+                           'Rate Changes'])
+
+    itf.askOpenFile(filename)
+    logging.info('Scenario delta report completed without error')
@@ -8,6 +8,8 @@ functions are split into:
     - rate filtering functions
     - rate processing functions
     - cache building functions
+    - session cache functions
+    - sqlite cache functions
     - validation functions
 
 Built by Atlas Public Policy in Washington, DC
@@ -17,17 +19,35 @@ Built by Atlas Public Policy in Washington, DC
 # external dependencies
 from alive_progress import alive_it
 import pandas as pd
+import numpy as np
 from pick import pick
+import openpyxl
+import collections.abc
+import enum
+import hashlib
 import time
 import urllib.request
 import gzip
 import json
 import pickle
+import re
+import shutil
+import sqlite3
+import contextlib
+import threading
+import gc
 import os
 import logging
 
+# file locking is platform specific
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
 # internal dependencies
 import lib.interfaceFunctions as itf
+import lib.calculatorFunctions as calc
 
 ####################### USER INPUT AND VALIDATION ##############################
 
@@ -45,7 +65,7 @@ def getUserFile(inputfile, sheet):
     for i in range(5):
         if check == 'Exit':
             print('User terminated session. Exiting calculator...')
-            itf.exitOrMain()
+            itf.exitOrMain('input file selection cancelled...')
         
         try:
             # read the user input file
@@ -64,31 +84,224 @@ def getUserFile(inputfile, sheet):
                        'close the file and try again.')
             check, i = pick(['Try Again', 'Exit'], message, indicator='>> ')
 
+        except (ValueError, KeyError) as e:
+            print('Error: could not parse user input file. Please ensure the '
+                  f'file is correctly formatted and try again. ({e})')
+            input('press any key to return to main menu')
+            raise itf.ReturnToMenu
+
         except Exception as e:
             print('Error: ', e)
             input('press any key to exit')
-            itf.exitOrMain()
+            itf.exitOrMain('could not read the input file...')
             
     input('number of tries exceeded...press any key')
-    itf.exitOrMain()
+    itf.exitOrMain('number of tries exceeded...')
+
+# ---------------------------------------------------------------------------- #
+
+# known input cell ranges of the Single and Monthly sheets of the input
+# workbook as (first row, last row, first column, last column), 1-indexed as in
+# excel. Rows are hours and columns are months
+workbookRanges = {
+    'Single': {'energy': (2, 25, 2, 2),
+               'power': (2, 25, 3, 3)},
+    'Monthly': {'energy': (3, 26, 2, 13),
+                'power': (30, 53, 2, 13)}}
+
+# profile file types that can be used in place of an input workbook
+profileTypes = ['.csv', '.parquet', '.npy']
+
+# parsed profiles keyed by (file hash, sheet), see readFile
+profileCache = {}
+
+# parsed profiles are also saved as npy files in profileDir so they are reused
+# in later sessions. Increase profileSchema when the parsing of input files
+# changes so that older parsed profiles are not used
+profileDir = 'cached_data/profiles'
+profileSchema = 1
+
+# ---------------------------------------------------------------------------- #
+
+def fileHash(inputfile):
+    '''
+    returns the sha256 hash of a file's contents
+    '''
+    h = hashlib.sha256()
+    with open(inputfile, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+# ---------------------------------------------------------------------------- #
+
+def monthlyProfile(profile):
+    '''
+    helper function that repeats a single 24 hour energy and power profile
+    (2 x 24) for each month. Monthly profiles (2 x 12 x 24) are returned as is
+    '''
+    if profile.shape == (2, 24):
+        profile = np.repeat(profile[:, None, :], 12, axis=1)
+    if profile.shape != (2, 12, 24):
+        raise ValueError('expected a 24 hour or 12 month x 24 hour profile, '
+                         f'got an array of shape {profile.shape}')
+    return profile
+
+# ---------------------------------------------------------------------------- #
+
+def readWorkbook(inputfile, sheet):
+    '''
+    read the energy and power inputs of the Single or Monthly sheet of an input
+    workbook. Only the known input cell ranges are read (see workbookRanges)
+    and the workbook is opened in read-only mode. Empty cells are read as NaN.
+    returns a 2 x 12 x 24 array of energy and power
+    '''
+    wb = openpyxl.load_workbook(inputfile, read_only=True, data_only=True)
+    try:
+        ws = wb[sheet]
+        profile = []
+        for i in ['energy', 'power']:
+            minRow, maxRow, minCol, maxCol = workbookRanges[sheet][i]
+            cells = ws.iter_rows(min_row=minRow, max_row=maxRow,
+                                 min_col=minCol, max_col=maxCol,
+                                 values_only=True)
+            values = [[np.nan if x is None else x for x in row]
+                      for row in cells]
+            # hours x months to months x hours
+            profile.append(np.array(values, dtype=np.float64).T)
+    finally:
+        wb.close()
+
+    # single sheet inputs are 1 x 24 and are repeated for each month
+    return monthlyProfile(np.array(profile).squeeze(axis=1)
+                          if sheet == 'Single' else np.array(profile))
+
+# ---------------------------------------------------------------------------- #
+
+def readProfileFile(inputfile):
+    '''
+    read a load profile from a csv, parquet or npy file and return a
+    2 x 12 x 24 array of energy and power.
+     * csv and parquet files have 'hour' (0-23), 'energy' and 'power' columns
+       and either 24 rows (single profile) or 288 rows with a 'month' (1-12)
+       column (monthly profile)
+     * npy files hold an array of shape 2 x 24 or 2 x 12 x 24 with energy
+       first and power second
+    missing hours or months are read as NaN and caught by validation
+    '''
+    ext = os.path.splitext(inputfile)[1].lower()
+
+    if ext == '.npy':
+        return monthlyProfile(np.load(inputfile, allow_pickle=False)
+                              .astype(np.float64))
+
+    if ext == '.csv':
+        df = pd.read_csv(inputfile)
+    elif ext == '.parquet':
+        df = pd.read_parquet(inputfile)
+    else:
+        raise ValueError(f'unsupported input file type: {ext}')
+
+    df.columns = df.columns.str.strip().str.lower()
+
+    if 'month' in df.columns:
+        profile = [df.pivot(index='month', columns='hour', values=i)
+                     .reindex(index=range(1, 13), columns=range(24))
+                     .to_numpy(dtype=np.float64)
+                   for i in ['energy', 'power']]
+    else:
+        profile = [df.set_index('hour')[i]
+                     .reindex(range(24))
+                     .to_numpy(dtype=np.float64)
+                   for i in ['energy', 'power']]
+
+    return monthlyProfile(np.array(profile))
 
 # ---------------------------------------------------------------------------- #
 
 def readFile(inputfile, sheet):
     '''
-    read the user input file from the user_input folder. 
-    ignores first line if sheet is 'Monthly'
+    read the user input file from the user_input folder and return 12 x 24
+    arrays of energy and power. Input workbooks (xlsx) are read from the sheet
+    given by the sheet argument, profile files (csv, parquet, npy) ignore it.
+
+    parsed profiles are cached by file hash and sheet, in memory and on disk
+    (see profilePath), so an unchanged file is only parsed once
+    '''
+    if os.path.splitext(inputfile)[1].lower() in profileTypes:
+        sheet = None
+
+    key = (fileHash(inputfile), sheet)
+    if key not in profileCache:
+        profileCache[key] = loadProfile(key)
+
+    if profileCache[key] is None:
+        if sheet is None:
+            profileCache[key] = readProfileFile(inputfile)
+        else:
+            profileCache[key] = readWorkbook(inputfile, sheet)
+        saveProfile(key, profileCache[key])
+
+    energy, power = profileCache[key].copy()
+    return energy, power
+
+# ---------------------------------------------------------------------------- #
+
+def profilePath(key):
+    '''
+    returns the path of the saved parsed profile for a (file hash, sheet) key
     '''
+    filehash, sheet = key
+    return os.path.join(profileDir,
+                        f'{filehash}_{sheet or "file"}_v{profileSchema}.npy')
 
-    if sheet == 'Monthly':
-        userinputs = pd.read_excel(inputfile, 
-                               sheet_name = sheet, 
-                               header = 1)
-        
-    elif sheet == 'Single':
-        userinputs = pd.read_excel(inputfile, sheet_name=sheet)
-    
-    return userinputs 
+# ---------------------------------------------------------------------------- #
+
+def loadProfile(key):
+    '''
+    loads a saved parsed profile, returns None if there is none (or it cannot
+    be read)
+    '''
+    try:
+        profile = np.load(profilePath(key), allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+
+    return profile if profile.shape == (2, 12, 24) else None
+
+# ---------------------------------------------------------------------------- #
+
+def saveProfile(key, profile):
+    '''
+    saves a parsed profile for later sessions. The file is written to a
+    temporary file and moved into place so it is never read half written.
+    Failing to save is logged and does not stop the run
+    '''
+    path = profilePath(key)
+    try:
+        os.makedirs(profileDir, exist_ok=True)
+        with open(stagedFile(path), 'wb') as f:
+            np.save(f, profile, allow_pickle=False)
+        os.replace(stagedFile(path), path)
+    except OSError as e:
+        logging.warning(f'could not save parsed profile {path} ({e})')
+
+# ---------------------------------------------------------------------------- #
+
+def validateProfile(energy, power):
+    '''
+    checks that energy and power inputs have no empty (NaN) or negative values
+    and raises a ValueError describing the problem if they do. Both checks are
+    made with a single array comparison (NaN fails the >= 0 test)
+    '''
+    profile = np.stack([energy, power])
+
+    if not (profile >= 0).all():
+        if np.isnan(profile).any():
+            raise ValueError('input file contains empty cells')
+        raise ValueError('input file contains negative values')
+
+# ---------------------------------------------------------------------------- #
 
 def validateInput(energy, power):
     '''
@@ -97,23 +310,13 @@ def validateInput(energy, power):
     and return to the main menu.
     '''
 
-    # if there are any nan values in the input, raise an error
-    if (any([any([pd.isna(i) for i in j]) for j in energy]) 
-        or any([any([pd.isna(i) for i in j]) for j in power])):
-        print('Error: energy input file contains empty cells. Please '
-              'ensure all cells in rate_calculator_input_file are' 
-              'filled in and try again.')
-        input('press any key to return to main menu')
-        itf.mainMenu()
-    
-    # if there are any negative values in the input, raise an error
-    if (any([any([i < 0 for i in j]) for j in energy])
-        or any([any([i < 0 for i in j]) for j in power])):
-        print('Error: energy input file contains negative values. Please '
-              'ensure all cells in rate_calculator_input_file are' 
-              'positive and try again.')
+    try:
+        validateProfile(energy, power)
+    except ValueError as e:
+        print(f'Error: {e}. Please ensure all cells in the input file are '
+              'filled in with positive values and try again.')
         input('press any key to return to main menu')
-        itf.mainMenu()
+        raise itf.ReturnToMenu
 
     print('\nuser input file validated successfully')
 
@@ -121,40 +324,14 @@ def validateInput(energy, power):
 def parseUserInputs(inputfile, type):
     '''
     Parent function for parsing user inputs. Takes a type argument (monthly or 
-    single) and returns a list of energy and power values. If the user input
-    file is not found, the validation function will return an error and the
-    user will be returned to the main menu.
+    single) and returns 12 x 24 arrays of energy and power values. If the user
+    input file is not found, the validation function will return an error and
+    the user will be returned to the main menu.
     '''
     
     # get user input file from user_input folder, if it doesnt exist, warn user
-    user_input = getUserFile(inputfile, type)
-    
-    # parse user input file into energy and power lists
-    # single rate inputs are repeated for each month
-    try:
-        if type == 'Single':
-            energy = user_input['Average Energy (kWh)'].tolist()
-            energy = [energy for i in range(12)]
-            power = user_input['Peak Power (kW)'].tolist()
-            power = [power for i in range(12)]
-
-    # monthly rate inputs are parsed into lists
-        elif type == 'Monthly':
-            energy = user_input.iloc[0:24,1:13]
-            energy = energy.values.tolist()
-            power = user_input.iloc[27:52,1:13]
-            power = power.values.tolist()
-        # take 24 x 12 list and convert to 12 x 24 list
-            energy = [[energy[j][i] for j in range(len(energy))]
-                    for i in range(len(energy[0]))]
-            power = [[power[j][i] for j in range(len(power))]
-                    for i in range(len(power[0]))]
-    
-    except:
-        print('Error: could not parse user input file. Please ensure the '
-              'file is correctly formatted and try again.')
-        input('press any key to return to main menu')
-        itf.mainMenu()
+    # single inputs are repeated for each month
+    energy, power = getUserFile(inputfile, type)
 
     # validate the user input file (all fields have values). If the file is
     # invalid, inform user and return to the main menu.
@@ -164,67 +341,208 @@ def parseUserInputs(inputfile, type):
 
 ################### Rate Filtering Function ###################################
 
+# user filter file. When it exists it replaces the filtered rate set saved in
+# the cache and is applied each time a rate set is selected, so filters can
+# be changed without rebuilding the cache (see filteredRates)
+filterFile = 'user_input/rate_filter.json'
+
+# default filter, used for the filtered rate set saved in the cache. Keys
+# missing from a filter file take these values:
+#   current - drop rates that have ended (rates without an end date are kept)
+#   fields - rate information fields searched for keywords (rateName and / or
+#            description)
+#   includeKeywords, excludeKeywords - keep only rates with one of the
+#            include keywords (if any) and drop rates with any exclude
+#            keyword. Keywords are matched anywhere in a field, ignoring case
+#   includeSectors, excludeSectors, includeUtilities, excludeUtilities -
+#            keep only rates of the include sectors / utilities (if any) and
+#            drop rates of the exclude sectors / utilities
+defaultFilter = {'current': True,
+                 'fields': ['rateName'],
+                 'includeKeywords': [],
+                 'excludeKeywords': ['agriculture',
+                                     'water heat',
+                                     'space heat',
+                                     'space cool',
+                                     'unmetered',
+                                     'irrigation',
+                                     'pumping'],
+                 'includeSectors': [],
+                 'excludeSectors': ['Lighting'],
+                 'includeUtilities': [],
+                 'excludeUtilities': []}
+
+filterFields = ['rateName', 'description']
+
+# search text and filter matches of the loaded rate information table. Matches
+# are keyed by the hash of the filter file (see filteredRates)
+filterMemo = {}
+
+# ------------------------------------------------------------------------------
+def readFilter(path=filterFile):
+    '''
+    reads a filter file (json) and returns the filter, with defaults for
+    missing keys, and the hash of the file. Raises ValueError if the filter
+    is invalid
+    '''
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    try:
+        spec = json.loads(data)
+    except json.JSONDecodeError as e:
+        raise ValueError(f'invalid filter file {path} ({e})')
+
+    if not isinstance(spec, dict):
+        raise ValueError(f'filter file {path} must be a json object')
+    unknown = set(spec) - set(defaultFilter)
+    if unknown:
+        raise ValueError(f'unknown filter keys: {", ".join(sorted(unknown))}')
+
+    spec = {**defaultFilter, **spec}
+    for k, v in spec.items():
+        if k == 'current':
+            if not isinstance(v, bool):
+                raise ValueError('filter current must be true or false')
+        elif not (isinstance(v, list) and all(isinstance(i, str) for i in v)):
+            raise ValueError(f'filter {k} must be a list of strings')
+    if not set(spec['fields']) <= set(filterFields):
+        raise ValueError(f'filter fields must be in {filterFields}')
+
+    return spec, hashlib.sha256(data).hexdigest()
+
+# ------------------------------------------------------------------------------
+def compileFilter(spec):
+    '''
+    compiles the include and exclude keywords of a filter into one case
+    insensitive regular expression each (None if there are no keywords), so
+    every keyword is matched in a single pass over the rates
+    '''
+    compiled = dict(spec)
+    for k in ['includeKeywords', 'excludeKeywords']:
+        keywords = sorted(spec[k], key=len, reverse=True)
+        compiled[k] = (re.compile('|'.join(re.escape(i) for i in keywords),
+                                  re.IGNORECASE) if keywords else None)
+    return compiled
+
+# ------------------------------------------------------------------------------
+def filterText(rates, fields):
+    '''
+    joins the filter fields of a rate table into one search text per rate.
+    Missing values (False or NaN) are left out
+    '''
+    text = pd.Series('', index=rates.index)
+    for i in fields:
+        text += '\n' + rates[i].map(lambda x: x if isinstance(x, str) else '')
+    return text
+
+# ------------------------------------------------------------------------------
+def matchFilter(rates, compiled, text=None):
+    '''
+    applies a compiled filter (see compileFilter) to a rate table with the
+    rate information columns (rateName, description, sector, utilityName and
+    enddate). text is the search text of the filter fields if it has already
+    been built (see filterText). Returns a boolean array of the rates kept
+    '''
+    keep = np.ones(len(rates), dtype=bool)
+
+    if compiled['current']:
+        end = pd.to_datetime(rates['enddate'])
+        keep &= np.asarray((end >= pd.to_datetime('today')) | end.isnull())
+
+    for column, key in [('sector', 'Sectors'), ('utilityName', 'Utilities')]:
+        if compiled[f'include{key}']:
+            keep &= np.asarray(rates[column].isin(compiled[f'include{key}']))
+        if compiled[f'exclude{key}']:
+            keep &= ~np.asarray(rates[column].isin(compiled[f'exclude{key}']))
+
+    if text is None:
+        text = filterText(rates, compiled['fields'])
+    if compiled['includeKeywords'] is not None:
+        keep &= np.asarray(text.str.contains(compiled['includeKeywords']))
+    if compiled['excludeKeywords'] is not None:
+        keep &= ~np.asarray(text.str.contains(compiled['excludeKeywords']))
+
+    return keep
+
+# ------------------------------------------------------------------------------
+def filteredRates(cache, path=filterFile):
+    '''
+    returns the filtered rate set (a dataframe of rate labels and sectors, as
+    cache['filtered']) for rate selection. If the filter file exists it is
+    applied to the rate information table of the cache, otherwise the
+    filtered rate set saved in the cache is returned.
+
+    the search text of the rate information table is built once and the
+    matches of each filter file are kept by file hash, so trying a filter
+    again (or an unchanged filter on the next run) costs only reading the
+    file. Raises ValueError if the filter file is invalid
+    '''
+    if not os.path.exists(path):
+        return cache['filtered']
+
+    spec, key = readFilter(path)
+    info = cache['info']
+    if filterMemo.get('info') is not info:
+        filterMemo.clear()
+        filterMemo.update({'info': info, 'text': {}, 'matches': {}})
+
+    if key not in filterMemo['matches']:
+        fields = tuple(spec['fields'])
+        if fields not in filterMemo['text']:
+            filterMemo['text'][fields] = filterText(info, fields)
+
+        keep = matchFilter(info, compileFilter(spec),
+                           filterMemo['text'][fields])
+        filterMemo['matches'][key] = pd.DataFrame(
+            {'label': info['id'][keep], 'sector': info['sector'][keep]}
+        ).reset_index(drop=True)
+        logging.info(f'rate filter {path}: {keep.sum()} rates')
+
+    return filterMemo['matches'][key]
+
+# ------------------------------------------------------------------------------
+def filterKey(path=filterFile):
+    '''
+    returns the hash of the filter file (None if there is none), for callers
+    that keep their own rate selections (see serverFunctions.selectRates)
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# ------------------------------------------------------------------------------
 def rateFilter(rates):
     '''
-    method for building cached rate filter
-    just a long set of negative filters for:
+    method for building cached rate filter. Applies the default filter (see
+    defaultFilter) to the URDB csv rates:
         - old rates
         - lighting rates
-        - specialty rates not used for EV charging (found by keyword) 
-
-    takes the rates dataframe as an argument and returns a dataframe 
-    is used for filtering rates
+        - specialty rates not used for EV charging (found by keyword)
 
-    feature improvement:
-        - refactor code to use an external list of keyword filters that
-          can be easily updated or user-specified
+    takes the rates dataframe as an argument and saves the labels and
+    sectors of the filtered rates to a staged cache file. A filter file
+    replaces this set when rates are selected (see filteredRates)
     '''
-
-    # -------- remove old rates ------------------------------------------------
     # many of the rates in the openei database are old and no longer in use or
-    # have been replaced by newer versions. This section removes rates that have
-    # ended before the current year or have no end date. Users can select the
+    # have been replaced by newer versions, lighting rates and many specialty
+    # rates are unlikely to be used for EV charging. Users can select the
     # unfiltered rates for historical analysis.
+    rates = rates.rename(columns={'name': 'rateName',
+                                  'utility': 'utilityName'})
+    if 'utilityName' not in rates.columns:
+        rates['utilityName'] = None
+    keep = matchFilter(rates, compileFilter(defaultFilter))
 
-    # convert enddate to datetime
-    rates['enddate'] = pd.to_datetime(rates['enddate'])
-    # current year
-    current = pd.to_datetime('today')
-    # remove rates that ended before current year or have no end date
-    rates = rates[(rates['enddate'] >= current) | (rates['enddate'].isnull())]
-
-    print(f'{len(rates)} current rates.')
-
-    # -------- remove lighting rates ----------------------------------------------
-    # lighting rates are unlikely to be used for EV charging
-    rates = rates[rates['sector'] != 'Lighting']
-    print(f'{len(rates)} commercial, residential, & industrial rates.')
-
-    # -------- keyword filtering --------------------------------------------------
-    # many specialty rates are not applicable to EV charging. This section removes
-    # rates that are unlikely to be used for EV charging through keyword filtering. 
-
-    # list of keywords to filter out
-    keywords = ['agriculture',
-                 'water heat',
-                 'space heat',
-                 'space cool',
-                 'unmetered',
-                 'irrigation',
-                 'pumping']
-    
-    # remove rates with keywords in the name field
-    for i in keywords:
-        rates = rates[~rates['name'].str.contains(i, case=False, na=False)]
-
-    print(f'{len(rates)} keyword filtered rates.')
+    print(f'{keep.sum()} of {len(rates)} rates kept by the rate filter.')
 
     # -------- create rate set ---------------------------------------------------
     # output dataframe with only rate label and sector
     # the label field is used to subset the full rate database
     # the sector field is used to subset further filter rates by sector
-    filtered = rates[['label', 'sector']]
-    filtered.to_pickle('cached_data/filtered.pkl')
+    filtered = rates.loc[keep, ['label', 'sector']]
+    filtered.to_pickle(stagedFile(cacheFiles['filtered']))
 
 #################### Rate Data Preprocessing Functions #########################
 
@@ -377,6 +695,32 @@ def mapMonSchedule (sched, value):
 
 # -------------------------- Main Function -------------------------------------
 
+# rate details carried through from the URDB json file. These are not used in
+# the calculation and are stored separately from compiled rates in the cache
+rateDetails = ['rateName', 'utilityName', 'eiaId', 'sector',
+               'fixedChargeFirstMeter', 'sourceReference',
+               'description', 'demandMax', 'demandMin']
+
+# effective dates of the rate, stored as timestamps (NaT if missing)
+rateDates = ['startdate', 'enddate']
+
+def rateDate(value):
+    '''
+    helper function that converts a URDB date to a pandas timestamp. URDB
+    dates are unix timestamps (seconds), extended json dates ({'$date': ...}
+    in milliseconds or as a date string) or date strings
+    '''
+    unit = 's'
+    if isinstance(value, dict):
+        value, unit = value.get('$date'), 'ms'
+    if value is None or isinstance(value, bool):
+        return pd.NaT
+    if isinstance(value, (int, float)):
+        return pd.to_datetime(value, unit=unit, errors='coerce')
+    return pd.to_datetime(value, errors='coerce', utc=True).tz_localize(None)
+
+
+
 def rateProcess (rateData):
     '''
     main process for creating rate data dictionary
@@ -392,10 +736,16 @@ def rateProcess (rateData):
     outputs dictionary with either data or none for each key. Whether or not
     there is data for each key will control flow of the calculator.
 
+    unsupported rate structures are marked with 'unsupported' and the reason
+    is recorded under the 'unsupportedReason' key (a RateReason, or None)
+
     to do - refactor to into separate functions for each rate type and a main 
             function that calls them. This will make it easier to maintain.
     '''
 
+    # reasons the rate is unsupported (first reason found is kept)
+    reasons = []
+
     # logic to determine which  rate type is present. outputs are captured in
     # lists of four values which will be mapped to the dictionary keys
 
@@ -424,12 +774,14 @@ def rateProcess (rateData):
                 False, False]
         else:
             nrg = ['unsupported', 'unsupported', 'unsupported', 'unsupported']
+            reasons.append(RateReason.TIERED_TOU_ENERGY)
                
     elif maxNRG is None and rateNRG is None:
         nrg = [False, False, False, False]   
 
     elif maxNRG is not None and rateNRG is None:
         nrg = ['unsupported', 'unsupported', 'unsupported', 'unsupported'] 
+        reasons.append(RateReason.TIERS_WITHOUT_RATES)
 
     #-------------------------- TOU demand rates ------------------------------#
 
@@ -449,6 +801,7 @@ def rateProcess (rateData):
         
     elif maxDemandTou is not None: # tiers unsupported
         touDemand = ['unsupported', 'unsupported']        
+        reasons.append(RateReason.TIERED_TOU_DEMAND)
     
     # ------------------------- flat demand rates -----------------------------#
  
@@ -483,11 +836,16 @@ def rateProcess (rateData):
             mapMonSchedule(monSched, maxDemandFlat)
         ]
 
-    elif (maxDemandFlat is not None, rateDemandFlat is None):
+    elif (maxDemandFlat is not None and rateDemandFlat is None):
         flatDemand = ['unsupported', 'unsupported']
+        if monSched is None:
+            reasons.append(RateReason.FLAT_DEMAND_WITHOUT_MONTHS)
+        else:
+            reasons.append(RateReason.TIERS_WITHOUT_RATES)
     
     elif (monSched is None):
         flatDemand = ['unsupported', 'unsupported']
+        reasons.append(RateReason.FLAT_DEMAND_WITHOUT_MONTHS)
 
     cats = ['nrgTierMax', 'nrgTierRates', 'nrgTOUWkdRates', 'nrgTOUWkeRates',
             'demandTOUwkdRates', 'demandTOUwkeRates', 'demandFlatRates',
@@ -497,23 +855,430 @@ def rateProcess (rateData):
     allout = nrg + touDemand + flatDemand
     # stich together all the lists into a single list
     outDict = {k:v for k,v in zip(cats, allout)}
+    outDict['unsupportedReason'] = reasons[0] if reasons else None
     
     outDict['id'] = rateData['_id']['$oid']
     # rate details if present
-    details = ['rateName', 'utilityName', 'eiaId', 'sector',
-                'fixedChargeFirstMeter', 'sourceReference',
-                'description', 'demandMax', 'demandMin']
-    for i in details:
+    for i in rateDetails:
         try:
             outDict[i] = rateData[i]
         except:
             outDict[i] = False
+
+    for i in rateDates:
+        outDict[i] = rateDate(rateData.get(i))
         
     return outDict
 
 
+#################### Rate Compiling Functions ##################################
+
+class RateStatus(enum.Enum):
+    '''
+    support status of a compiled rate. Replaces the 'unsupported' and
+    'schedule invalid' strings used in the rateProcess output
+    '''
+    SUPPORTED = 'supported'
+    UNSUPPORTED = 'unsupported'
+    SCHEDULE_INVALID = 'schedule invalid'
+
+# ------------------------------------------------------------------------------
+
+class RateReason(enum.Enum):
+    '''
+    machine-readable reason codes for the support status of a compiled rate.
+    These are saved with the rate details in the cache (supportReason) so
+    unsupported rates can be explained without rerunning the calculator
+    '''
+    SUPPORTED = 'supported'
+    # rate structures the calculator does not support
+    TIERED_TOU_ENERGY = 'tiered_tou_energy'
+    TIERED_TOU_DEMAND = 'tiered_tou_demand'
+    TIERS_WITHOUT_RATES = 'tiers_without_rates'
+    FLAT_DEMAND_WITHOUT_MONTHS = 'flat_demand_without_months'
+    UNTIERED_MULTIPLE_RATES = 'untiered_multiple_rates'
+    # tier limits out of sequence (see validRates)
+    UNSORTED_TIERS = 'unsorted_tiers'
+    # schedules that are missing or point to periods that do not exist
+    INVALID_ENERGY_SCHEDULE = 'invalid_energy_schedule'
+    INVALID_DEMAND_SCHEDULE = 'invalid_demand_schedule'
+    INVALID_FLAT_DEMAND_SCHEDULE = 'invalid_flat_demand_schedule'
+    # rate data that could not be compiled
+    MALFORMED_RATE = 'malformed_rate'
+
+# ------------------------------------------------------------------------------
+
+class CompiledRate:
+    '''
+    compact, analysis-ready version of a rateProcess dictionary. This is the
+    rate format stored in the cache and consumed by coreCalc.
+
+    * TOU rates are stored as a vector of prices and a 12x24 schedule of
+      indexes into that vector (one schedule each for weekdays and weekends).
+      Identical schedules share storage, both within a rate (weekday and
+      weekend) and across rates.
+    * tiered rates are stored as 12 x n arrays of tier rates and tier upper
+      limits. The last tier of each month has an upper limit of inf and months
+      with fewer tiers are padded with zero-cost tiers that can never be
+      reached.
+    * components that are not part of the rate are None
+    * status and reason record whether the rate is supported and why not
+    * rate details (name, utility, etc.) are not stored here, see rateInfo in
+      buildCache
+    '''
+
+    __slots__ = ('id', 'status', 'reason',
+                 'nrgTierRates', 'nrgTierMax',
+                 'nrgPrices', 'nrgWkdSched', 'nrgWkeSched',
+                 'demandPrices', 'demandWkdSched', 'demandWkeSched',
+                 'demandFlatRates', 'demandFlatMax')
+
+    def __init__(self, id, status=RateStatus.SUPPORTED,
+                 reason=RateReason.SUPPORTED, **components):
+        self.id = id
+        self.status = status
+        self.reason = reason
+        for i in self.__slots__[3:]:
+            setattr(self, i, components.get(i))
+
+    # 12x24 price views of the TOU schedules
+    @property
+    def nrgTOUWkdRates(self):
+        return mapPrices(self.nrgPrices, self.nrgWkdSched)
+
+    @property
+    def nrgTOUWkeRates(self):
+        return mapPrices(self.nrgPrices, self.nrgWkeSched)
+
+    @property
+    def demandTOUwkdRates(self):
+        return mapPrices(self.demandPrices, self.demandWkdSched)
+
+    @property
+    def demandTOUwkeRates(self):
+        return mapPrices(self.demandPrices, self.demandWkeSched)
+
+# ------------------------------------------------------------------------------
+
+def mapPrices(prices, sched):
+    '''
+    helper function that maps a compiled price vector onto a compiled schedule
+    and returns a 12x24 array of prices (or None if there is no schedule)
+    '''
+    if prices is None:
+        return None
+    return prices[sched]
+
+# ------------------------------------------------------------------------------
+
+def internSchedule(sched, schedules):
+    '''
+    returns a shared, read-only copy of a compiled schedule. schedules is a
+    dictionary of schedules already seen during the cache build so that rates
+    with identical schedules point to the same array
+    '''
+    key = sched.tobytes()
+    if key not in schedules:
+        sched.flags.writeable = False
+        schedules[key] = sched
+    return schedules[key]
+
+# ------------------------------------------------------------------------------
+
+def compileTOU(wkd, wke, schedules):
+    '''
+    compiles weekday and weekend 12x24 price lists from rateProcess into a
+    price vector and two int16 schedules of indexes into that vector
+    '''
+    grid = np.asarray([wkd, wke], dtype=np.float64)
+    if grid.shape != (2, 12, 24):
+        raise ValueError(f'unexpected schedule shape {grid.shape}')
+
+    prices, ids = np.unique(grid, return_inverse=True)
+    ids = ids.reshape(grid.shape).astype(np.int16)
+
+    wkdSched = internSchedule(ids[0], schedules)
+    # weekend schedules are often the same as the weekday schedule
+    if np.array_equal(ids[0], ids[1]):
+        wkeSched = wkdSched
+    else:
+        wkeSched = internSchedule(ids[1], schedules)
+
+    return prices, wkdSched, wkeSched
+
+# ------------------------------------------------------------------------------
+
+def compileTiers(rates, maxes):
+    '''
+    compiles 12 x n tier rates and 12 x n-1 tier maximums from rateProcess
+    into two padded 12 x n arrays (see CompiledRate). maxes may be False for
+    rates without tier limits
+    '''
+    if len(rates) != 12:
+        raise ValueError(f'expected 12 months of tiers, got {len(rates)}')
+
+    nTiers = max(len(i) for i in rates)
+    tierRates = np.zeros((12, nTiers))
+    tierMax = np.full((12, nTiers), np.inf)
+
+    for m in range(12):
+        tierRates[m, :len(rates[m])] = rates[m]
+        if maxes is not False:
+            tierMax[m, :len(maxes[m])] = maxes[m]
+
+    return tierRates, tierMax
+
+# ------------------------------------------------------------------------------
+
+def scheduleReason(rate):
+    '''
+    returns the RateReason for the first invalid (or missing) schedule in a
+    rateProcess dictionary, or None if all schedules are valid. Missing
+    schedules are mapped to None by mapSchedule
+    '''
+    components = {
+        RateReason.INVALID_ENERGY_SCHEDULE: ['nrgTierMax', 'nrgTierRates',
+                                             'nrgTOUWkdRates', 'nrgTOUWkeRates'],
+        RateReason.INVALID_DEMAND_SCHEDULE: ['demandTOUwkdRates',
+                                             'demandTOUwkeRates'],
+        RateReason.INVALID_FLAT_DEMAND_SCHEDULE: ['demandFlatRates',
+                                                  'demandFlatMax']}
+
+    for reason, keys in components.items():
+        if any(rate[i] is None or isinstance(rate[i], str) and
+               rate[i] == 'schedule invalid' for i in keys):
+            return reason
+    return None
+
+# ------------------------------------------------------------------------------
+
+def compileRate(rate, schedules):
+    '''
+    main process for compiling a rateProcess dictionary into a CompiledRate.
+    The status of the rate and the reason for it are decided here (rather than
+    at calculation time) from the reasons recorded by rateProcess, the
+    schedule checks in scheduleReason and the validRates function. Rates that
+    fail to compile are unsupported.
+
+    schedules is the dictionary of shared schedules used by internSchedule
+    '''
+
+    if rate['unsupportedReason'] is not None:
+        return CompiledRate(rate['id'], RateStatus.UNSUPPORTED,
+                            rate['unsupportedReason'])
+
+    reason = scheduleReason(rate)
+    if reason is not None:
+        return CompiledRate(rate['id'], RateStatus.SCHEDULE_INVALID, reason)
+
+    try:
+        if validRates(rate) is False:
+            return CompiledRate(rate['id'], RateStatus.UNSUPPORTED,
+                                RateReason.UNSORTED_TIERS)
+
+        components = {}
+
+        if rate['nrgTierRates'] is not False:
+            (components['nrgTierRates'],
+             components['nrgTierMax']) = compileTiers(rate['nrgTierRates'],
+                                                      rate['nrgTierMax'])
+
+        if rate['nrgTOUWkdRates'] is not False:
+            (components['nrgPrices'],
+             components['nrgWkdSched'],
+             components['nrgWkeSched']) = compileTOU(rate['nrgTOUWkdRates'],
+                                                     rate['nrgTOUWkeRates'],
+                                                     schedules)
+
+        if rate['demandTOUwkdRates'] is not False:
+            (components['demandPrices'],
+             components['demandWkdSched'],
+             components['demandWkeSched']) = compileTOU(rate['demandTOUwkdRates'],
+                                                        rate['demandTOUwkeRates'],
+                                                        schedules)
+
+        if rate['demandFlatRates'] is not False:
+            flatRates, flatMax = compileTiers(rate['demandFlatRates'],
+                                              rate['demandFlatMax'])
+            # flat demand without tier limits must have a single rate per month
+            if rate['demandFlatMax'] is False:
+                if flatRates.shape[1] > 1:
+                    return CompiledRate(rate['id'], RateStatus.UNSUPPORTED,
+                                        RateReason.UNTIERED_MULTIPLE_RATES)
+                flatMax = None
+            components['demandFlatRates'] = flatRates
+            components['demandFlatMax'] = flatMax
+
+    except (TypeError, ValueError, IndexError) as e:
+        logging.warning(f'could not compile rate {rate["id"]} ({e})')
+        return CompiledRate(rate['id'], RateStatus.UNSUPPORTED,
+                            RateReason.MALFORMED_RATE)
+
+    return CompiledRate(rate['id'], RateStatus.SUPPORTED, **components)
+
+
 ################## Cache Building Functions ####################################
 
+# files that make up the rate cache
+cacheFiles = {'filtered': 'cached_data/filtered.pkl',
+              'rates': 'cached_data/ratesProcessed.pickle',
+              'info': 'cached_data/rateInfo.pkl',
+              'demand': 'cached_data/demandIndex.pkl',
+              'dates': 'cached_data/dateIndex.pkl'}
+
+# precompiled price matrices of the supported rates (see writePriceMatrices).
+# Each matrix is saved as an npy file so that it can be memory mapped
+priceFiles = {i: f'cached_data/prices/{i}.npy' for i in
+              ['ids', 'marginal', 'nrgTiered', 'nrgTierRates', 'nrgTierMax',
+               'demandFlatRates', 'demandFlatMax', 'demandIds',
+               'demandPrices']}
+
+# fingerprints of the cost structure of each rate (see rateFingerprint).
+# When the cache is rebuilt the fingerprints of the previous build are kept so
+# the two snapshots can be compared (see snapshotDiff)
+fingerprintFile = 'cached_data/fingerprints.json'
+previousFingerprintFile = 'cached_data/fingerprints_previous.json'
+
+# rateProcess fields that determine the cost of a rate
+fingerprintFields = ['nrgTierMax', 'nrgTierRates', 'nrgTOUWkdRates',
+                     'nrgTOUWkeRates', 'demandTOUwkdRates', 'demandTOUwkeRates',
+                     'demandFlatRates', 'demandFlatMax', 'unsupportedReason']
+
+# the cache manifest records the cache schema version, the cache backend and
+# the size, modification time and checksum of each cache file. Increase cacheSchema when the format of the
+# cached data changes so that older caches are rebuilt
+cacheSchema = 6
+
+# lock files. buildLock is held while a cache is built, swapLock while cache
+# files are replaced (exclusive) or loaded (shared)
+buildLock = 'cached_data/build.lock'
+swapLock = 'cached_data/swap.lock'
+
+
+@contextlib.contextmanager
+def cacheLock(path, shared=False):
+    '''
+    context manager that holds a cross-process lock on a lock file, waiting
+    until it is free. Shared locks can be held by several processes at once
+    (on windows all locks are exclusive)
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'a+b') as f:
+        if os.name == 'nt':
+            while True:
+                try:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        else:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+# ------------------------------------------------------------------------------
+def stagedFile(path):
+    '''
+    returns the path a cache file is written to before it is moved into place
+    '''
+    return f'{path}.{os.getpid()}.tmp'
+
+# ------------------------------------------------------------------------------
+def manifestFile():
+    '''
+    returns the manifest path of the selected cache backend
+    '''
+    return f'cached_data/manifest_{cacheBackend}.json'
+
+# ------------------------------------------------------------------------------
+def fileChecksum(path):
+    '''
+    returns the sha256 checksum of a file, read in blocks
+    '''
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 20), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+# ------------------------------------------------------------------------------
+def commitCache():
+    '''
+    moves staged cache files into place and writes the cache manifest. Files
+    are replaced with atomic renames while the swap lock is held so readers
+    never see a partly written file or a mix of old and new files
+    '''
+    manifest = {'schema': cacheSchema,
+                'backend': cacheBackend,
+                'built': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'files': {i: {'size': os.path.getsize(stagedFile(i)),
+                              'mtime': os.path.getmtime(stagedFile(i)),
+                              'sha256': fileChecksum(stagedFile(i))}
+                          for i in cachePaths()}}
+
+    with open(stagedFile(manifestFile()), 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    with cacheLock(swapLock):
+        if os.path.exists(fingerprintFile):
+            shutil.copyfile(fingerprintFile, previousFingerprintFile)
+        for i in cachePaths() + [manifestFile()]:
+            os.replace(stagedFile(i), i)
+
+# ------------------------------------------------------------------------------
+def cacheVersion():
+    '''
+    returns the schema, backend and build time of the current cache from its
+    manifest (None if there is no manifest)
+    '''
+    try:
+        with open(manifestFile()) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return {i: manifest.get(i) for i in ['schema', 'backend', 'built']}
+
+# ------------------------------------------------------------------------------
+def validCache(verify=False):
+    '''
+    checks that the cache manifest matches this version of the tool and the
+    selected backend and that every cache file matches its recorded size and
+    modification time, without reading or unpickling the cache. A file whose
+    modification time changed (for example a copied cache) is accepted if its
+    checksum still matches. If verify is True every file is checked against
+    its checksum (see loadCache, which does this after a failed load)
+    '''
+    try:
+        with open(manifestFile()) as f:
+            manifest = json.load(f)
+
+        if (manifest['schema'] != cacheSchema
+                or manifest['backend'] != cacheBackend):
+            return False
+
+        for i in cachePaths():
+            entry = manifest['files'][i]
+            if os.path.getsize(i) != entry['size']:
+                return False
+            if ((verify or os.path.getmtime(i) != entry['mtime'])
+                    and fileChecksum(i) != entry['sha256']):
+                return False
+
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+    return True
+
+
 def getRateJson ():
     '''
     function to download the URDB json file and return it as a dictionary 
@@ -632,13 +1397,40 @@ def getRateCsv ():
         return
 # ---------------------------------------------------------------------------- #
 
-def buildCache ():
+def buildCache (force=True):
     '''
     Parent function to build the rate cache. This function calls the other
     functions in this module to build the rate cache. This function is called
     by the checkCache function or from the mainMenu if the user chooses to 
     rebuild the cache.
 
+    only one process builds the cache at a time (see cacheLock). Cache files
+    are written to staged files and moved into place with the manifest once
+    they are all written (see commitCache). If force is False the cache is
+    not rebuilt when another process built a valid cache while this one was
+    waiting for the lock
+    '''
+    with cacheLock(buildLock):
+        if not force and validCache():
+            print('cache was built by another process\n')
+            return
+
+        try:
+            writeCache()
+            commitCache()
+        finally:
+            for i in (list(cacheFiles.values()) + [sqliteFile]
+                      + list(priceFiles.values()) + [fingerprintFile]):
+                if os.path.exists(stagedFile(i)):
+                    os.remove(stagedFile(i))
+
+    print('cache built\n')
+
+# ---------------------------------------------------------------------------- #
+def writeCache():
+    '''
+    downloads and processes the rate data and writes the cache files to
+    staged files (see buildCache)
     '''
     print('Building rate cache...this action takes about a minute depending'
           'on internet connection\n')
@@ -655,59 +1447,587 @@ def buildCache ():
     print('data download complete\n')
 
     # process URDB JSON file ---------------------------------------------------
-    # dict comprehension to process rates in parallel
+    # each rate is processed and then compiled into a CompiledRate. Rate details
+    # are kept aside and saved as a separate rate information table
     iter = alive_it(rates.items(), title='Processing rates')
-    ratesProcessed = {k: rateProcess(v) for k, v in iter}
+    ratesProcessed = {}
+    rateInfo = []
+    schedules = {}
+    fingerprints = {}
+    for k, v in iter:
+        processed = rateProcess(v)
+        ratesProcessed[k] = compileRate(processed, schedules)
+        fingerprints[k] = rateFingerprint(processed)
+        rateInfo.append({i: processed[i]
+                         for i in ['id'] + rateDetails + rateDates})
+        rateInfo[-1]['supportReason'] = ratesProcessed[k].reason.value
+
+    rateInfo = pd.DataFrame(rateInfo)
    
+    # interval indexes of the demand ranges and effective dates, saved with
+    # either cache backend so they are not rebuilt when the cache is loaded
+    indexes = {'demand': buildDemandIndex(rateInfo),
+               'dates': buildDateIndex(rateInfo)}
+
     print('rate processing complete. Saving to file...')
-    # save processed rates to file pickle file
-    with open('cached_data/ratesProcessed.pickle', 'wb') as f:
-        pickle.dump(ratesProcessed, f)
+    # save processed rates to the sqlite cache if it is selected, otherwise
+    # to pickle files
+    if cacheBackend == 'sqlite':
+        writeSqliteCache(ratesProcessed, rateInfo,
+                         pd.read_pickle(stagedFile(cacheFiles['filtered'])),
+                         indexes)
+    else:
+        with open(stagedFile(cacheFiles['rates']), 'wb') as f:
+            pickle.dump(ratesProcessed, f)
+        rateInfo.to_pickle(stagedFile(cacheFiles['info']))
+        for k, v in indexes.items():
+            with open(stagedFile(cacheFiles[k]), 'wb') as f:
+                pickle.dump(v, f)
 
-    print('cache built\n')
+    writePriceMatrices(ratesProcessed)
+
+    with open(stagedFile(fingerprintFile), 'w') as f:
+        json.dump({'built': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'rates': fingerprints}, f)
+
+# ---------------------------------------------------------------------------- #
+def writePriceMatrices(rates):
+    '''
+    precompiles the supported rates of a dictionary of CompiledRates into
+    contiguous arrays, in rate id order, and saves them to staged files (see
+    buildCache):
+        ids - rate ids
+        marginal - N x 2 x 12 x 24 marginal energy price ($/kWh) by day type
+                   (weekday, weekend), month and hour. Flat and TOU prices
+                   are expanded to every hour, tiered rates get the price of
+                   their first tier
+        nrgTiered - N flags of rates with tiered energy prices (their
+                    marginal price is only the first tier)
+        nrgTierRates, nrgTierMax, demandFlatRates, demandFlatMax, demandIds,
+        demandPrices - tier and TOU demand arrays as made by stackRates
+    '''
+    supported = {k: rates[k] for k in sorted(rates)
+                 if rates[k].status is RateStatus.SUPPORTED}
+    batch = calc.stackRates(supported)
+
+    # energy is either tiered or TOU (rates with both are unsupported), so
+    # the TOU prices of tiered rates are zero and can be replaced
+    nrgTiered = np.array([i.nrgTierRates is not None
+                          for i in supported.values()], dtype=bool)
+    marginal = np.where(nrgTiered[:, None, None, None],
+                        batch['nrgTierRates'][:, None, :, :1],
+                        batch['nrgTOU'])
+
+    matrices = {'ids': np.array(batch['ids'], dtype=str),
+                'marginal': marginal,
+                'nrgTiered': nrgTiered}
+    matrices.update({i: batch[i] for i in
+                     ['nrgTierRates', 'nrgTierMax', 'demandFlatRates',
+                      'demandFlatMax', 'demandIds', 'demandPrices']})
+
+    os.makedirs(os.path.dirname(priceFiles['ids']), exist_ok=True)
+    for k, v in matrices.items():
+        with open(stagedFile(priceFiles[k]), 'wb') as f:
+            np.save(f, np.ascontiguousarray(v), allow_pickle=False)
 
 # ---------------------------------------------------------------------------- #
-def loadCache():
+def loadPriceMatrices():
+    '''
+    memory maps the precompiled price matrices (see writePriceMatrices), so
+    only the parts that are used are read from disk
+    '''
+    return {k: np.load(v, mmap_mode='r', allow_pickle=False)
+            for k, v in priceFiles.items()}
+
+# ---------------------------------------------------------------------------- #
+def rateFingerprint(processed):
+    '''
+    returns a fingerprint of the cost structure of a rateProcess output (its
+    tiers, schedules and support reason, see fingerprintFields). Rates with
+    the same fingerprint have the same cost for any profile, changes to rate
+    details such as the name or description do not change it
+    '''
+    fields = {i: processed[i] for i in fingerprintFields}
+    text = json.dumps(fields, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+# ---------------------------------------------------------------------------- #
+def loadFingerprints(path=fingerprintFile):
+    '''
+    loads a fingerprint snapshot (see writeCache). Returns a dictionary with
+    the time the cache was built and the fingerprint of each rate id, or
+    None if the snapshot does not exist
+    '''
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+# ---------------------------------------------------------------------------- #
+def snapshotDiff(previous, current):
+    '''
+    compares two fingerprint dictionaries (rate id: fingerprint) and returns
+    a dictionary of the sorted rate ids that were added, removed and changed
+    (same id with a different cost structure)
+    '''
+    return {'added': sorted(current.keys() - previous.keys()),
+            'removed': sorted(previous.keys() - current.keys()),
+            'changed': sorted(k for k in current.keys() & previous.keys()
+                              if current[k] != previous[k])}
+
+# ---------------------------------------------------------------------------- #
+def loadCache(quiet=False):
     '''
     function to load in cached data. loop construct used to 
-    show progress bar while loading data
+    show progress bar while loading data (no progress bar if quiet is True)
+
+    returns a dictionary with the same keys as cacheFiles:
+        filtered - dataframe of filtered rate labels and sectors
+        rates - dictionary of CompiledRate objects keyed by rate id
+        info - dataframe of rate details (name, utility, sector, etc.) and
+               the supportReason code of each rate
+        demand - interval index of rate demand ranges (see buildDemandIndex)
+        dates - interval index of rate effective dates (see buildDateIndex)
+        prices - memory mapped price matrices (see writePriceMatrices)
+        fingerprints - cost structure fingerprint of each rate id (see
+                       rateFingerprint)
+
+    with the sqlite cache, rates is a RateStore that loads rates from the
+    cache file as they are used
+
+    the cache is checked against its manifest before it is loaded (see
+    validCache) and a shared lock is held while loading so that a cache build
+    cannot replace the files part way through. Raises FileNotFoundError if
+    there is no valid cache, or if loading fails and a cache file no longer
+    matches its checksum
     '''
-    files = [r'cached_data/filtered.pkl',
-             r'cached_data/ratesProcessed.pickle']
 
-    iter = alive_it(files, title='Loading cache')
-    
-    out = []
+    with cacheLock(swapLock, shared=True):
+        if not validCache():
+            raise FileNotFoundError('no valid rate cache found, build it with '
+                                    'buildCache or the REFRESH CACHE menu')
 
-    for i in iter:
-        with open(i, 'rb') as f:
-            out.append(pickle.load(f))
-    rateFiltered, ratesProcessed = out[0], out[1]
-    return rateFiltered, ratesProcessed
+        try:
+            if cacheBackend == 'sqlite':
+                cache = loadSqliteCache()
+
+            else:
+                iter = cacheFiles.items()
+                if not quiet:
+                    iter = alive_it(iter, title='Loading cache')
+
+                cache = {}
+
+                for k, v in iter:
+                    with open(v, 'rb') as f:
+                        cache[k] = pickle.load(f)
+
+            cache['prices'] = loadPriceMatrices()
+            cache['fingerprints'] = loadFingerprints()['rates']
+
+        except Exception as e:
+            # a file that no longer matches its checksum was damaged after
+            # the cache was built
+            if not validCache(verify=True):
+                raise FileNotFoundError('the rate cache is damaged, rebuild '
+                                        'it with buildCache or the REFRESH '
+                                        f'CACHE menu ({e})')
+            raise
+
+        return cache
 
 # ------------------------------------------------------------------------------
 def checkCache():
     '''
     function to check for and load the rate cache. This function is called
-    in the calcSetup function. If the cache is not found, the buildCache
-    function is called to build the cache.
+    in the calcSetup function. If the cache is not found (or does not match
+    its manifest), the buildCache function is called to build the cache.
+    If another process is already building the cache, this waits for it. A
+    cache that fails to load because a file was damaged is rebuilt.
 
     '''
 
     print('checking for and loading cached data...')
 
-    if (os.path.exists('cached_data/filtered.pkl') and
-        os.path.exists('cached_data/ratesProcessed.pickle')):
+    if validCache():
         print('using prebuilt cache')
-        rateFiltered, ratesProcessed = loadCache()
-        
-    else:
-        print('no cache found. building cache...')
-        buildCache()
-        print('cache built...loading data')
-        rateFiltered, ratesProcessed = loadCache()
+        try:
+            return loadCache()
+        except FileNotFoundError as e:
+            print(f'{e}. rebuilding cache...')
+            buildCache(force=True)
+            print('cache built...loading data')
+            return loadCache()
+
+    print('no valid cache found. building cache...')
+    buildCache(force=False)
+    print('cache built...loading data')
+    cache = loadCache()
   
-    return rateFiltered, ratesProcessed
+    return cache
+
+# ------------------------------------------------------------------------------
+def cachePaths():
+    '''
+    returns the files that make up the rate cache of the selected cache
+    backend
+    '''
+    if cacheBackend == 'sqlite':
+        return [sqliteFile] + list(priceFiles.values()) + [fingerprintFile]
+    return (list(cacheFiles.values()) + list(priceFiles.values())
+            + [fingerprintFile])
+
+################## Session Cache Functions #####################################
+
+# the default input workbook (see calcMenu)
+defaultInput = 'user_input/rate_calculator_input_file.xlsx'
+
+# background preload of the rate cache and default input workbook, started
+# when the main menu opens (see startPreload)
+preload = {}
+
+# rate cache kept in memory for the rest of the session once it is loaded,
+# with the cacheStamp it was loaded at (see sessionCache)
+session = {}
+
+# ------------------------------------------------------------------------------
+def cacheStamp():
+    '''
+    returns the modification times of the cache files and manifest (None for
+    missing files). The stamp changes whenever the cache is rebuilt or a cache
+    file is replaced
+    '''
+    stamp = []
+    for i in cachePaths() + [manifestFile()]:
+        try:
+            stamp.append(os.path.getmtime(i))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+# ------------------------------------------------------------------------------
+def sessionCurrent():
+    '''
+    checks whether the session cache was loaded from the current cache files
+    '''
+    return 'cache' in session and session['stamp'] == cacheStamp()
+
+# ------------------------------------------------------------------------------
+def preloadWorker(job):
+    '''
+    loads the rate cache (if it is valid and not already in the session
+    cache) and parses both sheets of the default input workbook into
+    profileCache. Runs in a background thread so it does not print. Errors
+    are logged and left for the foreground run to report
+    '''
+    try:
+        job['stamp'] = cacheStamp()
+        if not sessionCurrent() and validCache():
+            job['cache'] = loadCache(quiet=True)
+    except Exception as e:
+        logging.warning(f'could not preload rate cache ({e})')
+
+    for sheet in ['Single', 'Monthly']:
+        try:
+            readFile(defaultInput, sheet)
+        except Exception as e:
+            logging.info(f'could not preload {defaultInput} {sheet} ({e})')
+
+# ------------------------------------------------------------------------------
+def startPreload(restart=False):
+    '''
+    starts loading the rate cache and default input workbook in a background
+    thread while the user works through the menus. Does nothing if a preload
+    is already waiting to be used, unless restart is True (after the cache
+    is rebuilt), in which case the old preload and the session cache are
+    dropped
+    '''
+    if 'job' in preload and not restart:
+        return
+
+    if restart:
+        session.clear()
+
+    job = {'cache': None}
+    job['thread'] = threading.Thread(target=preloadWorker, args=(job,),
+                                     daemon=True)
+    preload['job'] = job
+    job['thread'].start()
+
+# ------------------------------------------------------------------------------
+def releaseCache():
+    '''
+    drops the preloaded and session rate caches so the cache files can be
+    replaced by a cache build (see buildCache). A running preload is waited
+    for. The price matrices are memory mapped (see loadPriceMatrices) and the
+    sqlite cache is kept open (see RateStore), and on windows a file that is
+    still mapped or open cannot be replaced, so the matrices are dropped and
+    collected and the sqlite connection closed here rather than when the
+    cache is next loaded
+    '''
+    job = preload.pop('job', None)
+    caches = [session.get('cache')]
+    if job is not None:
+        job['thread'].join()
+        caches.append(job['cache'])
+
+    for cache in caches:
+        if cache is None:
+            continue
+        cache.pop('prices', None)
+        if isinstance(cache.get('rates'), RateStore):
+            cache['rates'].close()
+    session.clear()
+
+    gc.collect()
+
+# ------------------------------------------------------------------------------
+def sessionCache():
+    '''
+    returns the rate cache for a calculator run. The cache is loaded once per
+    session (usually in the background, see startPreload) and kept in memory
+    for later runs. It is loaded again by checkCache if the cache files have
+    changed since it was loaded
+    '''
+    job = preload.pop('job', None)
+
+    if job is not None:
+        if job['thread'].is_alive():
+            print('waiting for cache preload to finish...')
+        job['thread'].join()
+
+        if job['cache'] is not None and job['stamp'] == cacheStamp():
+            session.update({'cache': job['cache'], 'stamp': job['stamp']})
+
+    if sessionCurrent():
+        print('using rate cache loaded this session')
+        return session['cache']
+
+    # drop the old cache before loading the new one
+    session.clear()
+    cache = checkCache()
+    session.update({'cache': cache, 'stamp': cacheStamp()})
+
+    return cache
+
+################## SQLite Cache Functions ######################################
+
+# the rate cache is saved as pickle files by default. Setting the
+# RATE_CALCULATOR_CACHE environment variable to sqlite saves it in a single
+# sqlite database instead. Rates are then loaded only when they are selected
+# and several processes can read the cache safely at the same time
+cacheBackend = os.environ.get('RATE_CALCULATOR_CACHE', 'pickle').lower()
+sqliteFile = 'cached_data/rates.sqlite'
+
+# sector of each filtered rate set (see filterRates)
+filterSectors = {'Filtered Residential Rates': 'Residential',
+                 'Filtered Commercial Rates': 'Commercial',
+                 'Filtered Industrial Rates': 'Industrial'}
+
+sqliteTables = '''
+    DROP TABLE IF EXISTS rateInfo;
+    DROP TABLE IF EXISTS compiledRates;
+    DROP TABLE IF EXISTS rateIndexes;
+    CREATE TABLE rateInfo (
+        id TEXT PRIMARY KEY, position INTEGER,
+        rateName, utilityName, eiaId, sector, fixedChargeFirstMeter,
+        sourceReference, description, demandMax, demandMin,
+        startdate TEXT, enddate TEXT, supportReason TEXT,
+        filtered INTEGER, filterSector TEXT, filterPosition INTEGER);
+    CREATE TABLE compiledRates (id TEXT PRIMARY KEY, rate BLOB);
+    CREATE TABLE rateIndexes (name TEXT PRIMARY KEY, data BLOB);
+    CREATE INDEX rateSector ON rateInfo (sector);
+    CREATE INDEX rateEiaId ON rateInfo (eiaId);
+    CREATE INDEX rateUtility ON rateInfo (utilityName);
+    CREATE INDEX rateStart ON rateInfo (startdate);
+    CREATE INDEX rateEnd ON rateInfo (enddate);
+    CREATE INDEX rateFilter ON rateInfo (filtered, filterSector,
+                                         filterPosition);
+'''
+
+# ------------------------------------------------------------------------------
+def writeSqliteCache(ratesProcessed, rateInfo, filtered, indexes):
+    '''
+    writes the compiled rates, the rate information table, the filtered rate
+    set and the demand and date indexes (pickled, keyed like cacheFiles) to a
+    staged sqlite cache file in a single transaction (see buildCache). Missing rate details (False) are saved as NULL and dates as
+    ISO strings
+    '''
+    info = rateInfo.copy()
+    info.insert(1, 'position', range(len(info)))
+    for i in rateDetails:
+        info[i] = info[i].astype(object).where(info[i].astype(object)
+                                               .map(lambda x: x is not False),
+                                               None)
+    for i in rateDates:
+        info[i] = info[i].dt.strftime('%Y-%m-%d %H:%M:%S')
+
+    filterPosition = {k: n for n, k in enumerate(filtered['label'])}
+    filterSector = dict(zip(filtered['label'], filtered['sector']))
+    info['filtered'] = info['id'].isin(filterPosition.keys()).astype(int)
+    info['filterSector'] = info['id'].map(filterSector)
+    info['filterPosition'] = info['id'].map(filterPosition)
+
+    info = info.astype(object).where(info.notna(), None)
+
+    con = sqlite3.connect(stagedFile(sqliteFile), isolation_level=None)
+    try:
+        con.execute('BEGIN')
+        for statement in sqliteTables.split(';'):
+            if statement.strip():
+                con.execute(statement)
+
+        con.executemany(
+            f'INSERT INTO rateInfo ({", ".join(info.columns)}) '
+            f'VALUES ({", ".join("?" * len(info.columns))})',
+            info.itertuples(index=False))
+        con.executemany(
+            'INSERT INTO compiledRates VALUES (?, ?)',
+            ((k, pickle.dumps(v)) for k, v in ratesProcessed.items()))
+        con.executemany(
+            'INSERT INTO rateIndexes VALUES (?, ?)',
+            ((k, pickle.dumps(v)) for k, v in indexes.items()))
+        con.execute('COMMIT')
+
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+    finally:
+        con.close()
+
+# ------------------------------------------------------------------------------
+def loadSqliteCache():
+    '''
+    loads the rate information, filtered rate set and demand and date indexes
+    from the sqlite cache. Compiled rates are not loaded, a RateStore loads
+    them when they are selected. Returns a dictionary with the same keys as
+    loadCache
+    '''
+    store = RateStore(sqliteFile)
+
+    info = pd.read_sql(
+        f'SELECT {", ".join(["id"] + rateDetails + rateDates)}, supportReason '
+        'FROM rateInfo ORDER BY position', store.con)
+    for i in rateDetails:
+        info[i] = info[i].astype(object).where(info[i].notna(), False)
+    for i in rateDates:
+        info[i] = pd.to_datetime(info[i])
+    info = info.infer_objects()
+
+    filtered = pd.read_sql(
+        'SELECT id AS label, filterSector AS sector FROM rateInfo '
+        'WHERE filtered = 1 ORDER BY filterPosition', store.con)
+
+    indexes = {k: pickle.loads(v) for k, v in
+               store.con.execute('SELECT name, data FROM rateIndexes')}
+
+    return {'filtered': filtered,
+            'rates': store,
+            'info': info,
+            'demand': indexes['demand'],
+            'dates': indexes['dates']}
+
+# ------------------------------------------------------------------------------
+class RateStore(collections.abc.Mapping):
+    '''
+    read-only dictionary of CompiledRates backed by the sqlite cache. Rates
+    are unpickled from the cache when they are looked up, and select and load
+    read many rates with a single indexed query
+    '''
+
+    def __init__(self, path):
+        self.con = sqlite3.connect(f'file:{path}?mode=ro', uri=True,
+                                   check_same_thread=False)
+
+    def close(self):
+        '''
+        closes the connection to the cache file. On windows an open sqlite
+        file cannot be replaced, so this is called before the cache is
+        rebuilt (see releaseCache). The store cannot be used afterwards
+        '''
+        self.con.close()
+
+    def __getitem__(self, id):
+        row = self.con.execute('SELECT rate FROM compiledRates WHERE id = ?',
+                               (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return pickle.loads(row[0])
+
+    def __contains__(self, id):
+        return self.con.execute('SELECT 1 FROM compiledRates WHERE id = ?',
+                                (id,)).fetchone() is not None
+
+    def __iter__(self):
+        query = 'SELECT id FROM rateInfo ORDER BY position'
+        return (i[0] for i in self.con.execute(query))
+
+    def __len__(self):
+        return self.con.execute('SELECT COUNT(*) FROM rateInfo').fetchone()[0]
+
+    def items(self):
+        return self.select().items()
+
+    def values(self):
+        return self.select().values()
+
+    def rateSet(self, filtertype):
+        '''
+        returns the WHERE and ORDER BY clause that picks a calculator rate set
+        (see filterRates) from the rate information table (as i), and its
+        parameters
+        '''
+        if filtertype == 'All Rates in URDB':
+            return 'ORDER BY i.position', ()
+        if filtertype in filterSectors:
+            return ('WHERE i.filtered = 1 AND i.filterSector = ? '
+                    'ORDER BY i.filterPosition', (filterSectors[filtertype],))
+        return 'WHERE i.filtered = 1 ORDER BY i.filterPosition', ()
+
+    def select(self, filtertype='All Rates in URDB'):
+        '''
+        loads the rates of a calculator rate set (see filterRates) with one
+        query on the rate information indexes
+        '''
+        clause, params = self.rateSet(filtertype)
+        rows = self.con.execute('SELECT r.id, r.rate FROM rateInfo i '
+                                'JOIN compiledRates r ON r.id = i.id '
+                                + clause, params)
+        return {k: pickle.loads(v) for k, v in rows}
+
+    def selectIds(self, filtertype='All Rates in URDB'):
+        '''
+        returns the ids of a calculator rate set (see select) from the rate
+        information table, without loading the rates
+        '''
+        clause, params = self.rateSet(filtertype)
+        rows = self.con.execute('SELECT i.id FROM rateInfo i ' + clause,
+                                params)
+        return [i[0] for i in rows]
+
+    def load(self, ids):
+        '''
+        loads the rates of a list of ids (in order, missing ids are skipped)
+        '''
+        rates = {}
+        ids = list(ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            rows = self.con.execute(
+                'SELECT id, rate FROM compiledRates WHERE id IN '
+                f'({", ".join("?" * len(chunk))})', chunk)
+            rates.update((k, pickle.loads(v)) for k, v in rows)
+        return {k: rates[k] for k in ids if k in rates}
+
+# ------------------------------------------------------------------------------
+def getRates(rates, ids):
+    '''
+    returns a dictionary of the rates of a list of ids from a rate dictionary
+    or RateStore (with one query)
+    '''
+    if isinstance(rates, RateStore):
+        return rates.load(ids)
+    return {k: rates[k] for k in ids}
 
 ################## Rate Validation Function ####################################
 
@@ -716,7 +2036,8 @@ def validRates(rate):
     in some cases tier rates are not in sequence. This causes a bug 
     in the calculate function for tiered rates that returns negative values
     This function checks for that and returns a boolean indicator that triggers
-    a unsupported rate output. 
+    a unsupported rate output. It is run on rateProcess dictionaries when rates
+    are compiled into the cache (see compileRate)
     '''
     
     # tier values are in sequence    
@@ -739,38 +2060,218 @@ def validRates(rate):
     else:
         return True
 
+# ------------------------------------------------------------------------------
+
+def unsupportedRates(rateInfo, ids=None):
+    '''
+    returns the id, name, utility and supportReason of unsupported rates from
+    the cached rate information table. ids optionally limits the query to a
+    list of rate ids. Reason codes are the values of RateReason
+    '''
+    df = rateInfo[rateInfo['supportReason'] != RateReason.SUPPORTED.value]
+    if ids is not None:
+        df = df[df['id'].isin(ids)]
+    return df[['id', 'rateName', 'utilityName', 'supportReason']]
+
+# ------------------------------------------------------------------------------
+
+def supportedIds(rateInfo, ids):
+    '''
+    returns the supported rates of a list of rate ids (in order) from the
+    supportReason column of the cached rate information table, so the rates
+    do not have to be loaded to check their status
+    '''
+    supported = set(rateInfo.loc[
+        rateInfo['supportReason'] == RateReason.SUPPORTED.value, 'id'])
+    return [i for i in ids if i in supported]
+
 ################## Rate Selection Functions ####################################
-def filterRates(filtertype, rateFiltered, rates):
+def filterIds(filtertype, rateFiltered, rates):
     ''''
     'All Filtered Rates'
     'Filtered Residential Rates',
     'Filtered Commercial Rates',
     'Filtered Industrial Rates',
     'All Rates in URDB'
+
+    returns the ids of the rates in a rate set. rateFiltered is the filtered
+    rate set (see filteredRates). With the sqlite cache (rates is a
+    RateStore) the ids are read from the rate information table without
+    loading the rates
     '''
 
     if filtertype == 'All Filtered Rates':
-        filterset = rateFiltered['label'].tolist()
-        # rates in dictionary rates where key is in filterset
-        rates = {key: rates[key] for key in filterset}
-    elif filtertype == 'Filtered Residential Rates':
-        filterset = (rateFiltered[
-            rateFiltered['sector'] == 'Residential']['label']
+        return rateFiltered['label'].tolist()
+    elif filtertype in filterSectors:
+        return (rateFiltered[
+            rateFiltered['sector'] == filterSectors[filtertype]]['label']
             .tolist())
-        rates = {key: rates[key] for key in filterset}
-    elif filtertype == 'Filtered Commercial Rates':
-        filterset = (rateFiltered[
-            rateFiltered['sector'] == 'Commercial']['label']
-            .tolist())
-        rates = {key: rates[key] for key in filterset}
-    elif filtertype == 'Filtered Industrial Rates': 
-        filterset = (rateFiltered[
-            rateFiltered['sector'] == 'Industrial']['label']
-            .tolist())
-        rates = {key: rates[key] for key in filterset}
+    elif isinstance(rates, RateStore):
+        return rates.selectIds(filtertype)
+    else:
+        return list(rates)
+
+# ----------------------------------------------------------------
+
+def filterRates(filtertype, rateFiltered, rates):
+    '''
+    returns the rates of a rate set (see filterIds). With the sqlite cache
+    (rates is a RateStore) the rates are loaded with indexed queries
+    '''
+
+    if filtertype in filterSectors or filtertype == 'All Filtered Rates':
+        # rates in dictionary rates where key is in filterset
+        return getRates(rates, filterIds(filtertype, rateFiltered, rates))
+    elif isinstance(rates, RateStore):
+        return rates.select(filtertype)
     else:
-        pass
+        return rates
+
+# ----------------------------------------------------------------
+
+def buildDemandIndex(rateInfo):
+    '''
+    builds an interval index over the demand range (demandMin to demandMax,
+    in kW) of each rate for the applicability filter. Rates are sorted by
+    demandMin so the rates that can apply to a peak demand are found with a
+    binary search (see applicableRates). Missing limits (and a demandMax of
+    zero or less) are treated as no limit.
+
+    returns a dictionary of arrays: ids, min and max
+    '''
+    low = pd.to_numeric(rateInfo['demandMin'], errors='coerce').to_numpy(float)
+    high = pd.to_numeric(rateInfo['demandMax'], errors='coerce').to_numpy(float)
 
-    return rates
+    low = np.where(np.isnan(low), -np.inf, low)
+    high = np.where(np.isnan(high) | (high <= 0), np.inf, high)
+
+    order = np.argsort(low, kind='stable')
+    return {'ids': rateInfo['id'].to_numpy()[order],
+            'min': low[order],
+            'max': high[order]}
+
+# ----------------------------------------------------------------
+
+def applicableRates(demandIndex, peak):
+    '''
+    returns the set of rate ids whose demand range contains the peak demand
+    (kW) of a profile (see getMaxPower)
+    '''
+    n = np.searchsorted(demandIndex['min'], peak, side='right')
+    return set(demandIndex['ids'][:n][demandIndex['max'][:n] >= peak])
 
 # ----------------------------------------------------------------    
+
+# number of rates in each leaf block of the date index (see buildDateIndex),
+# and the dates used for a missing startdate or enddate
+dateBlock = 64
+dateMin = np.datetime64('1677-09-22', 'ns')
+dateMax = np.datetime64('2262-04-11', 'ns')
+
+def buildDateIndex(rateInfo):
+    '''
+    builds an interval index over the effective dates (startdate to enddate)
+    of each rate for as-of-date rate selection. Rates are sorted by startdate
+    and split into blocks of dateBlock rates, and a max-end tree over the
+    blocks records the latest enddate below each node, so the rates in effect
+    on a date are found in logarithmic time plus the number of rates returned
+    (see effectiveRates). A missing startdate is treated as always in effect
+    before the enddate and a missing enddate as still in effect.
+
+    returns a dictionary of arrays: ids, start and end (datetime64) and
+    maxEnd (the max-end tree, node 1 is the root and node i has children
+    2i and 2i+1)
+    '''
+    low = pd.to_datetime(rateInfo['startdate']).to_numpy('datetime64[ns]')
+    high = pd.to_datetime(rateInfo['enddate']).to_numpy('datetime64[ns]')
+
+    low = np.where(np.isnat(low), dateMin, low)
+    high = np.where(np.isnat(high), dateMax, high)
+
+    order = np.argsort(low, kind='stable')
+    high = high[order]
+
+    # the leaves of the tree are the blocks of rates, padded to a power of two
+    blocks = -(-len(high) // dateBlock)
+    size = 1 << max(blocks - 1, 0).bit_length()
+    padded = np.full(size * dateBlock, dateMin)
+    padded[:len(high)] = high
+
+    maxEnd = np.full(2 * size, dateMin)
+    maxEnd[size:] = padded.reshape(size, dateBlock).max(axis=1)
+    level = size // 2
+    while level:
+        maxEnd[level:2 * level] = np.maximum(maxEnd[2 * level:4 * level:2],
+                                             maxEnd[2 * level + 1:4 * level:2])
+        level //= 2
+
+    return {'ids': rateInfo['id'].to_numpy()[order],
+            'start': low[order],
+            'end': high,
+            'maxEnd': maxEnd}
+
+# ----------------------------------------------------------------
+
+def asOfDates(asOf):
+    '''
+    helper function that converts an as-of date (anything pd.Timestamp
+    reads, e.g. '2021-06-30') or a (start, end) pair of dates to a pair of
+    datetime64 values. An end date without a time of day (midnight) means
+    the end of that day, so a single date is a range of one day and rates
+    that start later on that day are included. Raises ValueError for invalid
+    dates
+    '''
+    if isinstance(asOf, (list, tuple)):
+        if len(asOf) != 2:
+            raise ValueError('an as-of date range must be a (start, end) pair')
+        start, end = asOf
+    else:
+        start = end = asOf
+
+    try:
+        start, end = pd.Timestamp(start), pd.Timestamp(end)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f'invalid as-of date ({e})')
+    if pd.isnull(start) or pd.isnull(end) or end < start:
+        raise ValueError('as-of dates must be valid with start before end')
+
+    if end == end.normalize():
+        end = end + pd.Timedelta(days=1) - pd.Timedelta(1, 'ns')
+
+    return (start.to_datetime64().astype('datetime64[ns]'),
+            end.to_datetime64().astype('datetime64[ns]'))
+
+# ----------------------------------------------------------------
+
+def effectiveRates(dateIndex, asOf):
+    '''
+    returns the set of rate ids in effect on an as-of date, or at any time
+    in an as-of date range (see asOfDates): rates that start on or before
+    the end of the range and end on or after its start.
+
+    A binary search on the sorted start dates finds the rates that start in
+    time, and the max-end tree (see buildDateIndex) skips every block of
+    rates that all ended before the range, so only blocks holding at least
+    one rate in effect are checked
+    '''
+    start, end = asOfDates(asOf)
+    n = np.searchsorted(dateIndex['start'], end, side='right')
+    maxEnd = dateIndex['maxEnd']
+
+    found = []
+    stack = [(1, 0, len(maxEnd) // 2)]
+    while stack:
+        node, first, width = stack.pop()
+        if first * dateBlock >= n or maxEnd[node] < start:
+            continue
+        if width == 1:
+            a, b = first * dateBlock, min((first + 1) * dateBlock, n)
+            found.append(dateIndex['ids'][a:b][dateIndex['end'][a:b] >= start])
+        else:
+            width //= 2
+            stack += [(2 * node, first, width),
+                      (2 * node + 1, first + width, width)]
+
+    return set(np.concatenate(found)) if found else set()
+
+# ----------------------------------------------------------------
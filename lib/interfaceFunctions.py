@@ -26,6 +26,17 @@ import lib.outputFunctions as out
 
 ######################### MENUS ###############################################3
 
+class ReturnToMenu(Exception):
+    '''
+    raised to leave a submenu or calculator run and go back to the main menu
+    (see exitOrMain). Menus are loops rather than calling each other, so
+    objects from earlier runs are released when control returns to the main
+    menu
+    '''
+
+# -----------------------------------------------------------------------------
+
+
 def mainMenu():
     '''
     main menu for the rate calculator tool. Uses pick to create a menu for 
@@ -34,6 +45,7 @@ def mainMenu():
 
     Main Menu Options are:
         RUN RATE CALCULATOR
+        ADVANCED ANALYSES
         REFRESH CACHE
         OPEN INPUT WORKBOOK
         EXIT
@@ -66,9 +78,15 @@ def mainMenu():
     # main menu loop that will continue to run until the user selects exit
     while True:
 
+        # start loading the rate cache and default input workbook in the
+        # background so they are ready when the user runs the calculator
+        # (the cache is only loaded once per session, see sessionCache)
+        imp.startPreload()
+
         # top level menu
         xInput, i = pick(
             ['RUN RATE CALCULATOR', 
+             'ADVANCED ANALYSES',
              'REFRESH CACHE',
              'OPEN INPUT WORKBOOK', 
              'EXIT'],
@@ -77,32 +95,61 @@ def mainMenu():
         indicator='>> '
         )
 
-        # this could probably be a case statement
-        # if the user selects run rate calculator, call the calcMenu function
-        # to launch the calcMenu submenu.
-        if xInput == 'RUN RATE CALCULATOR':
-            calcMenu()
-
-        # if the user selects refresh cache, call the buildCache function
-        elif xInput == 'REFRESH CACHE':
-            imp.buildCache()
-            logging.info('cache built without error')
-            input('press enter to return to menu')
-
-        # if the user selects open input workbook, call the openExcelFile
-        # function to open the input workbook in excel on the user's machine
-        elif xInput == 'OPEN INPUT WORKBOOK':
-            filepath = selectFile('user_input/')
-            out.openExcelFile(f'user_input/{filepath}')
-            logging.info(f'opened {filepath} without error')
-            input('press enter to return to menu')
-
-        # if the user selects exit, exit the program
-        elif xInput == 'EXIT':
-            print('Exiting program...')
-            logging.info('user exited script without error')
-            time.sleep(2)
-            raise SystemExit
+        try:
+            mainChoice(xInput)
+        except ReturnToMenu:
+            continue
+
+# -----------------------------------------------------------------------------
+
+def mainChoice(xInput):
+    '''
+    runs the main menu option selected by the user. Submenus and runs return
+    here when they finish or raise ReturnToMenu to go back to the main menu
+    '''
+
+    # this could probably be a case statement
+    # if the user selects run rate calculator, call the calcMenu function
+    # to launch the calcMenu submenu.
+    if xInput == 'RUN RATE CALCULATOR':
+        calcMenu()
+
+    # if the user selects advanced analyses, launch the advancedMenu
+    # submenu
+    elif xInput == 'ADVANCED ANALYSES':
+        advancedMenu()
+
+    # if the user selects refresh cache, call the buildCache function. The
+    # cache loaded this session is dropped first so its files can be replaced
+    elif xInput == 'REFRESH CACHE':
+        imp.releaseCache()
+        imp.buildCache()
+        imp.startPreload(restart=True)
+
+        # rates changed since the previous cache (see imp.snapshotDiff)
+        previous = imp.loadFingerprints(imp.previousFingerprintFile)
+        if previous is not None:
+            diff = imp.snapshotDiff(previous['rates'],
+                                    imp.loadFingerprints()['rates'])
+            print('since the previous cache: '
+                  + ', '.join(f'{len(v)} rates {k}' for k, v in diff.items()))
+        logging.info('cache built without error')
+        input('press enter to return to menu')
+
+    # if the user selects open input workbook, call the openExcelFile
+    # function to open the input workbook in excel on the user's machine
+    elif xInput == 'OPEN INPUT WORKBOOK':
+        filepath = selectFile('user_input/')
+        out.openExcelFile(f'user_input/{filepath}')
+        logging.info(f'opened {filepath} without error')
+        input('press enter to return to menu')
+
+    # if the user selects exit, exit the program
+    elif xInput == 'EXIT':
+        print('Exiting program...')
+        logging.info('user exited script without error')
+        time.sleep(2)
+        raise SystemExit
 # -----------------------------------------------------------------------------
 
 
@@ -118,29 +165,8 @@ def calcMenu():
     # calc menu loop that will continue to run until the user selects exit
     while True:
     
-    # user select input file from the input directory.
-        message = '''
-    Do you wish to use the default input file (rate_calculator_input_file.xlsx) 
-    or select a different file from the user_input directory?
-        '''
-        iInputFile, i = pick(
-            ['Default', 'Select'],
-            message,
-            indicator = '>> '
-        )
-
-        if iInputFile == 'Default':
-            iInputFile = 'user_input/rate_calculator_input_file.xlsx'
-
-        elif iInputFile == 'Select':
-            iInputFile = selectFile('user_input/')
-            print(f'You selected {iInputFile}')
-            iInputFile = 'user_input/' + iInputFile
-
-
-    # filter options for the rate calculator, the filter options restrict the
-    # set of rates that are used in the calculator.
-   
+    # user input for the input file, rate set, charging days and curve (see
+    # runInputs). The rate set restricts the rates used in the calculator
         message = '''
     You may select from the following rate sets or subsets to calculate costs 
     Filtered rates are current and easily identified specialty rates have been
@@ -148,42 +174,38 @@ def calcMenu():
 
     Choose 'All rates in URDB if you wish to get all rates (including historical)    
         '''
-        iFilter, i = pick(
-            ['All Filtered Rates',
-            'Filtered Residential Rates',
-            'Filtered Commercial Rates',
-            'Filtered Industrial Rates',
-            'All Rates in URDB'],
-            message,
-            indicator='>> '
-            )
-    
+        iInputFile, iFilter, iDays, iCurve = runInputs(message)
 
-    # user input for the number of days per week that user vehicles will charge
-    # this input is used to determine the overall charging use of the vehicle(s)
+    # user input for the as-of date. Rates that were not in effect during the
+    # selected year are not calculated, for back-casting past costs
         message = '''
-    How many days a week will vehicles charge? The number of days per week will 
-    determine overall charing use.
+    Do you want to calculate rates in effect at any time, or only rates that
+    were in effect during a past year? Use 'All Rates in URDB' for years
+    before this one, filtered rates only include current rates.
         '''
-        iDayString, iDays = pick(
-            ['1 day','2 days','3 days','4 days','5 days','6 days','7 days'],
+        year = int(time.strftime('%Y'))
+        iAsOf, i = pick(
+            ['Any Date'] + [f'In Effect During {y}'
+                            for y in range(year, year - 10, -1)],
             message,
             indicator='>> '
-        )
-        iDays =+ 1
+            )
+        xAsOf = None
+        if i > 0:
+            y = year + 1 - i
+            xAsOf = (f'{y}-01-01', f'{y}-12-31')
 
-    # user input for the power and charging curve to use in the calculator.
-    # if the user selects single, the single power and charging curve will be 
-    # read in from the input file. If the user selects monthly, the monthly
-    # power and charging curve will be read in from the input file.
 
+    # user input for the applicability filter. If the user selects applicable
+    # rates only, rates whose demand range (demandMin to demandMax) does not
+    # contain the peak demand of the input profile are not calculated
         message = '''
-    Would you like to use the single power and charging curve or the monthly
-    power and charging curve? If you have not filled out the input file for your
-    selection you will get an error.
+    Do you want to calculate all rates or only rates that apply to the peak
+    demand (kW) of your input? Rates list the demand range they apply to, rates
+    for much larger (or smaller) customers are left out of the results.
         '''
-        iCurve, i = pick(
-            ['Single', 'Monthly'],
+        iApplicable, i = pick(
+            ['All Rates', 'Applicable Rates Only'],
             message,
             indicator = '>> '
         )
@@ -217,35 +239,44 @@ def calcMenu():
             iOutFile = getValidFilename()
 
         elif iOutFile == 'Use Input Filename':
-            iOutFile = iInputFile[11:-5] + '_output'
+            iOutFile = inputName(iInputFile) + '_output'
 
         elif iOutFile == 'Default':
             iOutFile = 'rate_calculator_output'
     
     # confirm the user's selections before running the calculator
         message = ('you have selected:\n'
-                   f' 1.  Input file: {iInputFile[11:-5]}\n' 
-                   f' 2.  {iFilter}\n'
-                   f' 3.  {iDayString} per week\n'
+                   f' 1.  Input file: {inputName(iInputFile)}\n' 
+                   f' 2.  {iFilter} ({iAsOf})\n'
+                   f' 3.  {iDays} charging days per week\n'
                    f' 4.  {iCurve} input file\n'
-                   f' 5.  Output file: {iOutFile} \n\n'
+                   f' 5.  {iApplicable}\n'
+                   f' 6.  Output file: {iOutFile} \n\n'
                   'Is this correct? Selecting yes will kick off rate calculator.\n'
-                  'Selecting no will let you reselect options. Exiting will return\n'
-                  'you to the main menu.'
+                  'Selecting yes with profiling also times each rate and saves a\n'
+                  'report of slow rates. Selecting yes with hourly attribution\n'
+                  'also saves the cost of each hour and demand period of every\n'
+                  'rate. Selecting no will let you reselect options. Exiting\n'
+                  'will return you to the main menu.'
                   )
 
         xChoice, i = pick(
-        ['Yes', 'No', 'Exit'],
+        ['Yes', 'Yes (with profiling)', 'Yes (with hourly attribution)',
+         'No', 'Exit'],
         message,
         indicator = '>> '
         )
 
-        # if user confirms selections, run the calculator 
-        if xChoice == 'Yes':
+        # if user confirms selections, run the calculator. calcRun ends by
+        # asking to exit or return to the main menu (see exitOrMain)
+        if xChoice in ['Yes', 'Yes (with profiling)',
+                       'Yes (with hourly attribution)']:
             print('running calculator...\n')
-            calc.calcRun(iInputFile, iFilter, iDays, iCurve, iOutFile)
-            input('operation complete, press enter to return to main menu') 
-            mainMenu()
+            calc.calcRun(iInputFile, iFilter, iDays, iCurve, iOutFile,
+                         profile = xChoice == 'Yes (with profiling)',
+                         applicable = iApplicable == 'Applicable Rates Only',
+                         attribution = xChoice == 'Yes (with hourly attribution)',
+                         asOf = xAsOf)
         
         # if user selects no, return to the top of the calcMenu loop
         elif xChoice == 'No':
@@ -257,6 +288,389 @@ def calcMenu():
             exitOrMain('leaving rate calculator...')
     
 
+# -----------------------------------------------------------------------------
+
+def advancedMenu():
+    '''
+    Submenu for analyses that go beyond a single rate calculator run. Returns
+    to the main menu when the user selects MAIN MENU
+
+    Advanced Menu Options are:
+        FLEET (MULTI-SITE) RUN
+        LOAD UNCERTAINTY (MONTE CARLO) RUN
+        MULTI-YEAR PROJECTION
+        MANAGED CHARGING (LOAD SHIFTING)
+        DEMAND CAP SWEEP
+        SAVE SCENARIO
+        SCENARIO DELTA REPORT
+        MAIN MENU
+    '''
+    message = '''
+    Advanced analyses:
+
+    Fleet (multi-site) runs calculate many sites at once, each against the rates
+    of its own utilities. Sites are listed in a fleet manifest (csv or xlsx) in
+    the user_input directory. See the user guide for the manifest format.
+
+    Load uncertainty runs calculate thousands of random variations of your
+    input profile and report the range of likely costs for each rate.
+
+    Multi-year projections estimate costs over 5 to 20 years with rate
+    escalation and load growth, and the net present value of each rate.
+
+    Managed charging runs move charging into the cheapest hours of a charging
+    window for each rate and compare the cost with unmanaged charging.
+
+    Demand cap sweeps show how much capping the site power (e.g. with a power
+    limit or a battery) at several levels would save under each rate.
+
+    Saved scenarios are brought up to date after a cache refresh by
+    recalculating only the rates that changed. The delta report lists the
+    cost change of each added, removed or changed rate.
+    '''
+    while True:
+        xInput, i = pick(
+            ['FLEET (MULTI-SITE) RUN',
+             'LOAD UNCERTAINTY (MONTE CARLO) RUN',
+             'MULTI-YEAR PROJECTION',
+             'MANAGED CHARGING (LOAD SHIFTING)',
+             'DEMAND CAP SWEEP',
+             'SAVE SCENARIO',
+             'SCENARIO DELTA REPORT',
+             'MAIN MENU'],
+            message,
+            indicator='>> '
+        )
+
+        if xInput == 'FLEET (MULTI-SITE) RUN':
+            fleetMenu()
+
+        elif xInput == 'LOAD UNCERTAINTY (MONTE CARLO) RUN':
+            uncertaintyMenu()
+
+        elif xInput == 'MULTI-YEAR PROJECTION':
+            projectionMenu()
+
+        elif xInput == 'MANAGED CHARGING (LOAD SHIFTING)':
+            managedMenu()
+
+        elif xInput == 'DEMAND CAP SWEEP':
+            capSweepMenu()
+
+        elif xInput == 'SAVE SCENARIO':
+            scenarioMenu()
+
+        elif xInput == 'SCENARIO DELTA REPORT':
+            message = '''
+    Do you want to use the default output file name (scenario_delta_output) or
+    create a custom filename to save results to?
+
+    NOTE: The output file will be overwritten if it already exists.
+        '''
+            iOutFile, i = pick(['Default', 'Custom'], message,
+                               indicator='>> ')
+            if iOutFile == 'Custom':
+                iOutFile = getValidFilename()
+            else:
+                iOutFile = 'scenario_delta_output'
+
+            calc.scenarioDeltaRun(iOutFile)
+            input('operation complete, press enter to return to menu')
+
+        elif xInput == 'MAIN MENU':
+            return
+
+# -----------------------------------------------------------------------------
+
+def fleetMenu():
+    '''
+    Submenu for fleet (multi-site) runs. The user selects a fleet manifest,
+    the rate set that sites are matched to and the output file name before
+    fleetRun is called
+    '''
+    iManifest = selectFile('user_input/', ['.csv', '.xlsx'])
+    iManifest = 'user_input/' + iManifest
+
+    message = '''
+    Select the rate set that sites are matched to. Each site is calculated
+    against the rates in this set that belong to its utilities (and sectors).
+        '''
+    iFilter, i = pick(
+        ['All Filtered Rates',
+         'Filtered Residential Rates',
+         'Filtered Commercial Rates',
+         'Filtered Industrial Rates',
+         'All Rates in URDB'],
+        message,
+        indicator='>> '
+    )
+
+    message = '''
+    Do you want to use the default output file name (fleet_output) or create a
+    custom filename to save results to?
+
+    NOTE: The output file will be overwritten if it already exists.
+        '''
+    iOutFile, i = pick(['Default', 'Custom'], message, indicator='>> ')
+
+    if iOutFile == 'Custom':
+        iOutFile = getValidFilename()
+    else:
+        iOutFile = 'fleet_output'
+
+    print('running fleet calculation...\n')
+    calc.fleetRun(iManifest, iFilter, iOutFile)
+    input('operation complete, press enter to return to menu')
+
+# -----------------------------------------------------------------------------
+
+def uncertaintyMenu():
+    '''
+    Submenu for load uncertainty (Monte Carlo) runs. The user selects the
+    input file, rate set, charging days, curve, number of draws, distribution
+    and spread of the hourly energy and power values and the output file name
+    before uncertaintyRun is called
+    '''
+    message = '''
+    Select the rate set to calculate cost ranges for.
+        '''
+    iInputFile, iFilter, iDays, iCurve = runInputs(message)
+
+    message = '''
+    How many random variations (draws) of the profile should be calculated?
+    More draws give steadier results but take longer.
+        '''
+    iDraws, i = pick(['1000', '2000', '5000', '10000'], message,
+                     indicator='>> ')
+    iDraws = int(iDraws)
+
+    message = '''
+    Each hourly energy and power value is multiplied by a random factor with an
+    average of 1. Select the distribution of the factors.
+        '''
+    iDistribution, i = pick(['normal', 'lognormal', 'uniform'], message,
+                            indicator='>> ')
+
+    spreads = ['5%', '10%', '20%', '30%', '50%']
+    message = '''
+    How uncertain are the hourly ENERGY values? (standard deviation, or half
+    width for the uniform distribution, of the factors)
+        '''
+    iEnergySpread, i = pick(spreads, message, indicator='>> ')
+
+    message = '''
+    How uncertain are the hourly PEAK POWER values? Demand charges depend on
+    peak power, so this usually has the most effect on costs.
+        '''
+    iPowerSpread, i = pick(spreads, message, indicator='>> ')
+
+    message = '''
+    Do you want to use the default output file name (uncertainty_output) or
+    create a custom filename to save results to?
+
+    NOTE: The output file will be overwritten if it already exists.
+        '''
+    iOutFile, i = pick(['Default', 'Custom'], message, indicator='>> ')
+
+    if iOutFile == 'Custom':
+        iOutFile = getValidFilename()
+    else:
+        iOutFile = 'uncertainty_output'
+
+    print('running load uncertainty calculation...\n')
+    calc.uncertaintyRun(iInputFile, iFilter, iDays, iCurve, iOutFile,
+                        iDraws, iDistribution,
+                        float(iEnergySpread.strip('%')) / 100,
+                        float(iPowerSpread.strip('%')) / 100)
+    input('operation complete, press enter to return to menu')
+
+# -----------------------------------------------------------------------------
+
+def projectionMenu():
+    '''
+    Submenu for multi-year projections. The user selects the input file,
+    rate set, charging days, curve, number of years, annual energy and demand
+    price escalation, annual load growth, discount rate and the output file
+    name before projectionRun is called
+    '''
+    message = '''
+    Select the rate set to project costs for.
+        '''
+    iInputFile, iFilter, iDays, iCurve = runInputs(message)
+
+    message = '''
+    How many years should costs be projected over?
+        '''
+    iYears, i = pick(['5', '10', '15', '20'], message, indicator='>> ')
+
+    rates = ['0%', '1%', '2%', '3%', '4%', '5%', '7%', '10%']
+    message = '''
+    How much will ENERGY prices (per kWh) rise each year?
+        '''
+    iEnergyEscalation, i = pick(rates, message, indicator='>> ')
+
+    message = '''
+    How much will DEMAND prices (per kW) rise each year?
+        '''
+    iDemandEscalation, i = pick(rates, message, indicator='>> ')
+
+    message = '''
+    How much will the charging load (energy and peak power) grow each year,
+    for example as the fleet grows?
+        '''
+    iLoadGrowth, i = pick(['0%', '2%', '5%', '10%', '15%', '20%', '30%'],
+                          message, indicator='>> ')
+
+    message = '''
+    What discount rate should be used for the net present value of costs?
+        '''
+    iDiscountRate, i = pick(['0%', '3%', '5%', '7%', '10%'], message,
+                            indicator='>> ')
+
+    message = '''
+    Do you want to use the default output file name (projection_output) or
+    create a custom filename to save results to?
+
+    NOTE: The output file will be overwritten if it already exists.
+        '''
+    iOutFile, i = pick(['Default', 'Custom'], message, indicator='>> ')
+
+    if iOutFile == 'Custom':
+        iOutFile = getValidFilename()
+    else:
+        iOutFile = 'projection_output'
+
+    print('running multi-year projection...\n')
+    calc.projectionRun(iInputFile, iFilter, iDays, iCurve, iOutFile,
+                       int(iYears),
+                       *[float(x.strip('%')) / 100 for x in
+                         [iEnergyEscalation, iDemandEscalation, iLoadGrowth,
+                          iDiscountRate]])
+    input('operation complete, press enter to return to menu')
+
+# -----------------------------------------------------------------------------
+
+def managedMenu():
+    '''
+    Submenu for managed charging runs. The user selects the input file, rate
+    set, charging days, curve, charging window, charger power, site power
+    limit and the output file name before managedRun is called
+    '''
+    message = '''
+    Select the rate set to optimize charging for.
+        '''
+    iInputFile, iFilter, iDays, iCurve = runInputs(message)
+
+    hours = [f'{h}:00' for h in range(24)]
+    message = '''
+    When are vehicles plugged in (start of the charging window)?
+        '''
+    iString, iPlugIn = pick(hours, message, indicator='>> ',
+                            default_index=18)
+
+    message = '''
+    When do vehicles leave (end of the charging window)? The window may run
+    past midnight.
+        '''
+    iString, iDeparture = pick(hours, message, indicator='>> ',
+                               default_index=7)
+
+    message = '''
+    What is the charger power? Each hour of the window can take at most this
+    much energy.
+        '''
+    iPower, i = pick(['Input peak power', '7.2 kW', '19.2 kW', '50 kW',
+                      '150 kW', '350 kW', '1000 kW'],
+                     message, indicator='>> ')
+    iPower = None if i == 0 else float(iPower.split()[0])
+
+    message = '''
+    Is there a site power limit? No hour of the managed profile will go above
+    it.
+        '''
+    iCap, i = pick(['No limit', '50 kW', '100 kW', '250 kW', '500 kW',
+                    '1000 kW', '2500 kW'],
+                   message, indicator='>> ')
+    iCap = None if i == 0 else float(iCap.split()[0])
+
+    message = '''
+    Do you want to use the default output file name (managed_output) or
+    create a custom filename to save results to?
+
+    NOTE: The output file will be overwritten if it already exists.
+        '''
+    iOutFile, i = pick(['Default', 'Custom'], message, indicator='>> ')
+
+    if iOutFile == 'Custom':
+        iOutFile = getValidFilename()
+    else:
+        iOutFile = 'managed_output'
+
+    print('running managed charging optimization...\n')
+    calc.managedRun(iInputFile, iFilter, iDays, iCurve, iOutFile, iPlugIn,
+                    iDeparture, iPower, iCap)
+    input('operation complete, press enter to return to menu')
+
+# -----------------------------------------------------------------------------
+
+def capSweepMenu():
+    '''
+    Submenu for demand cap sweeps. The user selects the input file, rate set,
+    charging days, curve, cap levels and the output file name before
+    capSweepRun is called
+    '''
+    message = '''
+    Select the rate set to calculate demand caps for.
+        '''
+    iInputFile, iFilter, iDays, iCurve = runInputs(message)
+
+    message = '''
+    Which power caps should be calculated? Caps are shares of the peak power
+    of the input profile.
+        '''
+    iSteps, i = pick(['90% to 10% in 10% steps', '95% to 50% in 5% steps',
+                      '98% to 80% in 2% steps'],
+                     message, indicator='>> ')
+    iShares = [x / 100 for x in [range(90, 9, -10), range(95, 49, -5),
+                                 range(98, 79, -2)][i]]
+
+    message = '''
+    Do you want to use the default output file name (demand_cap_output) or
+    create a custom filename to save results to?
+
+    NOTE: The output file will be overwritten if it already exists.
+        '''
+    iOutFile, i = pick(['Default', 'Custom'], message, indicator='>> ')
+
+    if iOutFile == 'Custom':
+        iOutFile = getValidFilename()
+    else:
+        iOutFile = 'demand_cap_output'
+
+    print('running demand cap sweep...\n')
+    calc.capSweepRun(iInputFile, iFilter, iDays, iCurve, iOutFile, iShares)
+    input('operation complete, press enter to return to menu')
+
+# -----------------------------------------------------------------------------
+
+def scenarioMenu():
+    '''
+    Submenu for saving a scenario. The user selects the input file, rate set,
+    charging days, curve and the scenario name before scenarioSaveRun is
+    called
+    '''
+    message = '''
+    Select the rate set of the scenario.
+        '''
+    iInputFile, iFilter, iDays, iCurve = runInputs(message)
+
+    print('\nenter a name for the scenario. A saved scenario with the same '
+          'name is replaced.')
+    iName = getValidFilename()
+
+    calc.scenarioSaveRun(iInputFile, iFilter, iDays, iCurve, iName)
+    input('operation complete, press enter to return to menu')
+
 ############################# USER PROMPTS #####################################
 
 def exitOrMain(passedMessage):
@@ -273,11 +687,72 @@ def exitOrMain(passedMessage):
         time.sleep(2)
         raise SystemExit
     elif xExit == 'MAIN MENU':
-        mainMenu()
+        raise ReturnToMenu
+# ------------------------------------------------------------------------------
+def runInputs(message):
+    '''
+    asks for the inputs every calculator run needs: the input file, the rate
+    set (message is the rate set prompt), the number of charging days per week
+    and the power and charging curve. Returns (iInputFile, iFilter, iDays,
+    iCurve)
+    '''
+    # user select input file from the input directory.
+    fileMessage = '''
+    Do you wish to use the default input file (rate_calculator_input_file.xlsx)
+    or select a different file from the user_input directory?
+        '''
+    iInputFile, i = pick(['Default', 'Select'], fileMessage, indicator='>> ')
+
+    if iInputFile == 'Default':
+        iInputFile = imp.defaultInput
+    else:
+        iInputFile = selectFile('user_input/')
+        print(f'You selected {iInputFile}')
+        iInputFile = 'user_input/' + iInputFile
+
+    # filter options restrict the set of rates that are used in the calculator
+    iFilter, i = pick(
+        ['All Filtered Rates',
+         'Filtered Residential Rates',
+         'Filtered Commercial Rates',
+         'Filtered Industrial Rates',
+         'All Rates in URDB'],
+        message,
+        indicator='>> '
+    )
+
+    # the number of days per week determines the overall charging use
+    daysMessage = '''
+    How many days a week will vehicles charge? The number of days per week will 
+    determine overall charing use.
+        '''
+    iDayString, i = pick(
+        ['1 day','2 days','3 days','4 days','5 days','6 days','7 days'],
+        daysMessage,
+        indicator='>> '
+    )
+    iDays = i + 1
+
+    # profile files (csv, parquet, npy) hold a single or monthly curve so the
+    # question is only asked for input workbooks
+    if os.path.splitext(iInputFile)[1].lower() in imp.profileTypes:
+        iCurve = 'Profile'
+    else:
+        curveMessage = '''
+    Would you like to use the single power and charging curve or the monthly
+    power and charging curve? If you have not filled out the input file for your
+    selection you will get an error.
+        '''
+        iCurve, i = pick(['Single', 'Monthly'], curveMessage, indicator='>> ')
+
+    return iInputFile, iFilter, iDays, iCurve
+
 # ------------------------------------------------------------------------------
-def selectFile(dir):
+def selectFile(dir, types=None):
     '''
-    provide a list of files in the directory and ask the user to select one
+    provide a list of files in the directory and ask the user to select one.
+    types is the list of file extensions to show (input workbooks and
+    profile files by default)
 
     to do:
         - read in and verify the file here instead of in the calc module
@@ -285,18 +760,29 @@ def selectFile(dir):
     
     title = '''
     Select an input file from the user_input directory below. Selected file must
-    be a filled copy of the rate_calculator_input_file.xlsx file otherwise you
-    will get an error.
+    be a filled copy of the rate_calculator_input_file.xlsx file or a load
+    profile file (csv, parquet or npy) otherwise you will get an error.
     
     If your file does not appear in this list, click exit return to the main menu. 
     verify that your file is in the correct directory and has the proper extension
-    (xlsx) and try again.
+    (xlsx, csv, parquet or npy) and try again.
+    '''
+
+    if types is None:
+        types = ['.xlsx'] + imp.profileTypes
+    else:
+        extensions = ', '.join(i.strip('.') for i in types)
+        title = f'''
+    Select a file from the {dir} directory below ({extensions}).
+
+    If your file does not appear in this list, click exit return to the main menu.
     '''
 
     # get a list of files in the directory
     options = os.listdir(dir)
-    # remove any files that are not xlsx files
-    options = [x for x in options if x.endswith('.xlsx')]
+    # remove any files that are not of the listed types
+    options = [x for x in options
+               if os.path.splitext(x)[1].lower() in types]
 
     options.append('Exit')
     option, index = pick(options, title)
@@ -304,6 +790,13 @@ def selectFile(dir):
         exitOrMain('leaving file selection...')
     return option
 
+# ------------------------------------------------------------------------------
+def inputName(inputfile):
+    '''
+    returns the name of an input file without its directory or extension
+    '''
+    return os.path.splitext(os.path.basename(inputfile))[0]
+
 # ------------------------------------------------------------------------------
 def askOpenFile(filepath):
     '''
@@ -10,6 +10,12 @@ Built by Atlas Public Policy in Washington, DC
 from alive_progress import alive_it
 import pandas as pd
 import numpy as np
+import xlsxwriter
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+import secrets
+import json
 import time
 import os
 
@@ -67,7 +73,7 @@ def processOutput(output, total_energy):
 # ------------------------------------------------------------------------------
 
 
-def toDataFrame(output, rates):
+def toDataFrame(output, rateInfo):
 
     '''
     This function takes the output dictionary and converts it to a dataframe
@@ -82,33 +88,25 @@ def toDataFrame(output, rates):
 
 # ------------------------------------------------------------------------------
 
-def addRateInfo(df, rates):
+def addRateInfo(df, rateInfo):
     '''
     This function takes the output dataframe and adds in the rate information
-    from the rates dictionary
-
-    note: Candidate for reengineering: This is not the best way to manage the
-    data. It would be better to have a separate dataframe for the rate information
-    that can be cached and pulled in here. This would avoid the need to pass
-    so much data around in the rates dictionary. 
+    from the cached rate information table (see buildCache)
     '''
 
     # details dictionary
     details = ['id', 'rateName', 'utilityName', 'eiaId', 'sector', 
                'fixedChargeFirstMeter', 'sourceReference', 'description',
-                 'demandMax', 'demandMin']
-    
-    detailsDF = pd.DataFrame.from_dict(rates, orient='index').reset_index()
-    detailsDF = detailsDF[details]
+                 'demandMax', 'demandMin', 'supportReason']
 
     # add details to the output dataframe
-    df = df.merge(detailsDF, left_on='id', right_on='id', how='left')
+    df = df.merge(rateInfo[details], left_on='id', right_on='id', how='left')
 
     return df
 
 # ------------------------------------------------------------------------------
 
-def createSummaries(df, rates):
+def createSummaries(df, rateInfo):
     '''
     pass in the output dataframe and get back two dataframes, one with the
     results in a long format with one row per month, (indexed to the id) and
@@ -124,7 +122,8 @@ def createSummaries(df, rates):
                  'FlatDemandCharge', 'TOUDemandCharge','totalCost',
                  'costPerkWH']]
         
-    summarydf = (df.groupby(['id', 'rateSupported', 'rateName', 'utilityName', 
+    summarydf = (df.groupby(['id', 'rateSupported', 'supportReason',
+                             'rateName', 'utilityName', 
                              'eiaId', 'sector', 'fixedChargeFirstMeter',
                              'sourceReference', 'description', 'demandMax',
                              'demandMin'])
@@ -144,6 +143,38 @@ def createSummaries(df, rates):
 
 # ------------------------------------------------------------------------------
 
+def createProfileReport(profile, rateInfo):
+    '''
+    takes the profile records from calcRun's profiling mode and returns a
+    dataframe of rates ranked from slowest to fastest evaluation time with
+    their structure and rate details.
+
+    rates are flagged as outliers if their evaluation time is above the upper
+    outer fence (Q3 + 3 * IQR) of all evaluation times. timeVsMedian shows how
+    many times slower than the median rate each rate is.
+    '''
+
+    df = pd.DataFrame.from_dict(profile, orient='index')
+    df['id'] = df.index
+
+    # add rate name and utility so slow rates can be identified at a glance
+    df = df.merge(rateInfo[['id', 'rateName', 'utilityName']],
+                  on='id', how='left')
+
+    # rank rates by evaluation time
+    df = df.sort_values('evalTimeMs', ascending=False)
+    df['rank'] = range(1, len(df) + 1)
+
+    # flag outliers
+    q1, median, q3 = df['evalTimeMs'].quantile([0.25, 0.5, 0.75])
+    df['timeVsMedian'] = df['evalTimeMs'] / median if median > 0 else np.nan
+    df['outlier'] = df['evalTimeMs'] > q3 + 3 * (q3 - q1)
+
+    return df[['rank', 'id', 'rateName', 'utilityName', 'evalTimeMs', 'timeVsMedian', 'outlier', 'components',
+               'nrgPeriods', 'demandPeriods', 'nrgTiers', 'demandFlatTiers']]
+
+# ------------------------------------------------------------------------------
+
 def write2ExcelTables(filename, dfs, sheet_names):
     '''
     This function takes a list of dataframes and writes them to an excel file
@@ -169,7 +200,7 @@ def write2ExcelTables(filename, dfs, sheet_names):
             
         if i == 9:  
             input('file inaccessible...press enter to exit to main menu')
-            itf.exitOrMain()
+            itf.exitOrMain(f'could not write {filename}...')
 
     iter = alive_it(zip(dfs, sheet_names), title='Writing data')
 
@@ -211,6 +242,256 @@ def write2ExcelTables(filename, dfs, sheet_names):
 
 # ------------------------------------------------------------------------------
 
+def openExcelStream(filename, sheet_names):
+    '''
+    opens an output workbook that results are written to in chunks (see
+    appendExcelRows and closeExcelStream). The workbook is written in
+    xlsxwriter's constant memory mode, so rows are flushed to disk as they
+    are written and memory use does not grow with the size of the results.
+
+    returns a dictionary with the workbook, its worksheets and the next row
+    and columns of each sheet
+    '''
+    filename = f'results/{filename}.xlsx'
+    workbook = xlsxwriter.Workbook(filename, {'constant_memory': True})
+
+    return {'filename': filename,
+            'workbook': workbook,
+            'sheets': {i: workbook.add_worksheet(i) for i in sheet_names},
+            'rows': {i: 0 for i in sheet_names},
+            'columns': {}}
+
+# ------------------------------------------------------------------------------
+
+def cellValue(value):
+    '''
+    helper function that converts a dataframe value for xlsxwriter. Missing
+    values are left blank (as in to_excel) and numpy values are converted to
+    python values
+    '''
+    if pd.isna(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+# ------------------------------------------------------------------------------
+
+def appendExcelRows(stream, sheet, df):
+    '''
+    appends the rows of a dataframe to a sheet of an output workbook opened
+    with openExcelStream. The header row is written with the first chunk and
+    later chunks are written in the same column order
+    '''
+    worksheet = stream['sheets'][sheet]
+
+    if sheet not in stream['columns']:
+        stream['columns'][sheet] = list(df.columns)
+        worksheet.write_row(0, 0, stream['columns'][sheet])
+        stream['rows'][sheet] = 1
+
+    for row in df[stream['columns'][sheet]].itertuples(index=False):
+        worksheet.write_row(stream['rows'][sheet], 0,
+                            [cellValue(i) for i in row])
+        stream['rows'][sheet] += 1
+
+# ------------------------------------------------------------------------------
+
+def closeExcelStream(stream):
+    '''
+    formats and saves an output workbook opened with openExcelStream. Tables
+    are not available in constant memory mode, so each sheet gets a header
+    filter and a frozen header row instead (column widths are set as in
+    write2ExcelTables)
+    '''
+    for sheet, columns in stream['columns'].items():
+        worksheet = stream['sheets'][sheet]
+        worksheet.autofilter(0, 0, stream['rows'][sheet] - 1, len(columns) - 1)
+        worksheet.freeze_panes(1, 0)
+        for idx, col in enumerate(columns):
+            worksheet.set_column(idx, idx, len(str(col)) + 2)
+
+    filename = stream['filename']
+    for i in range(10):
+        try:
+            stream['workbook'].close()
+            break
+        except xlsxwriter.exceptions.FileCreateError:
+            print('Error writing to file, file is open or inaccessible')
+            input(f'try closing {filename} and press enter to continue')
+            time.sleep(3)
+
+        if i == 9:
+            input('file inaccessible...press enter to exit to main menu')
+            itf.exitOrMain('could not save results...')
+
+    print(f'results saved in {filename}\n')
+    return filename
+
+# ------------------------------------------------------------------------------
+
+def openParquetStream(filename):
+    '''
+    opens a parquet file that rows are appended to in chunks (see
+    appendParquetRows and closeParquetStream). The file is created when the
+    first chunk is written, with the columns of that chunk
+    '''
+    return {'filename': filename, 'writer': None, 'rows': 0}
+
+# ------------------------------------------------------------------------------
+
+def appendParquetRows(stream, df):
+    '''
+    appends the rows of a dataframe to a parquet file opened with
+    openParquetStream
+    '''
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if stream['writer'] is None:
+        stream['writer'] = pq.ParquetWriter(stream['filename'], table.schema)
+    stream['writer'].write_table(table)
+    stream['rows'] += len(df)
+
+# ------------------------------------------------------------------------------
+
+def closeParquetStream(stream):
+    '''
+    closes a parquet file opened with openParquetStream
+    '''
+    if stream['writer'] is not None:
+        stream['writer'].close()
+    return stream['filename']
+
+# ------------------------------------------------------------------------------
+
+# accumulated results of calculator runs (see openResultsRun). Monthly results
+# are saved as parquet partitioned by runId, scenario and sector and the
+# manifest lists the inputs of each finished run, one json line per run
+storeDir = 'results/store/data'
+storeManifest = 'results/store/runs.jsonl'
+storePartitioning = ds.partitioning(pa.schema([('runId', pa.string()),
+                                               ('scenario', pa.string()),
+                                               ('sector', pa.string())]),
+                                    flavor='hive')
+
+# monthly result columns saved in the store, with the rate details added to
+# them (see appendResults)
+storeColumns = ['id', 'rateSupported', 'month', 'TieredEnergyCharge',
+                'TOUEnergyCharge', 'FlatDemandCharge', 'TOUDemandCharge',
+                'totalCost', 'costPerkWH']
+storeDetails = ['rateName', 'utilityName', 'eiaId', 'sector']
+
+# ------------------------------------------------------------------------------
+
+def openResultsRun(scenario, inputs):
+    '''
+    starts a run in the results store. scenario is the name the run is
+    stored under (the output file name for calcRun) and inputs a dictionary
+    of the run inputs saved in the manifest when the run is finished (see
+    closeResultsRun)
+    '''
+    runId = (time.strftime('%Y%m%d-%H%M%S')
+             + f'-{os.getpid()}-{secrets.token_hex(2)}')
+    return {'runId': runId, 'scenario': scenario, 'inputs': inputs,
+            'parts': 0, 'rows': 0}
+
+# ------------------------------------------------------------------------------
+
+def appendResults(run, longdf, rateInfo):
+    '''
+    appends the monthly results (long dataframe) of a run, or a chunk of a
+    run, to the results store. Rate details are added from the rate
+    information table and rates without a sector are stored as Unknown.
+    Files are only added to the store, existing files are never changed
+    '''
+    df = longdf[storeColumns].copy()
+    details = rateInfo.set_index('id')[storeDetails]
+    df = df.join(details, on='id')
+
+    for c in ['rateName', 'utilityName', 'sector']:
+        df[c] = df[c].map(lambda x: x if isinstance(x, str) else None)
+    df['sector'] = df['sector'].fillna('Unknown')
+    df['eiaId'] = pd.to_numeric(df['eiaId'].where(df['eiaId'] != False),
+                                errors='coerce')
+    df['month'] = df['month'].astype(np.int8)
+    for c in storeColumns[3:]:
+        df[c] = df[c].astype(float)
+    df['runId'] = run['runId']
+    df['scenario'] = run['scenario']
+
+    ds.write_dataset(pa.Table.from_pandas(df, preserve_index=False),
+                     storeDir, format='parquet',
+                     partitioning=storePartitioning,
+                     basename_template=f'part-{run["parts"]}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore')
+    run['parts'] += 1
+    run['rows'] += len(df)
+
+# ------------------------------------------------------------------------------
+
+def closeResultsRun(run):
+    '''
+    records a finished run in the store manifest. Results of runs that are
+    not in the manifest (e.g. a run that failed part way) are left out of
+    queries (see apiFunctions.queryResults)
+    '''
+    os.makedirs(os.path.dirname(storeManifest), exist_ok=True)
+    entry = {'runId': run['runId'], 'scenario': run['scenario'],
+             'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+             'rows': run['rows'], **run['inputs']}
+    with open(storeManifest, 'a') as f:
+        f.write(json.dumps(entry, default=str) + '\n')
+    return run['runId']
+
+# ------------------------------------------------------------------------------
+
+def energyAttribution(ids, hourly, energy, days):
+    '''
+    hourly TOU energy cost attribution of one profile as a dataframe with one
+    row per rate, month, day type and hour.
+
+    ids: n rate ids
+    hourly: n x 2 x 12 x 24 TOU energy cost (see calculatorFunctions.batchCalc)
+    energy, days: the profile's 12 x 24 energy and 2 x 12 days per month
+    '''
+    n = len(ids)
+    use = np.asarray(energy)[None] * np.asarray(days)[:, :, None]
+
+    return pd.DataFrame({
+        'id': np.repeat(ids, 2 * 12 * 24),
+        'dayType': np.tile(np.repeat(['weekday', 'weekend'], 12 * 24), n),
+        'month': np.tile(np.repeat(np.arange(1, 13, dtype=np.int8), 24), 2 * n),
+        'hour': np.tile(np.arange(24, dtype=np.int8), 2 * 12 * n),
+        'energy': np.tile(use.ravel(), n),
+        'touEnergyCost': hourly.ravel()})
+
+# ------------------------------------------------------------------------------
+
+def demandAttribution(ids, peaks, hours, cost, prices):
+    '''
+    TOU demand cost attribution of one profile as a dataframe with one row per
+    rate, month and TOU demand period the rate has in that month, with the
+    period's price (periodPrice, $/kW).
+
+    Periods are the distinct demand prices of each rate (see
+    inputFunctions.compileTOU), so period is an index ordered by price from
+    0 (the lowest price), not the URDB period number. URDB periods with the
+    same price are one period here.
+
+    ids: n rate ids
+    peaks, hours, cost: n x 12 x G peak power, hour of the peak and demand
+                        charge of each period (see demandTOUPeriods)
+    prices: n x G price of each period
+    '''
+    n, m, g = np.nonzero(~np.isnan(peaks))
+
+    return pd.DataFrame({'id': np.asarray(ids)[n],
+                         'month': (m + 1).astype(np.int8),
+                         'period': g.astype(np.int16),
+                         'periodPrice': np.asarray(prices)[n, g],
+                         'peakPower': peaks[n, m, g],
+                         'peakHour': hours[n, m, g],
+                         'touDemandCost': cost[n, m, g]})
+
+# ------------------------------------------------------------------------------
+
 def openExcelFile(filepath):
 
     '''
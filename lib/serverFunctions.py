@@ -0,0 +1,311 @@
+'''
+serverFunctions.py is a module of the rate calculator tool. It contains the
+functions used to run the calculator as a local HTTP/JSON service. The service
+loads the rate cache once, keeps the supported rates stacked in memory for the
+batch calculator and reloads them when the cache files change.
+
+Requests that arrive at the same time are grouped by their rate selection and
+calculated together in a single batchCalc call.
+
+functions are split into:
+    - rate store functions
+    - request batching functions
+    - request handling functions
+
+Endpoints:
+    GET  /status     - number of rates loaded and when they were loaded
+    POST /calculate  - monthly costs for a load profile, with a JSON body of
+        energy      - 24 or 12 x 24 hourly average energy (kWh)
+        power       - 24 or 12 x 24 hourly peak power (kW)
+        chargeDays  - charging days per week (1-7)
+        rates       - optional rate selection criteria:
+                      filter (a calculator rate set, default
+                      'All Filtered Rates'), ids, sector, eiaId, utility,
+                      asOf (a date or [start, end] dates the rates were in
+                      effect)
+
+Built by Atlas Public Policy in Washington, DC
+2023
+'''
+
+# external dependencies
+import numpy as np
+import http.server
+import threading
+import queue
+import json
+import time
+import os
+import logging
+
+# internal dependencies
+import lib.inputFunctions as imp
+import lib.calculatorFunctions as calc
+import lib.apiFunctions as api
+
+# requests that arrive within batchWindow seconds of the first request in a
+# batch are calculated together (up to maxBatch requests)
+batchWindow = 0.01
+maxBatch = 256
+
+# rate store shared by all requests. It is only replaced by the batch worker
+# thread (see batchWorker), with a single assignment so request threads see
+# either the old or the new store, never a mix of the two (see loadStore)
+store = {}
+
+# queue of requests waiting to be calculated
+jobs = queue.Queue()
+
+########################## RATE STORE FUNCTIONS ################################
+
+def cacheMtimes():
+    '''
+    returns the modification times of the cache files and manifest
+    '''
+    return {i: os.path.getmtime(i)
+            for i in imp.cachePaths() + [imp.manifestFile()]}
+
+# ------------------------------------------------------------------------------
+
+def loadStore():
+    '''
+    loads the rate cache into the store and stacks the supported rates for the
+    batch calculator (see apiFunctions.loadRates). Selections from the
+    previous cache are dropped. The new store is built in full and then
+    swapped in, so requests never read a partly loaded store
+    '''
+    global store
+
+    mtimes = cacheMtimes()
+    rates = api.loadRates()
+
+    store = {**rates,
+             'selections': {},
+             'mtimes': mtimes,
+             'loaded': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+    logging.info(f'rate store loaded: {len(rates["cache"]["rates"])} rates, '
+                 f'{len(rates["batch"]["ids"])} supported')
+
+# ------------------------------------------------------------------------------
+
+def checkReload():
+    '''
+    reloads the store if the cache files have changed since they were loaded.
+    If the cache cannot be read (e.g. it does not match its manifest) the
+    current store is kept and the reload is tried again on the next batch.
+    loadCache waits while a cache build is replacing the files
+    '''
+    try:
+        if cacheMtimes() != store['mtimes']:
+            print('cache files changed, reloading rates...')
+            loadStore()
+    except Exception as e:
+        logging.warning(f'could not reload rate cache ({e})')
+
+# ------------------------------------------------------------------------------
+
+def selectRates(criteria):
+    '''
+    resolves rate selection criteria (see apiFunctions.selectRates) to a list
+    of rate ids and the positions of the supported ones in the stacked batch.
+    Selections are kept in the store so repeated criteria are only resolved
+    once per cache load and filter file (see inputFunctions.filteredRates).
+    '''
+    key = json.dumps([criteria, imp.filterKey()], sort_keys=True)
+    if key not in store['selections']:
+        ids = api.selectRates(store, criteria)
+        store['selections'][key] = ids, api.ratePositions(store, ids)
+
+    return store['selections'][key]
+
+######################## REQUEST BATCHING FUNCTIONS ############################
+
+def batchWorker():
+    '''
+    worker thread that takes requests off the queue and calculates them in
+    batches. After the first request arrives, further requests are collected
+    for batchWindow seconds (or until maxBatch requests are waiting)
+    '''
+    while True:
+        batch = [jobs.get()]
+        deadline = time.monotonic() + batchWindow
+
+        while len(batch) < maxBatch:
+            try:
+                batch.append(jobs.get(timeout=max(0, deadline
+                                                  - time.monotonic())))
+            except queue.Empty:
+                break
+
+        runJobs(batch)
+
+# ------------------------------------------------------------------------------
+
+def runJobs(batch):
+    '''
+    calculates a batch of requests. Requests with the same rate selection are
+    stacked into one batchCalc call. Each request gets its result (or error)
+    and is marked done
+    '''
+    checkReload()
+
+    groups = {}
+    for job in batch:
+        key = json.dumps(job['criteria'], sort_keys=True)
+        groups.setdefault(key, []).append(job)
+
+    for group in groups.values():
+        try:
+            ids, index = selectRates(group[0]['criteria'])
+            output = calc.batchCalc(store['batch'],
+                                    [i['energy'] for i in group],
+                                    [i['power'] for i in group],
+                                    [i['days'] for i in group],
+                                    index)
+            for p, job in enumerate(group):
+                job['result'] = formatResult(output, p, ids, index, job)
+
+        except Exception as e:
+            logging.exception(e)
+            for job in group:
+                job['error'] = str(e)
+
+        finally:
+            for job in group:
+                job['done'].set()
+
+# ------------------------------------------------------------------------------
+
+def formatResult(output, p, ids, index, job):
+    '''
+    converts the batchCalc output for profile p into the JSON response:
+    monthly costs by component, total cost and cost per kWh for each selected
+    rate. Unsupported rates are listed with their supportReason
+    '''
+    batchIds = [store['batch']['ids'][i] for i in index]
+    total_energy = np.asarray(calc.nrgUse(job['energy'], job['days']))
+
+    costs = {c: output[c][p] for c in calc.components}
+    totalCost = sum(costs.values())
+    with np.errstate(divide='ignore', invalid='ignore'):
+        costPerkWh = np.nan_to_num(totalCost / total_energy)
+
+    columns = {c: v.tolist() for c, v in costs.items()}
+    columns['totalCost'] = totalCost.tolist()
+    columns['costPerkWh'] = costPerkWh.tolist()
+    annualCost = totalCost.sum(axis=1).tolist()
+
+    rates = {}
+    for n, k in enumerate(batchIds):
+        rates[k] = {c: v[n] for c, v in columns.items()}
+        rates[k]['rateSupported'] = True
+        rates[k]['annualCost'] = annualCost[n]
+
+    for k in ids:
+        if k not in rates:
+            rates[k] = {'rateSupported': False,
+                        'supportReason': store['reasons'][k]}
+
+    return {'totalEnergy': total_energy.tolist(), 'rates': rates}
+
+####################### REQUEST HANDLING FUNCTIONS #############################
+
+def parseRequest(body):
+    '''
+    validates a /calculate request body and returns a job for the batch
+    worker. Raises ValueError if the request is invalid
+    '''
+    try:
+        profile = np.array([body['energy'], body['power']], dtype=np.float64)
+        chargeDays = int(body.get('chargeDays', 7))
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f'invalid request ({type(e).__name__}: {e})')
+
+    profile = imp.monthlyProfile(profile)
+    imp.validateProfile(profile[0], profile[1])
+    if chargeDays < 1 or chargeDays > 7:
+        raise ValueError('chargeDays must be between 1 and 7')
+
+    criteria = body.get('rates', {})
+    if not isinstance(criteria, dict):
+        raise ValueError('rates must be an object of selection criteria')
+    if 'asOf' in criteria:
+        imp.asOfDates(criteria['asOf'])
+
+    return {'energy': profile[0], 'power': profile[1],
+            'days': calc.daysMonth(chargeDays), 'criteria': criteria,
+            'done': threading.Event()}
+
+# ------------------------------------------------------------------------------
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    '''
+    handles HTTP requests to the service (see module docstring for endpoints)
+    '''
+
+    def sendJson(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.sendJson(404, {'error': 'not found'})
+
+        # read from one store in case the batch worker swaps in a new one
+        current = store
+        self.sendJson(200, {'rates': len(current['cache']['rates']),
+                            'supportedRates': len(current['batch']['ids']),
+                            'loaded': current['loaded']})
+
+    def do_POST(self):
+        if self.path != '/calculate':
+            return self.sendJson(404, {'error': 'not found'})
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = parseRequest(json.loads(self.rfile.read(length)))
+        except ValueError as e:
+            return self.sendJson(400, {'error': str(e)})
+
+        jobs.put(job)
+        job['done'].wait()
+
+        if 'error' in job:
+            return self.sendJson(500, {'error': job['error']})
+        self.sendJson(200, job['result'])
+
+    def log_message(self, format, *args):
+        logging.info(format % args)
+
+# ------------------------------------------------------------------------------
+
+def serve(port=8750):
+    '''
+    builds the rate cache if needed, loads it and serves the calculator on
+    localhost until the process is stopped
+    '''
+    if not imp.validCache():
+        print('no valid cache found. building cache...')
+        imp.buildCache(force=False)
+
+    print('loading rate cache...')
+    loadStore()
+    threading.Thread(target=batchWorker, daemon=True).start()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port),
+                                             RequestHandler)
+    print(f'rate calculator service running on http://127.0.0.1:{port}\n'
+          'press ctrl+c to stop')
+    logging.info(f'service started on port {port}')
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('stopping service...')
+    finally:
+        server.server_close()
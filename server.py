@@ -0,0 +1,34 @@
+'''
+Entry point for running the Calculator as a local calculation service. The
+service keeps the rate cache loaded in memory and answers HTTP/JSON requests
+on localhost (see lib/serverFunctions.py for the endpoints).
+
+usage: python server.py [port]
+
+Built by Atlas Public Policy in Washington, DC
+2023
+
+'''
+
+import lib.serverFunctions as srv
+import sys
+import logging
+import time
+
+# start logfile
+try:
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    logging.basicConfig(filename=f'logs/server{timestamp}.txt',
+                     level=logging.INFO,
+                     filemode='w',
+                     format='%(asctime)s %(levelname)s %(message)s',
+                     datefmt='%m/%d/%Y %I:%M:%S %p')
+except Exception as e:
+    print('could not create log file\n'
+          f'(because {e})')
+    sys.exit()
+
+# run the service
+
+port = int(sys.argv[1]) if len(sys.argv) > 1 else 8750
+srv.serve(port)
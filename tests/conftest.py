@@ -0,0 +1,132 @@
+'''
+shared fixtures for the rate calculator tests. The fixture cache is built by
+the normal cache build (buildCache) from a handful of hand written URDB rates
+instead of the downloaded URDB files, in a temporary working directory.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lib.inputFunctions as imp
+
+# ------------------------------------------------------------------------------
+
+def schedule(peak=None):
+    '''
+    12 x 24 URDB period schedule. Hours in peak (a range) are period 1, all
+    other hours period 0
+    '''
+    peak = peak or range(0)
+    return [[1 if h in peak else 0 for h in range(24)] for m in range(12)]
+
+# ------------------------------------------------------------------------------
+
+def urdbRate(id, name, **fields):
+    '''
+    a URDB json rate with the rate details the cache keeps
+    '''
+    rate = {'_id': {'$oid': id}, 'rateName': name,
+            'utilityName': 'Test Utility', 'eiaId': 1234,
+            'sector': 'Commercial', 'description': name,
+            'startdate': 1577836800}
+    rate.update(fields)
+    return rate
+
+# hand written rates, one of each structure the calculator supports and one it
+# does not
+fixtureRates = [
+    urdbRate('flat', 'Flat Energy',
+             energyRateStrux=[{'energyRateTiers': [{'rate': 0.12}]}],
+             energyWeekdaySched=schedule(), energyWeekendSched=schedule()),
+    urdbRate('tou', 'TOU Energy',
+             energyRateStrux=[{'energyRateTiers': [{'rate': 0.08}]},
+                              {'energyRateTiers': [{'rate': 0.25}]}],
+             energyWeekdaySched=schedule(range(16, 21)),
+             energyWeekendSched=schedule()),
+    urdbRate('tiered', 'Tiered Energy',
+             energyRateStrux=[{'energyRateTiers': [{'max': 500, 'rate': 0.10},
+                                                   {'rate': 0.15}]}],
+             energyWeekdaySched=schedule(), energyWeekendSched=schedule()),
+    urdbRate('demand', 'TOU Energy and Demand',
+             energyRateStrux=[{'energyRateTiers': [{'rate': 0.07}]},
+                              {'energyRateTiers': [{'rate': 0.20}]}],
+             energyWeekdaySched=schedule(range(12, 18)),
+             energyWeekendSched=schedule(),
+             demandRateStrux=[{'demandRateTiers': [{'rate': 4.0}]},
+                              {'demandRateTiers': [{'rate': 12.0}]}],
+             demandWeekdaySched=schedule(range(12, 18)),
+             demandWeekendSched=schedule()),
+    urdbRate('flatdemand', 'Flat Demand',
+             energyRateStrux=[{'energyRateTiers': [{'rate': 0.09}]}],
+             energyWeekdaySched=schedule(), energyWeekendSched=schedule(),
+             flatDemandStrux=[{'flatDemandTiers': [{'rate': 9.5}]}],
+             flatDemandMonths=[0] * 12,
+             demandMin=10, demandMax=200),
+    urdbRate('unsupported', 'Tiered TOU Energy',
+             energyRateStrux=[{'energyRateTiers': [{'max': 500, 'rate': 0.1},
+                                                   {'rate': 0.2}]},
+                              {'energyRateTiers': [{'max': 500, 'rate': 0.3},
+                                                   {'rate': 0.4}]}],
+             energyWeekdaySched=schedule(range(16, 21)),
+             energyWeekendSched=schedule()),
+]
+
+# ------------------------------------------------------------------------------
+
+def fixtureCsv():
+    '''
+    URDB csv rows of the fixture rates (the csv is only used for the filtered
+    rate set)
+    '''
+    rates = pd.DataFrame({'label': [i['_id']['$oid'] for i in fixtureRates],
+                          'name': [i['rateName'] for i in fixtureRates],
+                          'utility': [i['utilityName'] for i in fixtureRates],
+                          'sector': [i['sector'] for i in fixtureRates],
+                          'description': [i['description']
+                                          for i in fixtureRates],
+                          'enddate': None})
+    imp.rateFilter(rates)
+    return rates
+
+# ------------------------------------------------------------------------------
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''
+    empty working directory with the folders made by initial_setup
+    '''
+    for i in ['results', 'cached_data', 'logs', 'user_input']:
+        (tmp_path / i).mkdir()
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+# ------------------------------------------------------------------------------
+
+@pytest.fixture
+def cache(workdir, monkeypatch):
+    '''
+    builds the fixture rate cache in the working directory and returns it
+    loaded (see loadCache)
+    '''
+    monkeypatch.setattr(imp, 'getRateCsv', fixtureCsv)
+    monkeypatch.setattr(imp, 'getRateJson',
+                        lambda: {i['_id']['$oid']: i for i in fixtureRates})
+    imp.buildCache()
+    return imp.loadCache(quiet=True)
+
+# ------------------------------------------------------------------------------
+
+@pytest.fixture
+def profile():
+    '''
+    12 x 24 energy (kWh) and power (kW) profile of overnight and afternoon
+    charging, with a different peak in each month
+    '''
+    energy = np.zeros((12, 24))
+    power = np.zeros((12, 24))
+    for m in range(12):
+        for h in list(range(0, 6)) + [17, 18]:
+            power[m, h] = 20 + 2 * m
+            energy[m, h] = power[m, h] * 0.9
+    return energy, power
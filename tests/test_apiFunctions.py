@@ -0,0 +1,139 @@
+'''
+tests of the library API in apiFunctions against the fixture rate cache
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lib.apiFunctions as api
+import lib.calculatorFunctions as calc
+import lib.inputFunctions as imp
+import lib.outputFunctions as out
+
+# ------------------------------------------------------------------------------
+
+@pytest.fixture
+def rates(cache):
+    return api.loadRates(cache)
+
+# ------------------------------------------------------------------------------
+
+def test_calculate_matches_coreCalc(rates, cache, profile):
+    energy, power = profile
+    longdf, summarydf = api.calculate(profile, 'All Rates in URDB', 5,
+                                      rates=rates)
+
+    days = calc.daysMonth(5)
+    total_energy = calc.nrgUse(energy, days)
+    maxPower = calc.getMaxPower(power)
+
+    assert sorted(summarydf['id']) == sorted(cache['rates'])
+    for k, rate in cache['rates'].items():
+        expected = calc.coreCalc(rate, energy, power, days, maxPower,
+                                 total_energy)
+        monthly = longdf[longdf['id'] == k].sort_values('month')
+
+        if expected == 'unsupported':
+            assert not monthly['rateSupported'].any()
+            continue
+
+        assert monthly['rateSupported'].all()
+        for c in calc.components:
+            np.testing.assert_allclose(monthly[c].astype(float), expected[c],
+                                       atol=1e-9, err_msg=f'{k} {c}')
+
+# ------------------------------------------------------------------------------
+
+def test_calculate_selection(rates, profile):
+    longdf, summarydf = api.calculate(profile, ['tou', 'missing', 'flat'], 5,
+                                      rates=rates)
+    assert summarydf['id'].tolist() == ['flat', 'tou']
+
+    longdf, summarydf = api.calculate(profile, {'ids': ['tou', 'flat'],
+                                                'asOf': '2020-06-30'}, 5,
+                                      rates=rates)
+    assert summarydf['id'].tolist() == ['flat', 'tou']
+
+# ------------------------------------------------------------------------------
+
+@pytest.mark.parametrize('peak', [False, True])
+def test_recalculate_matches_calculate_after_edit(rates, profile, peak):
+    energy, power = profile
+    longdf, summarydf, months = api.recalculate(profile, None,
+                                                'All Rates in URDB', 5,
+                                                rates=rates)
+
+    # edit one month, with or without a new peak for the year
+    energy, power = energy.copy(), power.copy()
+    energy[3, 17] *= 2
+    power[3, 17] = power.max() + 10 if peak else power[3, 17] * 0.5
+    assert api.changedMonths(months, energy, power) == [3]
+
+    longdf, summarydf, months = api.recalculate((energy, power), months,
+                                                'All Rates in URDB', 5,
+                                                rates=rates)
+    expected, expectedSummary = api.calculate((energy, power),
+                                              'All Rates in URDB', 5,
+                                              rates=rates)
+
+    sort = lambda df: df.sort_values(['id', 'month']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(sort(longdf), sort(expected))
+
+# ------------------------------------------------------------------------------
+
+def test_demand_attribution_periods(rates, profile):
+    longdf, summarydf = api.calculate(profile, ['demand'], 5, rates=rates,
+                                      attribution='results/test')
+    df = pd.read_parquet('results/test_demand.parquet')
+
+    # periods are ordered by price, the URDB periods cost 4 and 12 $/kW
+    assert sorted(df['period'].unique()) == [0, 1]
+    assert df.groupby('period')['periodPrice'].first().tolist() == [4.0, 12.0]
+    np.testing.assert_allclose(df['touDemandCost'],
+                               df['peakPower'] * df['periodPrice'])
+
+    monthly = df.groupby('month')['touDemandCost'].sum()
+    np.testing.assert_allclose(monthly.to_numpy(),
+                               longdf['TOUDemandCharge'].astype(float))
+
+# ------------------------------------------------------------------------------
+
+def test_queryResults_skips_runs_not_in_manifest(cache, profile, rates):
+    longdf, summarydf = api.calculate(profile, 'All Rates in URDB', 5,
+                                      rates=rates)
+
+    finished = out.openResultsRun('finished', {'chargeDays': 5})
+    out.appendResults(finished, longdf, cache['info'])
+    out.closeResultsRun(finished)
+
+    # a run that failed part way is written but never recorded
+    failed = out.openResultsRun('failed', {'chargeDays': 5})
+    out.appendResults(failed, longdf, cache['info'])
+
+    assert api.runManifest()['runId'].tolist() == [finished['runId']]
+
+    df = api.queryResults()
+    assert set(df['runId']) == {finished['runId']}
+    assert len(df) == len(longdf)
+
+    assert api.queryResults(runs=failed['runId']).empty
+
+    df = api.queryResults(ids='tou', months=[1, 2])
+    assert sorted(df['month'].tolist()) == [1, 2]
+    assert set(df['id']) == {'tou'}
+
+# ------------------------------------------------------------------------------
+
+def test_calculate_sqlite_cache(workdir, monkeypatch, cache, rates, profile):
+    expected = api.calculate(profile, 'All Filtered Rates', 5, rates=rates)
+
+    monkeypatch.setattr(imp, 'cacheBackend', 'sqlite')
+    imp.buildCache()
+    sqliteCache = imp.loadCache(quiet=True)
+    assert isinstance(sqliteCache['rates'], imp.RateStore)
+
+    result = api.calculate(profile, 'All Filtered Rates', 5,
+                           rates=api.loadRates(sqliteCache))
+    for df, expectedDf in zip(result, expected):
+        pd.testing.assert_frame_equal(df, expectedDf)
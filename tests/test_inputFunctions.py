@@ -0,0 +1,179 @@
+'''
+tests of the rate cache and rate selection functions in inputFunctions
+'''
+
+import copy
+import os
+import sqlite3
+import weakref
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import lib.inputFunctions as imp
+from tests.conftest import fixtureRates
+
+# ------------------------------------------------------------------------------
+
+def dateInfo(rows):
+    '''
+    rate information table of (id, startdate, enddate) rows
+    '''
+    return pd.DataFrame(rows, columns=['id', 'startdate', 'enddate'])
+
+# ------------------------------------------------------------------------------
+
+@pytest.fixture
+def dateIndex():
+    '''
+    date index of rates that start and end around 2021-06-30
+    '''
+    return imp.buildDateIndex(dateInfo([
+        ('startsDuringDay', pd.Timestamp('2021-06-30 04:00'), None),
+        ('endsDayBefore', pd.Timestamp('2020-01-01'),
+         pd.Timestamp('2021-06-29 23:00')),
+        ('endsAtMidnight', pd.Timestamp('2020-01-01'),
+         pd.Timestamp('2021-06-30 00:00')),
+        ('startsNextDay', pd.Timestamp('2021-07-01 00:00'), None),
+        ('startsNewYearsEve', pd.Timestamp('2021-12-31 18:00'), None),
+        ('noDates', None, None)]))
+
+# ------------------------------------------------------------------------------
+
+def test_effectiveRates_single_date_covers_whole_day(dateIndex):
+    assert imp.effectiveRates(dateIndex, '2021-06-30') == {
+        'startsDuringDay', 'endsAtMidnight', 'noDates'}
+
+# ------------------------------------------------------------------------------
+
+def test_effectiveRates_date_with_time_is_an_instant(dateIndex):
+    assert imp.effectiveRates(dateIndex, '2021-06-30 02:00') == {'noDates'}
+
+# ------------------------------------------------------------------------------
+
+def test_effectiveRates_year_range_includes_last_day(dateIndex):
+    assert imp.effectiveRates(dateIndex, ('2021-01-01', '2021-12-31')) == {
+        'startsDuringDay', 'endsDayBefore', 'endsAtMidnight', 'startsNextDay',
+        'startsNewYearsEve', 'noDates'}
+    assert imp.effectiveRates(dateIndex, ('2022-01-01', '2022-12-31')) == {
+        'startsDuringDay', 'startsNextDay', 'startsNewYearsEve', 'noDates'}
+
+# ------------------------------------------------------------------------------
+
+def test_effectiveRates_matches_full_scan():
+    # enough rates to fill several blocks of the max-end tree
+    rng = np.random.default_rng(0)
+    start = (pd.Timestamp('2000-01-01')
+             + pd.to_timedelta(rng.integers(0, 200000, 1000), unit='h'))
+    end = start + pd.to_timedelta(rng.integers(0, 50000, 1000), unit='h')
+    end = end.where(rng.random(1000) > 0.2)
+    dateIndex = imp.buildDateIndex(dateInfo(
+        {'id': [f'r{i}' for i in range(1000)], 'startdate': start,
+         'enddate': end}))
+
+    for asOf in ['1990-01-01', '2010-05-05', '2010-05-05 12:00', '2030-01-01',
+                 ('2001-01-01', '2005-12-31')]:
+        low, high = imp.asOfDates(asOf)
+        inEffect = (dateIndex['start'] <= high) & (dateIndex['end'] >= low)
+        assert imp.effectiveRates(dateIndex, asOf) == set(
+            dateIndex['ids'][inEffect])
+
+# ------------------------------------------------------------------------------
+
+def test_asOfDates_rejects_invalid_dates():
+    with pytest.raises(ValueError):
+        imp.asOfDates('not a date')
+    with pytest.raises(ValueError):
+        imp.asOfDates(('2021-12-31', '2021-01-01'))
+
+# ------------------------------------------------------------------------------
+
+def test_snapshotDiff():
+    previous = {'a': 'x', 'b': 'y', 'c': 'z'}
+    current = {'b': 'y', 'c': 'changed', 'd': 'new'}
+    assert imp.snapshotDiff(previous, current) == {
+        'added': ['d'], 'removed': ['a'], 'changed': ['c']}
+    assert imp.snapshotDiff(current, current) == {
+        'added': [], 'removed': [], 'changed': []}
+
+# ------------------------------------------------------------------------------
+
+def test_snapshotDiff_of_cache_refresh(cache, monkeypatch):
+    rates = copy.deepcopy(fixtureRates)
+    # a new price changes the cost structure, a new name does not
+    rates[0]['energyRateStrux'][0]['energyRateTiers'][0]['rate'] = 0.13
+    rates[1]['rateName'] = 'Renamed'
+    rates.pop()
+    monkeypatch.setattr(imp, 'getRateJson',
+                        lambda: {i['_id']['$oid']: i for i in rates})
+    imp.buildCache()
+
+    previous = imp.loadFingerprints(imp.previousFingerprintFile)['rates']
+    current = imp.loadFingerprints()['rates']
+    assert imp.snapshotDiff(previous, current) == {
+        'added': [], 'removed': ['unsupported'], 'changed': ['flat']}
+
+# ------------------------------------------------------------------------------
+
+def test_supportedIds(cache):
+    ids = ['unsupported', 'tou', 'flat']
+    assert imp.supportedIds(cache['info'], ids) == ['tou', 'flat']
+
+# ------------------------------------------------------------------------------
+
+def test_sqlite_cache_matches_pickle_cache(cache, monkeypatch):
+    monkeypatch.setattr(imp, 'cacheBackend', 'sqlite')
+    imp.buildCache()
+    sqliteCache = imp.loadCache(quiet=True)
+
+    for k in ['demand', 'dates']:
+        for name, v in cache[k].items():
+            np.testing.assert_array_equal(sqliteCache[k][name], v)
+
+    for filtertype in ['All Filtered Rates', 'Filtered Commercial Rates',
+                       'Filtered Residential Rates', 'All Rates in URDB']:
+        ids = imp.filterIds(filtertype, imp.filteredRates(cache),
+                            cache['rates'])
+        assert sqliteCache['rates'].selectIds(filtertype) == ids
+        assert list(sqliteCache['rates'].select(filtertype)) == ids
+    sqliteCache['rates'].close()
+
+# ------------------------------------------------------------------------------
+
+def test_validCache_detects_changed_files(cache):
+    assert imp.validCache()
+
+    path = imp.priceFiles['marginal']
+    with open(path, 'r+b') as f:
+        f.seek(-1, os.SEEK_END)
+        last = f.read(1)
+        f.seek(-1, os.SEEK_END)
+        f.write(bytes([last[0] ^ 1]))
+
+    assert not imp.validCache(verify=True)
+    assert not imp.validCache()
+
+# ------------------------------------------------------------------------------
+
+def test_releaseCache_drops_session_cache(cache):
+    imp.startPreload()
+    loaded = imp.sessionCache()
+    mapped = weakref.ref(loaded['prices']['marginal'])
+    del loaded
+
+    imp.releaseCache()
+    assert mapped() is None
+    assert not imp.session and not imp.preload
+
+# ------------------------------------------------------------------------------
+
+def test_releaseCache_closes_sqlite_cache(cache, monkeypatch):
+    monkeypatch.setattr(imp, 'cacheBackend', 'sqlite')
+    imp.buildCache()
+    store = imp.sessionCache()['rates']
+    assert len(store) == len(cache['rates'])
+
+    imp.releaseCache()
+    with pytest.raises(sqlite3.ProgrammingError):
+        len(store)